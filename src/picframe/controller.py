@@ -5,6 +5,7 @@ import time
 import signal
 import sys
 import ssl
+import threading
 
 
 def make_date(txt):
@@ -42,6 +43,8 @@ class Controller:
 
     """
 
+    STANDBY_POLL = 0.25  # seconds between checks for touch or key presses while the display is off
+
     def __init__(self, model, viewer):
         self.__logger = logging.getLogger("controller.Controller")
         self.__logger.info('creating an instance of Controller')
@@ -50,6 +53,8 @@ class Controller:
         self.__http_config = self.__model.get_http_config()
         self.__mqtt_config = self.__model.get_mqtt_config()
         self.__paused = False
+        self.__standby = False  # display switched off, loop() just waits to be woken
+        self.__wake = threading.Event()
         self.__force_navigate = False
         self.__next_tm = 0
         self.__date_from = make_date('1901/12/15')  # TODO This seems to be the minimum date to be handled by date functions  # noqa: E501
@@ -166,6 +171,12 @@ class Controller:
     def display_is_on(self, on_off):
         self.paused = not on_off
         self.__viewer.display_is_on = on_off
+        self.__model.suspend_image_cache(not on_off)
+        self.__standby = not on_off
+        if on_off:
+            self.__wake.set()
+        else:
+            self.__wake.clear()
         if self.__mqtt_config['use_mqtt']:
             self.publish_state()
 
@@ -301,6 +312,11 @@ class Controller:
         signal.signal(signal.SIGINT, self.__signal_handler)
 
         while self.keep_looping:
+            if self.__standby:
+                self.__viewer.frame_is_drawn = False  # nothing to draw the menu on to
+                self.__interface_peripherals.check_input()  # a touch or key press switches the display on
+                self.__wake.wait(timeout=self.STANDBY_POLL)
+                continue
             time_delay = self.__model.time_delay
             fade_time = self.__model.fade_time
 
@@ -326,10 +342,12 @@ class Controller:
                             image_attr[key] = pics[0].__dict__[field_name]  # TODO nicer using namedtuple for Pic
                     if self.__mqtt_config['use_mqtt']:
                         self.publish_state(pics[0].fname, image_attr)
-            self.__model.pause_looping = self.__viewer.is_in_transition()
+            self.__model.pause_looping(self.__viewer.is_in_transition() or self.__viewer.is_preloading())
             (loop_running, skip_image) = self.__viewer.slideshow_is_running(pics, time_delay, fade_time, self.__paused)
             if not loop_running:
                 break
+            if pics is not None and self.__viewer.prefetch_depth > 0:
+                self.__viewer.prefetch(self.__model.get_upcoming_files(self.__viewer.prefetch_depth))
             if skip_image:
                 self.__next_tm = 0
             self.__interface_peripherals.check_input()
@@ -372,6 +390,7 @@ class Controller:
 
     def stop(self):
         self.keep_looping = False
+        self.__wake.set()
         self.__interface_peripherals.stop()
         if self.__interface_mqtt:
             self.__interface_mqtt.stop()
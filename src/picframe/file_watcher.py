@@ -0,0 +1,176 @@
+import os
+import errno
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+              | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# file systems where changes made by other machines never produce inotify events
+NETWORK_FILE_SYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'ncpfs', 'afs', '9p', 'davfs',
+                        'fuse.sshfs', 'fuse.rclone', 'fuse.davfs2')
+
+
+class FileEvents:
+    """Changes collected by InotifyWatcher.read_events(). All entries are full paths."""
+
+    def __init__(self):
+        self.changed_files = set()  # created, written or moved in
+        self.removed_files = set()  # deleted or moved out
+        self.new_dirs = set()
+        self.removed_dirs = set()
+        self.overflow = False  # the kernel queue overflowed, events have been lost
+
+    def __bool__(self):
+        return bool(self.changed_files or self.removed_files or self.new_dirs or self.removed_dirs or self.overflow)
+
+
+def file_system_type(path):
+    """Return the type of the file system holding path according to /proc/mounts, or None"""
+    path = os.path.realpath(path)
+    fs_type = None
+    best = ''
+    try:
+        with open('/proc/mounts', 'r') as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace('\\040', ' ')
+                if ((path == mount_point or path.startswith(mount_point.rstrip('/') + '/'))
+                        and len(mount_point) >= len(best)):
+                    best, fs_type = mount_point, fields[2]
+    except OSError:
+        pass
+    return fs_type
+
+
+class InotifyWatcher:
+    """Watches a directory tree with the Linux inotify API via ctypes.
+
+    Raises OSError from the constructor if inotify can't be used for picture_dir
+    i.e. not Linux, a network file system or too few watches available. The caller
+    is expected to fall back to walking the tree periodically.
+    """
+
+    def __init__(self, picture_dir, follow_links=False):
+        self.__logger = logging.getLogger("file_watcher.InotifyWatcher")
+        self.__picture_dir = picture_dir
+        self.__follow_links = follow_links
+        self.__watches = {}  # wd -> directory path
+        fs_type = file_system_type(picture_dir)
+        if fs_type in NETWORK_FILE_SYSTEMS:
+            raise OSError(errno.ENOTSUP, "inotify doesn't see remote changes on {}".format(fs_type))
+        libc_name = ctypes.util.find_library('c')
+        if libc_name is None:
+            raise OSError(errno.ENOTSUP, "no C library found")
+        self.__libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.__libc, 'inotify_init1'):
+            raise OSError(errno.ENOTSUP, "inotify not available")
+        self.__fd = self.__libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.__fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        try:
+            self.add_tree(picture_dir)
+        except OSError:
+            self.close()
+            raise
+
+    def add_tree(self, path):
+        """Watch path and every (non hidden) directory below it"""
+        for dir, dirs, _files in os.walk(path, followlinks=self.__follow_links):
+            if os.path.basename(dir).startswith('.') and dir != path:
+                dirs[:] = []  # ignore hidden folders
+                continue
+            wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(dir), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue  # gone again already or unreadable, nothing to watch
+                raise OSError(err, "inotify_add_watch {}: {}".format(dir, os.strerror(err)))
+            self.__watches[wd] = dir
+
+    def remove_tree(self, path):
+        """Forget the watches for path and everything below it"""
+        prefix = path.rstrip('/') + '/'
+        for wd, dir in list(self.__watches.items()):
+            if dir == path or dir.startswith(prefix):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__watches[wd]
+
+    def read_events(self, timeout=1.0):
+        """Wait up to timeout seconds for changes and return them as FileEvents"""
+        events = FileEvents()
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        if not ready:
+            return events
+        while True:
+            try:
+                buf = os.read(self.__fd, 65536)
+            except BlockingIOError:
+                break
+            if not buf:
+                break
+            self.__parse(buf, events)
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+        self.__watches = {}
+
+    def __parse(self, buf, events):
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buf, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(buf[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & IN_Q_OVERFLOW:
+                events.overflow = True
+                continue
+            dir = self.__watches.get(wd)
+            if dir is None:
+                continue
+            if mask & IN_IGNORED:  # watch removed by the kernel
+                del self.__watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                events.removed_dirs.add(dir)
+                continue
+            path = os.path.join(dir, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    events.new_dirs.add(path)
+                    events.removed_dirs.discard(path)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    events.removed_dirs.add(path)
+                    events.new_dirs.discard(path)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.removed_files.add(path)
+                events.changed_files.discard(path)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                events.changed_files.add(path)
+                events.removed_files.discard(path)
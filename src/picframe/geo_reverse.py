@@ -1,18 +1,36 @@
+import os
 import json
+import math
+import threading
 import urllib.request
 import locale
 import logging
+import numpy as np
 
 URL = "https://nominatim.openstreetmap.org/reverse?format=geojson&lat={}&lon={}&zoom={}&email={}&accept-language={}"
 
 
+def format_address(adr, key_list=None):
+    """Join the parts of the address dict adr picked out by key_list"""
+    # some experimentation might be needed to get a good set of alternatives in key_list
+    adr_list = []
+    if key_list is not None:
+        for part in key_list:
+            for option in part:
+                if option in adr:
+                    adr_list.append(adr[option])
+                    break  # add just the first one from the options
+    else:
+        adr_list = adr.values()
+    return ", ".join(adr_list)
+
+
 class GeoReverse:
     def __init__(self, geo_key, zoom=18, key_list=None):
         self.__logger = logging.getLogger("geo_reverse.GeoReverse")
         self.__geo_key = geo_key
         self.__zoom = zoom
         self.__key_list = key_list
-        self.__geo_locations = {}
         self.__language = locale.getlocale()[0][:2]
 
     def get_address(self, lat, lon):
@@ -21,17 +39,169 @@ class GeoReverse:
                                         timeout=3.0) as req:
                 data = json.loads(req.read().decode())
             adr = data['features'][0]['properties']['address']
-            # some experimentation might be needed to get a good set of alternatives in key_list
-            adr_list = []
-            if self.__key_list is not None:
-                for part in self.__key_list:
-                    for option in part:
-                        if option in adr:
-                            adr_list.append(adr[option])
-                            break  # add just the first one from the options
-            else:
-                adr_list = adr.values()
-            return ", ".join(adr_list)
+            return format_address(adr, self.__key_list)
         except Exception as e:  # TODO return different thing for different exceptions
             self.__logger.error("lat=%f, lon=%f -> %s", lat, lon, e)
             return ""
+
+
+class GeoReverseOffline:
+    """Reverse geocoding from a GeoNames dump (e.g. cities1000.txt from
+    https://download.geonames.org/export/dump/) with no network access.
+
+    The places are held in numpy arrays sorted by grid cell so a look up only
+    measures the distance to the places in the cells around lat, lon. Names are
+    held UTF-8 encoded end to end in one array with the offset of the end of each,
+    states and countries as an index into a table of the few different ones, rather
+    than as fixed width unicode arrays at four bytes per character of the longest. The
+    arrays are saved next to data_file as .npz which is much quicker to load
+    than the text file. admin1CodesASCII.txt and countryInfo.txt, if they are
+    in the same folder, are used for the state and country names.
+    """
+
+    CELL = 1.0  # degrees
+    MAX_RINGS = 3  # cells searched out from the one containing lat, lon
+    CITY_POPULATION = 10000  # smaller places are reported as a village
+
+    def __init__(self, data_file, key_list=None):
+        self.__logger = logging.getLogger("geo_reverse.GeoReverseOffline")
+        self.__data_file = data_file
+        self.__key_list = key_list
+        self.__load_lock = threading.Lock()
+        self.__places = None  # dict of arrays, loaded on first use
+
+    def get_address(self, lat, lon):
+        places = self.__get_places()
+        if places is None:
+            return ""
+        i = self.__nearest(places, lat, lon)
+        if i is None:
+            self.__logger.debug("lat=%f, lon=%f -> no place within %d cells", lat, lon, self.MAX_RINGS)
+            return ""
+        adr = {}
+        place_key = 'city' if places['population'][i] >= self.CITY_POPULATION else 'village'
+        adr[place_key] = self.__text(places, 'name', i)
+        state = self.__text(places, 'states', places['state'][i])
+        if state:
+            adr['state'] = state
+        adr['country'] = self.__text(places, 'countries', places['country'][i])
+        return format_address(adr, self.__key_list)
+
+    def __text(self, places, key, i):
+        # string i of the table made by __string_table
+        end = places[key + '_end']
+        return places[key + '_text'][end[i - 1] if i > 0 else 0:end[i]].tobytes().decode('utf-8')
+
+    def __nearest(self, places, lat, lon):
+        n_lon = places['n_lon']
+        cell_lat = int((lat + 90.0) // self.CELL)
+        cell_lon = int((lon + 180.0) // self.CELL)
+        found = []
+        last_ring = self.MAX_RINGS
+        ring = 0
+        while ring <= last_ring:
+            ids = [(cell_lat + j) * n_lon + (cell_lon + k) % n_lon
+                   for j in range(-ring, ring + 1) for k in range(-ring, ring + 1)
+                   if max(abs(j), abs(k)) == ring]
+            lo = np.searchsorted(places['cell'], ids, side='left')
+            hi = np.searchsorted(places['cell'], ids, side='right')
+            found.extend(np.arange(a, b) for a, b in zip(lo, hi) if b > a)
+            if found and last_ring > ring + 1:
+                last_ring = ring + 1  # one more ring, a nearer place could be just over the edge of a cell
+            ring += 1
+        if not found:
+            return None
+        found = np.concatenate(found)
+        d_lat = places['lat'][found] - lat
+        d_lon = (places['lon'][found] - lon + 180.0) % 360.0 - 180.0
+        d_lon *= math.cos(math.radians(lat))
+        return found[np.argmin(d_lat * d_lat + d_lon * d_lon)]
+
+    def __get_places(self):
+        with self.__load_lock:
+            if self.__places is None:
+                try:
+                    self.__places = self.__load()
+                except Exception as e:
+                    self.__logger.error("Can't load places from %s -> %s", self.__data_file, e)
+                    self.__places = {}  # don't keep trying
+            return self.__places or None
+
+    def __getstate__(self):
+        # for the indexing process, the places are loaded again there when first needed
+        state = self.__dict__.copy()
+        del state['_GeoReverseOffline__load_lock']
+        state['_GeoReverseOffline__places'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__load_lock = threading.Lock()
+
+    def __load(self):
+        npz_file = self.__data_file + '.npz'
+        if (os.path.isfile(npz_file) and (not os.path.isfile(self.__data_file)
+                                          or os.path.getmtime(npz_file) >= os.path.getmtime(self.__data_file))):
+            with np.load(npz_file) as data:
+                places = {key: data[key] for key in data.files}
+            if 'name_end' in places or not os.path.isfile(self.__data_file):  # else saved by an older version
+                places['n_lon'] = int(places['n_lon'])
+                return places
+        places = self.__read_tsv()
+        try:
+            np.savez(npz_file, **places)
+        except OSError as e:
+            self.__logger.warning("Can't save %s -> %s", npz_file, e)
+        return places
+
+    def __read_tsv(self):
+        folder = os.path.dirname(self.__data_file)
+        states = self.__read_names(os.path.join(folder, 'admin1CodesASCII.txt'), 0, 1)
+        countries = self.__read_names(os.path.join(folder, 'countryInfo.txt'), 0, 4)
+        name, lat, lon, state, country, population = [], [], [], [], [], []
+        state_ids, country_ids = {}, {}  # name -> index in the table
+        with open(self.__data_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15 or fields[6] != 'P':  # only populated places
+                    continue
+                name.append(fields[1])
+                lat.append(float(fields[4]))
+                lon.append(float(fields[5]))
+                state.append(state_ids.setdefault(states.get(fields[8] + '.' + fields[10], ''), len(state_ids)))
+                country.append(country_ids.setdefault(countries.get(fields[8], fields[8]), len(country_ids)))
+                population.append(int(fields[14] or 0))
+        n_lon = int(round(360.0 / self.CELL))
+        lat = np.array(lat, dtype=np.float32)
+        lon = np.array(lon, dtype=np.float32)
+        cell = (((lat + 90.0) // self.CELL).astype(np.int64) * n_lon
+                + ((lon + 180.0) // self.CELL).astype(np.int64) % n_lon)
+        order = np.argsort(cell, kind='stable')
+        self.__logger.info("Read %d places from %s", len(order), self.__data_file)
+        places = {'cell': cell[order], 'lat': lat[order], 'lon': lon[order],
+                  'state': np.array(state, dtype=np.int32)[order],
+                  'country': np.array(country, dtype=np.int32)[order],
+                  'population': np.array(population, dtype=np.int64)[order], 'n_lon': n_lon}
+        places['name_text'], places['name_end'] = self.__string_table(name[i] for i in order)
+        places['states_text'], places['states_end'] = self.__string_table(state_ids)
+        places['countries_text'], places['countries_end'] = self.__string_table(country_ids)
+        return places
+
+    def __string_table(self, strings):
+        # (the strings UTF-8 encoded end to end as uint8, the offset of the end of each)
+        encoded = [string.encode('utf-8') for string in strings]
+        end = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        return np.frombuffer(b''.join(encoded), dtype=np.uint8), end
+
+    def __read_names(self, file_name, key_col, name_col):
+        names = {}
+        if not os.path.isfile(file_name):
+            return names
+        with open(file_name, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) > max(key_col, name_col):
+                    names[fields[key_col]] = fields[name_col]
+        return names
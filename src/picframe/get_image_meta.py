@@ -1,6 +1,12 @@
+import io
+import re
+import html
 import logging
-from PIL import Image
+import mmap
+import struct
+from PIL import Image, IptcImagePlugin
 from PIL.ExifTags import TAGS, GPSTAGS
+from PIL.TiffImagePlugin import IFDRational
 from fractions import Fraction
 
 try:
@@ -10,20 +16,224 @@ try:
 except ImportError:
     register_heif_opener = None
 
+# Tags read by the JPEG fast path, the ones ImageCache stores
+JPEG_IMAGE_TAGS = (0x0112,  # Orientation
+                   0x010F,  # Make
+                   0x0110,  # Model
+                   0x4746)  # Rating
+JPEG_EXIF_TAGS = (0x829D,  # FNumber
+                  0x829A,  # ExposureTime
+                  0x8827,  # ISOSpeedRatings
+                  0x920A,  # FocalLength
+                  0xA434,  # LensModel
+                  0x9003,  # DateTimeOriginal
+                  0x4746)  # Rating
+JPEG_GPS_TAGS = (1, 2, 3, 4)  # GPSLatitudeRef, GPSLatitude, GPSLongitudeRef, GPSLongitude
+JPEG_SOF_MARKERS = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 7: 1, 9: 4, 10: 8}
+XMP_HEADER = b'http://ns.adobe.com/xap/1.0/\x00'
+XMP_HEADLINE = re.compile(r'Headline(?:="([^"]*)"|>([^<]*)<)')
+XMP_DESCRIPTION = re.compile(r'<(?:\w+:)?description[\s>](.*?)</(?:\w+:)?description>', re.DOTALL)
+XMP_SUBJECT = re.compile(r'<(?:\w+:)?subject[\s>](.*?)</(?:\w+:)?subject>', re.DOTALL)
+XMP_LI = re.compile(r'<(?:\w+:)?li(?:\s[^>]*)?>([^<]*)</', re.DOTALL)
+
+
+def read_jpeg_segments(buf):
+    """Walk the markers of the JPEG in buf (bytes or mmap) up to the start of the scan data.
+
+    Returns (size, exif, xmp, iptc) where size is (width, height) from the SOFn
+    segment and exif, xmp and iptc are the payloads of the first APP1 Exif, APP1
+    XMP and APP13 Photoshop segments, or None. Raises ValueError for anything
+    it doesn't understand so the caller can fall back to PIL.
+    """
+    if buf[:2] != b'\xff\xd8':
+        raise ValueError("not a JPEG")
+    size = exif = xmp = iptc = None
+    pos = 2
+    end = len(buf)
+    while pos + 4 <= end:
+        if buf[pos] != 0xFF:
+            raise ValueError("marker expected at {}".format(pos))
+        marker = buf[pos + 1]
+        if marker == 0xFF:  # fill byte
+            pos += 1
+            continue
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:  # no length
+            pos += 2
+            continue
+        if marker in (0xD9, 0xDA):  # end of image or start of scan, nothing more of interest
+            break
+        length = (buf[pos + 2] << 8) | buf[pos + 3]
+        start = pos + 4
+        pos += 2 + length
+        if length < 2 or pos > end:
+            raise ValueError("bad segment length at {}".format(start))
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack_from('>HH', buf, start + 1)
+            size = (width, height)
+        elif marker == 0xE1:
+            if exif is None and buf[start:start + 6] == b'Exif\x00\x00':
+                exif = buf[start + 6:pos]
+            elif xmp is None and buf[start:start + len(XMP_HEADER)] == XMP_HEADER:
+                xmp = buf[start + len(XMP_HEADER):pos]
+        elif marker == 0xED and iptc is None and buf[start:start + 14] == b'Photoshop 3.0\x00':
+            iptc = buf[start + 14:pos]
+    if size is None or size[0] == 0 or size[1] == 0:
+        raise ValueError("no frame size")
+    return size, exif, xmp, iptc
+
+
+def read_exif_tags(exif):
+    """Return the JPEG_*_TAGS found in the TIFF structure exif as {"Image Make": 'SONY', ...}
+    with the values converted the way PIL does it (IFDRational, tuples for counts > 1)"""
+    order = {b'II': '<', b'MM': '>'}.get(bytes(exif[:2]))
+    if order is None or struct.unpack_from(order + 'H', exif, 2)[0] != 42:
+        raise ValueError("bad TIFF header")
+    tags = {}
+    ifd0 = read_ifd(exif, order, struct.unpack_from(order + 'L', exif, 4)[0],
+                    JPEG_IMAGE_TAGS + (0x8769, 0x8825))
+    for tag, value in ifd0.items():
+        if tag in JPEG_IMAGE_TAGS:
+            tags["Image " + TAGS[tag]] = value
+    if 0x8769 in ifd0:  # ExifOffset
+        for tag, value in read_ifd(exif, order, ifd0[0x8769], JPEG_EXIF_TAGS).items():
+            tags["EXIF " + TAGS[tag]] = value
+    if 0x8825 in ifd0:  # GPSInfo
+        for tag, value in read_ifd(exif, order, ifd0[0x8825], JPEG_GPS_TAGS).items():
+            tags["GPS " + GPSTAGS[tag]] = value
+    return tags
+
+
+def read_exif_thumbnail(exif):
+    """Return the JPEG thumbnail held in IFD1 of the TIFF structure exif as bytes, or None"""
+    order = {b'II': '<', b'MM': '>'}.get(bytes(exif[:2]))
+    if order is None:
+        return None
+    try:
+        offset = struct.unpack_from(order + 'L', exif, 4)[0]
+        (count,) = struct.unpack_from(order + 'H', exif, offset)
+        (offset,) = struct.unpack_from(order + 'L', exif, offset + 2 + 12 * count)  # next IFD
+        if offset == 0:
+            return None
+        ifd1 = read_ifd(exif, order, offset, (0x0201, 0x0202))  # JPEGInterchangeFormat, ...Length
+    except (struct.error, ValueError):
+        return None
+    start, length = ifd1.get(0x0201), ifd1.get(0x0202)
+    if not start or not length or start + length > len(exif):
+        return None
+    return bytes(exif[start:start + length])
+
+
+def read_ifd(exif, order, offset, wanted):
+    values = {}
+    (count,) = struct.unpack_from(order + 'H', exif, offset)
+    for i in range(count):
+        tag, typ, n, value_offset = struct.unpack_from(order + 'HHL4s', exif, offset + 2 + 12 * i)
+        if tag not in wanted:
+            continue
+        if typ not in TIFF_TYPE_SIZES:
+            raise ValueError("unexpected type {} for tag {}".format(typ, tag))
+        data_len = TIFF_TYPE_SIZES[typ] * n
+        if data_len <= 4:
+            data = value_offset[:data_len]
+        else:
+            (start,) = struct.unpack(order + 'L', value_offset)
+            if start + data_len > len(exif):
+                raise ValueError("tag {} outside the exif data".format(tag))
+            data = exif[start:start + data_len]
+        if typ == 2:  # ASCII, as PIL's load_string
+            data = bytes(data)
+            if data.endswith(b'\x00'):
+                data = data[:-1]
+            values[tag] = data.decode('latin-1', 'replace')
+            continue
+        if typ == 7:  # UNDEFINED
+            values[tag] = bytes(data)
+            continue
+        if typ in (5, 10):
+            nums = struct.unpack(order + ('L' if typ == 5 else 'l') * (2 * n), data)
+            vals = tuple(IFDRational(nums[j], nums[j + 1]) for j in range(0, len(nums), 2))
+        else:
+            vals = struct.unpack(order + {1: 'B', 3: 'H', 4: 'L', 9: 'l'}[typ] * n, data)
+        values[tag] = vals[0] if len(vals) == 1 else vals
+    return values
+
+
+def read_iptc(data):
+    """Return the IPTC datasets in the Photoshop image resources data as {(record, dataset): bytes
+    or list of bytes if repeated}, like PIL's IptcImagePlugin.getiptcinfo()"""
+    iptc = {}
+    pos = 0
+    while pos + 12 <= len(data) and data[pos:pos + 4] == b'8BIM':
+        (resource,) = struct.unpack_from('>H', data, pos + 4)
+        name_len = data[pos + 6]
+        pos += 6 + ((name_len + 2) & ~1)  # pascal string padded to an even length
+        (size,) = struct.unpack_from('>L', data, pos)
+        pos += 4
+        if resource == 0x0404:
+            block = data[pos:pos + size]
+            i = 0
+            while i + 5 <= len(block) and block[i] == 0x1C:
+                record, dataset, length = struct.unpack_from('>BBH', block, i + 1)
+                i += 5
+                if length & 0x8000:  # extended dataset, length in the next length & 0x7FFF bytes
+                    n = length & 0x7FFF
+                    length = int.from_bytes(block[i:i + n], 'big')
+                    i += n
+                value = bytes(block[i:i + length])
+                i += length
+                key = (record, dataset)
+                if key in iptc:
+                    if not isinstance(iptc[key], list):
+                        iptc[key] = [iptc[key]]
+                    iptc[key].append(value)
+                else:
+                    iptc[key] = value
+            break
+        pos += (size + 1) & ~1
+    return iptc
+
 
 class GetImageMeta:
 
-    def __init__(self, filename):
+    def __init__(self, filename, fast=False):
         self.__logger = logging.getLogger("get_image_meta.GetImageMeta")
         self.__tags = {}
         self.__filename = filename  # in case no exif data in which case needed for size
-        image = self.get_image_object(filename)
-        if image:
-            exif = image.getexif()
+        self.__size = None
+        self.__thumbnail = None  # bytes of the JPEG embedded in the exif, if there is one
+        # Map the file once and take everything from that. Image.open only parses the header
+        # so the size, exif and xmp come without decoding (or even reading) the pixel data.
+        try:
+            with open(filename, 'rb') as fh:
+                buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception as e:
+            self.__log_open_failure(filename, e)
+            return
+        try:
+            # Only the tags ImageCache needs are read from JPEG files when fast is set.
+            # Anything read_jpeg_segments doesn't understand goes through PIL as before.
+            if fast and buf[:2] == b'\xff\xd8':
+                try:
+                    self.__read_jpeg(buf)
+                    return
+                except Exception as e:
+                    self.__logger.debug("JPEG fast path failed: %s -> %s", filename, e)
+                    self.__tags = {}
+                    self.__size = None
+            image = Image.open(buf)
+            self.__size = image.size
+            if image.format == 'PNG' and 'exif' not in image.info:
+                exif = Image.Exif()  # getexif() would decode all of the image looking for an eXIf chunk after the data
+            else:
+                exif = image.getexif()
             self.__do_image_tags(exif)
             self.__do_exif_tags(exif)
             self.__do_geo_tags(exif)
-            self.__do_iptc_keywords()
+            self.__do_iptc_keywords(IptcImagePlugin.getiptcinfo(image))
+            raw_exif = image.info.get('exif')
+            if raw_exif:
+                self.__thumbnail = read_exif_thumbnail(raw_exif[6:] if raw_exif[:6] == b'Exif\x00\x00' else raw_exif)
             try:
                 xmp = image.getxmp()
                 if len(xmp) > 0:
@@ -31,6 +241,22 @@ class GetImageMeta:
             except Exception as e:
                 xmp = {}
                 self.__logger.warning("PILL getxmp() failed: %s -> %s", filename, e)
+            image.close()
+        except Exception as e:
+            self.__log_open_failure(filename, e)
+        finally:
+            buf.close()
+
+    def __read_jpeg(self, buf):
+        size, exif, xmp, iptc = read_jpeg_segments(buf)
+        if exif is not None:
+            self.__tags.update(read_exif_tags(exif))
+            self.__thumbnail = read_exif_thumbnail(exif)
+        if iptc is not None:
+            self.__do_iptc_keywords(read_iptc(iptc))
+        if xmp is not None:
+            self.__do_xmp_text(bytes(xmp))
+        self.__size = size
 
     def __do_image_tags(self, exif):
         tags = {
@@ -107,31 +333,62 @@ class GetImageMeta:
         except Exception as e:
             self.__logger.warning("xmp loading has failed: %s -> %s", self.__filename, e)
 
-    def __do_iptc_keywords(self):
+    def __do_xmp_text(self, xmp):
+        # The same as getxmp() then __do_xmp_keywords but only picks out the elements needed.
+        # Lightroom etc. write long edit histories into the xmp which take a while to parse.
         try:
-            from iptcinfo3 import IPTCInfo
-            iptcinfo_logger = logging.getLogger('iptcinfo')  # turn off useless log infos
-            iptcinfo_logger.setLevel(logging.ERROR)
-            with open(self.__filename, 'rb') as fh:
-                iptc = IPTCInfo(fh, force=True, out_charset='utf-8')  # TODO put IPTC read in separate function
-                # tags
-                val = iptc['keywords']
-                if val is not None and len(val) > 0:
-                    keywords = ''
-                    for key in iptc['keywords']:
-                        keywords += key.decode('utf-8') + ','  # decode binary strings
-                    self.__tags['IPTC Keywords'] = keywords
-                # caption
-                val = iptc['caption/abstract']
-                if val is not None and len(val) > 0:
-                    self.__tags['IPTC Caption/Abstract'] = iptc['caption/abstract'].decode('utf8')
-                # title
-                val = iptc['object name']
-                if val is not None and len(val) > 0:
-                    self.__tags['IPTC Object Name'] = iptc['object name'].decode('utf-8')
+            text = xmp.decode('utf-8', 'replace')
+            match = XMP_HEADLINE.search(text)
+            if match:
+                val = html.unescape(match.group(1) if match.group(1) is not None else match.group(2))
+                if len(val) > 0:
+                    self.__tags['IPTC Object Name'] = val
+            match = XMP_DESCRIPTION.search(text)
+            if match:
+                match = XMP_LI.search(match.group(1))
+                if match and len(match.group(1)) > 0:
+                    self.__tags['IPTC Caption/Abstract'] = html.unescape(match.group(1))
+            match = XMP_SUBJECT.search(text)
+            if match:
+                tags = ''.join(html.unescape(li) + ',' for li in XMP_LI.findall(match.group(1)) if li)
+                if len(tags) > 0:
+                    self.__tags['IPTC Keywords'] = tags
         except Exception as e:
-            self.__logger.warning("IPTC loading has failed - if you want to use this you will need to install iptcinfo3 %s -> %s",  # noqa: E501
-                                  self.__filename, e)
+            self.__logger.warning("xmp loading has failed: %s -> %s", self.__filename, e)
+
+    def __do_iptc_keywords(self, iptc):
+        # IPTC from the APP13 segment already read by Image.open or read_iptc, rather than
+        # IPTCInfo which reads the file again and scans all of it when there is none
+        try:
+            if not iptc:
+                return
+            # tags
+            val = iptc.get((2, 25))
+            if val:
+                if not isinstance(val, list):
+                    val = [val]
+                keywords = ''
+                for key in val:
+                    keywords += self.__decode_iptc(key) + ','  # decode binary strings
+                self.__tags['IPTC Keywords'] = keywords
+            # caption
+            val = iptc.get((2, 120))
+            if val:
+                self.__tags['IPTC Caption/Abstract'] = self.__decode_iptc(val)
+            # title
+            val = iptc.get((2, 5))
+            if val:
+                self.__tags['IPTC Object Name'] = self.__decode_iptc(val)
+        except Exception as e:
+            self.__logger.warning("IPTC loading has failed %s -> %s", self.__filename, e)
+
+    def __decode_iptc(self, val):
+        if isinstance(val, list):  # repeated when it shouldn't be, use the first
+            val = val[0]
+        try:
+            return val.decode('utf-8')
+        except UnicodeDecodeError:
+            return val.decode('latin-1')  # older files without a coded character set
 
     def has_exif(self):
         if self.__tags == {}:
@@ -220,18 +477,43 @@ class GetImageMeta:
             return None
 
     def get_size(self):
-        try:  # corrupt image file might crash app
-            return GetImageMeta.get_image_object(self.__filename).size
-        except Exception as e:
-            self.__logger.warning("get_size failed on %s -> %s", self.__filename, e)
+        if self.__size is None:  # corrupt image file might crash app
+            self.__logger.warning("get_size failed on %s", self.__filename)
             return (0, 0)
+        return self.__size
+
+    def get_thumbnail(self):
+        """The small preview image embedded in the exif as an RGB PIL image, not orientated, or None"""
+        if self.__thumbnail is None:
+            return None
+        try:
+            image = Image.open(io.BytesIO(self.__thumbnail))
+            return image.convert("RGB") if image.mode != "RGB" else image
+        except Exception as e:
+            self.__logger.debug("Can't read thumbnail of %s -> %s", self.__filename, e)
+            return None
+
+    def __log_open_failure(self, fname, e):
+        self.__logger.warning("Can't open file: \"%s\"", fname)
+        self.__logger.warning("Cause: %s", e)
 
     @staticmethod
-    def get_image_object(fname):
+    def get_image_object(fname, size=None):
+        """Open fname as an RGB or RGBA PIL image. If size (width, height) is given the
+        image is decoded at the smallest scale that still covers it, rather than at full
+        resolution, using the JPEG DCT scaling in draft() and a fast reduce() otherwise.
+        """
         try:
             image = Image.open(fname)
+            if size is not None:
+                size = (max(1, int(size[0])), max(1, int(size[1])))
+                image.draft("RGB", size)  # only JPEG acts on this, other formats ignore it
             if image.mode not in ("RGB", "RGBA"):  # mat system needs RGB or more
                 image = image.convert("RGB")
+            if size is not None:
+                factor = min(image.width // size[0], image.height // size[1])
+                if factor > 1:
+                    image = image.reduce(factor)
         # raise # the system should be able to withstand files being moved etc without crashing
         except Exception as e:
             logger = logging.getLogger("get_image_meta.GetImageMeta")
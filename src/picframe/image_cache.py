@@ -1,13 +1,132 @@
 import sqlite3
 import os
+import sys
 import time
+import math
+import signal
 import logging
 import threading
-from picframe import get_image_meta
+import multiprocessing
+from queue import Empty
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, BrokenExecutor
+from urllib.request import pathname2url
+from picframe import get_image_meta, file_watcher, mat_image
+
+
+def run_index_process(control, replies, log_level, log_files, kwargs):
+    """Entry point of the child process started by ImageCache(index_process=True). Runs an
+    ImageCache(**kwargs), which does all the writing to the db, driven by messages on control.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # ctrl-c is handled by the parent, which then sends stop
+    logging.basicConfig(stream=sys.stdout, level=log_level)
+    for log_file in log_files:
+        filehandler = logging.FileHandler(log_file)
+        filehandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logging.getLogger().addHandler(filehandler)
+    cache = ImageCache(**kwargs)
+    replies.put('ready')
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            msg = control.get(timeout=5.0)
+        except Empty:
+            if parent is not None and not parent.is_alive():
+                break  # parent died without sending stop
+            continue
+        if msg[0] == 'stop':
+            break
+        elif msg[0] == 'pause':
+            cache.pause_looping(msg[1])
+        elif msg[0] == 'suspend':
+            cache.suspend(msg[1])
+        elif msg[0] == 'purge':
+            cache.purge_files()
+        elif msg[0] == 'shown':  # refresh if changed, display stats and geo look up priority
+            cache.get_file_info(msg[1])
+            if msg[2]:
+                replies.put(msg[1])
+    cache.stop()
+
+
+def get_exif_info(file_path_name):
+    """Return a dict of the meta data stored for file_path_name. Module level so that it
+    can be run in a worker process.
+    """
+    exifs = get_image_meta.GetImageMeta(file_path_name, fast=True)
+    # Dict to store interesting EXIF data
+    # Note, the 'key' must match a field in the 'meta' table
+    e = {}
+
+    e['orientation'] = exifs.get_orientation()
+
+    width, height = exifs.get_size()
+    ext = os.path.splitext(file_path_name)[1].lower()
+    if ext not in ('.heif', '.heic') and e['orientation'] in (5, 6, 7, 8):
+        width, height = height, width  # swap values
+    e['width'] = width
+    e['height'] = height
+
+    e['f_number'] = exifs.get_exif('EXIF FNumber')
+    e['make'] = exifs.get_exif('Image Make')
+    e['model'] = exifs.get_exif('Image Model')
+    e['exposure_time'] = exifs.get_exif('EXIF ExposureTime')
+    e['iso'] = exifs.get_exif('EXIF ISOSpeedRatings')
+    e['focal_length'] = exifs.get_exif('EXIF FocalLength')
+    e['rating'] = exifs.get_exif('Image Rating')
+    e['lens'] = exifs.get_exif('EXIF LensModel')
+    e['exif_datetime'] = None
+    val = exifs.get_exif('EXIF DateTimeOriginal')
+    if val is not None:
+        # Remove any subsecond portion of the DateTimeOriginal value. According to the spec, it's
+        # not valid here anyway (should be in SubSecTimeOriginal), but it does exist sometimes.
+        val = val.split('.', 1)[0]
+        try:
+            e['exif_datetime'] = time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
+        except Exception:
+            pass
+
+    # If we still don't have a date/time, just use the file's modificaiton time
+    if e['exif_datetime'] is None:
+        e['exif_datetime'] = os.path.getmtime(file_path_name)
+
+    gps = exifs.get_location()
+    lat = gps['latitude']
+    lon = gps['longitude']
+    e['latitude'] = round(lat, 4) if lat is not None else lat  # TODO sqlite requires (None,) to insert NULL
+    e['longitude'] = round(lon, 4) if lon is not None else lon
+
+    # IPTC
+    e['tags'] = exifs.get_exif('IPTC Keywords')
+    e['title'] = exifs.get_exif('IPTC Object Name')
+    e['caption'] = exifs.get_exif('IPTC Caption/Abstract')
+
+    # Dominant colours for the mat and the average luminance, from the thumbnail in the exif
+    # read along with the tags, so they don't have to be worked out every time the picture is shown.
+    # Without one they are left for MatImage to find when needed, decoding the picture here
+    # would cost many times more than the rest of indexing it
+    e['palette'] = None
+    e['luminance'] = None
+    image = exifs.get_thumbnail()
+    if image is not None:
+        colors, luminance = mat_image.get_palette(image)
+        e['palette'] = mat_image.palette_to_text(colors)
+        e['luminance'] = round(luminance, 3)
+
+    return e
 
 
 class ImageCache:
 
+    # pragmas for every connection, sizes kept modest for a Raspberry Pi
+    DB_PRAGMAS = ('PRAGMA cache_size = -8000',  # KiB
+                  'PRAGMA mmap_size = 67108864',
+                  'PRAGMA temp_store = MEMORY')
+    GEO_BATCH = 20  # locations to collect before writing them to the db
+    GEO_RETRY = 600.0  # seconds to wait before trying a failed location again, doubled each time
+    GEO_MAX_RETRY = 7 * 24 * 3600.0
+    FILE_EVENTS_KEPT = 20000  # rows of file_event kept for readers to catch up with, see get_file_events()
+    QUERY_IDS_BATCH = 500  # file_ids per IN (...) in query_playlist
     EXTENSIONS = ['.png', '.jpg', '.jpeg', '.heif', '.heic']
     EXIF_TO_FIELD = {'EXIF FNumber': 'f_number',
                      'Image Make': 'make',
@@ -22,12 +141,14 @@ class ImageCache:
                      'IPTC Caption/Abstract': 'caption',
                      'IPTC Object Name': 'title'}
 
-    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, portrait_pairs=False):
+    def __init__(self, picture_dir, follow_links, db_file, geo_reverse, portrait_pairs=False, index_workers=1,
+                 watch_files=False, rescan_interval=2.0, geo_rate=1.0, geo_cell_size=250,
+                 index_files_per_sec=0.0, index_mb_per_sec=0.0, index_process=False, load_geoloc=True):
         # TODO these class methods will crash if Model attempts to instantiate this using a
         # different version from the latest one - should this argument be taken out?
         self.__modified_folders = []
         self.__modified_files = []
-        self.__cached_file_stats = []  # collection shared between threads
+        self.__cached_file_stats = []  # (last_displayed, file_id) queued by readers for the indexer thread
         self.__logger = logging.getLogger("image_cache.ImageCache")
         self.__logger.debug('Creating an instance of ImageCache')
         self.__picture_dir = picture_dir
@@ -35,77 +156,259 @@ class ImageCache:
         self.__db_file = db_file
         self.__geo_reverse = geo_reverse
         self.__portrait_pairs = portrait_pairs  # TODO have a function to turn this on and off?
+        self.__read_local = threading.local()  # read only connection for each thread that queries the cache
+        self.__read_dbs = []
+        self.__read_dbs_lock = threading.Lock()
+        self.__pause_looping = False
+        self.__suspended = False  # standby, don't look for changes at all
+        self.__process = None  # child process doing all the writing, if index_process
+        if index_process:
+            self.__start_process(dict(picture_dir=picture_dir, follow_links=follow_links, db_file=db_file,
+                                      geo_reverse=geo_reverse, portrait_pairs=portrait_pairs,
+                                      index_workers=index_workers, watch_files=watch_files,
+                                      rescan_interval=rescan_interval, geo_rate=geo_rate,
+                                      geo_cell_size=geo_cell_size, index_files_per_sec=index_files_per_sec,
+                                      index_mb_per_sec=index_mb_per_sec, load_geoloc=load_geoloc))
+            return
+        if index_workers < 1:  # auto, leave one core for the slideshow
+            index_workers = max(1, (os.cpu_count() or 1) - 1)
+        self.__index_workers = index_workers
+        self.__index_pool = None  # only created while there is a backlog of files to read
+        self.__watch_files = watch_files
+        self.__watcher = None  # file_watcher.InotifyWatcher, if it can be used for picture_dir
+        self.__rescan_interval = rescan_interval  # seconds between full walks of picture_dir
+        self.__index_files_per_sec = index_files_per_sec  # 0 for no limit
+        self.__index_bytes_per_sec = index_mb_per_sec * 1024 * 1024
+        self.__file_tokens = 0.0
+        self.__byte_tokens = 0.0
+        self.__budget_tm = time.time()
         self.__db = self.__create_open_db(self.__db_file)
         self.__db_write_lock = threading.Lock()  # lock to serialize db writes between threads
         # NB this is where the required schema is set
-        self.__update_schema(3)
+        self.__update_schema(6)
+        # generation stamped on every folder (and listed file) seen by a full scan of picture_dir
+        self.__scan_gen = self.__db.execute("SELECT MAX(scan_gen) FROM folder").fetchone()[0] or 0
+        self.__list_all_gen = -1  # last generation that listed the files of every folder
 
         self.__keep_looping = True
-        self.__pause_looping = False
+        self.__wake = threading.Event()
         self.__shutdown_completed = False
         self.__purge_files = False
 
+        # reverse geocoding runs on its own thread, no more than geo_rate requests per second
+        self.__geo_interval = 1.0 / geo_rate if geo_rate > 0 else 0.0
+        self.__geo_priority = deque()  # (lat, lon) of displayed pics still without a location
+        self.__geo_failed = {}  # (lat, lon) -> (number of failures, time to try again)
+        self.__geo_wake = threading.Event()
+        self.__geo_cell_size = geo_cell_size  # metres, places closer than this probably share a description
+        self.__geo_cells = {}  # (cell_lat, cell_lon) -> description, loaded from geo_cache by the geo thread
+        self.__geo_thread = None  # no look ups at all unless load_geoloc and there is a geocoder
+        if load_geoloc and geo_reverse is not None:
+            self.__geo_thread = threading.Thread(target=self.__geo_loop)
+            self.__geo_thread.start()
+
         t = threading.Thread(target=self.__loop)
         t.start()
 
     def __loop(self):
+        if self.__watch_files:
+            self.__start_watcher()
+        next_scan_tm = 0.0  # when to next walk the whole of picture_dir
         while self.__keep_looping:
-            if not self.__pause_looping:
+            self.__write_file_stats()
+            if self.__suspended:
+                self.__wake.wait(timeout=3600.0)  # set by suspend(False) or stop()
+                self.__wake.clear()
+                continue
+            if self.__pause_looping:
+                self.__wake.wait(timeout=1.0)  # set when the pause ends
+                self.__wake.clear()
+                continue
+            if self.__modified_files or self.__purge_files or time.time() >= next_scan_tm:
                 self.update_cache()
-                time.sleep(2.0)
+                next_scan_tm = time.time() + self.__rescan_interval
+            elif self.__watcher is not None:
+                events = self.__watcher.read_events(timeout=1.0)
+                if events.overflow:
+                    next_scan_tm = 0.0  # changes have been lost, walk the tree to catch up
+                elif events:
+                    self.__update_from_events(events)
+                continue
+            else:
+                time.sleep(min(0.5, self.__rescan_interval))
             time.sleep(0.01)
+        if self.__watcher is not None:
+            self.__watcher.close()
+        self.__shutdown_index_pool()
+        if self.__geo_thread is not None:
+            self.__geo_wake.set()
+            self.__geo_thread.join()
+        self.__write_file_stats()
         self.__db_write_lock.acquire()
         self.__db.commit()  # close after update_cache finished for last time
         self.__db_write_lock.release()
+        self.__close_read_dbs()
         self.__db.close()
         self.__shutdown_completed = True
 
+    def __start_process(self, kwargs):
+        # spawn rather than fork, as for the index pool. Not a daemon as it has its own pool of workers
+        ctx = multiprocessing.get_context('spawn')
+        self.__control = ctx.Queue()
+        self.__replies = ctx.Queue()
+        root_logger = logging.getLogger()
+        log_files = [hdlr.baseFilename for hdlr in root_logger.handlers if isinstance(hdlr, logging.FileHandler)]
+        self.__process = ctx.Process(target=run_index_process, name='picframe indexer',
+                                     args=(self.__control, self.__replies, root_logger.level, log_files, kwargs))
+        self.__process.start()
+        while self.__process.is_alive():  # the db schema has to be there before anything can be read
+            try:
+                if self.__replies.get(timeout=1.0) == 'ready':
+                    return
+            except Empty:
+                pass
+        raise RuntimeError("Indexing process failed to start, exit code {}".format(self.__process.exitcode))
+
     def pause_looping(self, value):
+        """Hold off reading files while value is True, i.e. during slide transitions and loading"""
+        if self.__process is not None:
+            if value != self.__pause_looping:  # called every frame, only pass on changes
+                self.__control.put(('pause', value))
+            self.__pause_looping = value
+            return
+        if self.__pause_looping and not value:
+            self.__wake.set()
         self.__pause_looping = value
 
+    def suspend(self, value):
+        """Stop looking for changes in picture_dir while value is True, i.e. the display is off.
+        Anything changed meanwhile is picked up by the next scan (or queued inotify events) on resuming.
+        """
+        if self.__process is not None:
+            self.__control.put(('suspend', value))
+            return
+        self.__suspended = value
+        self.__wake.set()  # out of any wait in __take_budget, or resume
+
     def stop(self):
+        if self.__process is not None:
+            self.__control.put(('stop',))
+            self.__process.join()  # blocking as below
+            self.__close_read_dbs()
+            return
         self.__keep_looping = False
+        self.__wake.set()
         while not self.__shutdown_completed:
             time.sleep(0.05)  # make function blocking to ensure staged shutdown
 
     def purge_files(self):
+        if self.__process is not None:
+            self.__control.put(('purge',))
+            return
         self.__purge_files = True
 
-    def update_cache(self):
+    def update_cache(self, scan_disk=True):
         """Update the cache database with new and/or modified files
         """
 
         self.__logger.debug('Updating cache')
 
         # If the current collection of updated files is empty, check for disk-based changes
-        if not self.__modified_files:
+        if not self.__modified_files and scan_disk:
             self.__logger.debug('No unprocessed files in memory, checking disk')
-            self.__modified_folders = self.__get_modified_folders()
-            self.__modified_files = self.__get_modified_files(self.__modified_folders)
+            self.__modified_folders, self.__modified_files = self.__scan_modified()
             self.__logger.debug('Found %d new files on disk', len(self.__modified_files))
 
         # While we have files to process and looping isn't paused
-        while self.__modified_files and not self.__pause_looping:
-            file = self.__modified_files.pop(0)
-            self.__logger.debug('Inserting: %s', file)
-            self.__insert_file(file)
+        self.__insert_files()
 
         # If we've process all files in the current collection, update the cached folder info
         if not self.__modified_files:
+            self.__shutdown_index_pool()
             self.__update_folder_info(self.__modified_folders)
             self.__modified_folders.clear()
 
         # If looping is still not paused, remove any files or folders from the db that are no longer on disk
-        if not self.__pause_looping:
+        if not self.__pause_looping and scan_disk:
             self.__purge_missing_files_and_folders()
 
         # Commit the current set of changes
+        self.__trim_file_events()
+        self.__commit()
+
+    def __trim_file_events(self):
+        sql = "DELETE FROM file_event WHERE seq <= (SELECT MAX(seq) FROM file_event) - ?"
         self.__db_write_lock.acquire()
-        self.__db.commit()
+        self.__db.execute(sql, (self.FILE_EVENTS_KEPT,))
         self.__db_write_lock.release()
 
+    def __start_watcher(self):
+        try:
+            self.__watcher = file_watcher.InotifyWatcher(self.__picture_dir, self.__follow_links)
+            self.__logger.info('Watching %s for changes', self.__picture_dir)
+        except OSError as e:
+            self.__logger.warning("Can't watch %s for changes, walking it every %.0fs instead: %s",
+                                  self.__picture_dir, self.__rescan_interval, e)
+            self.__watcher = None
+
+    def __update_from_events(self, events):
+        # Feed the paths reported by the watcher into the same insert and purge code used by update_cache
+        for dir in events.removed_dirs:
+            self.__watcher.remove_tree(dir)
+        for dir in events.new_dirs:
+            if self.__watcher is not None:
+                try:
+                    self.__watcher.add_tree(dir)
+                except OSError as e:  # most likely out of watches
+                    self.__logger.warning("Can't watch %s for changes, walking it every %.0fs instead: %s",
+                                          dir, self.__rescan_interval, e)
+                    self.__watcher.close()
+                    self.__watcher = None
+            new_folders, new_files = self.__scan_modified(dir)
+            self.__add_modified_folders(new_folders)
+            self.__modified_files.extend(f for f in new_files if f not in self.__modified_files)
+
+        for file in events.changed_files:
+            dir, file_only = os.path.split(file)
+            extension = os.path.splitext(file_only)[1]
+            if (extension.lower() in ImageCache.EXTENSIONS and '.AppleDouble' not in dir
+                    and not file_only.startswith('.') and os.path.isfile(file)
+                    and file not in self.__modified_files):
+                self.__modified_files.append(file)
+
+        removed = [os.path.split(file) for file in events.removed_files if not os.path.exists(file)]
+        if removed:
+            sql = """DELETE FROM file WHERE file_id IN
+                        (SELECT file.file_id FROM file INNER JOIN folder ON folder.folder_id = file.folder_id
+                            WHERE folder.name = ? AND file.basename = ? AND file.extension = ?)"""
+            self.__db_write_lock.acquire()
+            try:
+                self.__db.executemany(sql, [(dir, os.path.splitext(file_only)[0], os.path.splitext(file_only)[1][1:])
+                                            for dir, file_only in removed])
+            finally:
+                self.__db_write_lock.release()
+
+        # Record the new modification time of the folders involved so the next walk doesn't rescan them
+        changed_dirs = set(os.path.dirname(file) for file in events.changed_files | events.removed_files)
+        folders = []
+        for dir in changed_dirs:
+            try:
+                folders.append((dir, int(os.stat(dir).st_mtime)))
+            except OSError:  # gone since the event, the removed_dirs or next walk deal with it
+                continue
+        self.__add_modified_folders(folders)
+
+        if events.removed_dirs:
+            self.__flag_missing_folders(events.removed_dirs)
+        self.update_cache(scan_disk=False)
+
+    def __add_modified_folders(self, folders):
+        known = dict(self.__modified_folders)
+        known.update(folders)
+        self.__modified_folders = list(known.items())
+
     def query_cache(self, where_clause, sort_clause='fname ASC'):
-        cursor = self.__db.cursor()
+        cursor = self.__read_db().cursor()
         cursor.row_factory = None  # we don't want the "sqlite3.Row" setting from the db here...
         try:
             if not self.__portrait_pairs:  # TODO SQL insertion? Does it matter in this app?
@@ -145,54 +448,249 @@ class ImageCache:
         except Exception:
             return []
 
+    def query_playlist(self, where_clause, sort_clause='fname ASC', file_ids=None):
+        """Return an iterator over (file_id, is_portrait, last_modified) of the files matching
+        where_clause for playlist.Playlist.load(). Portrait pairs are left to the Playlist and
+        the rows come straight from the cursor, not gathered in a list as by query_cache.
+        If file_ids is given only those files are looked at, for Playlist.update().
+        """
+        sql = "SELECT file_id, is_portrait, last_modified FROM all_data WHERE ({0}){1} ORDER BY {2}"
+        if file_ids is None:
+            return self.__query_playlist(sql.format(where_clause, "", sort_clause))
+        file_ids = sorted(file_ids)
+        rows = []
+        for i in range(0, len(file_ids), self.QUERY_IDS_BATCH):
+            ids = ",".join(str(int(file_id)) for file_id in file_ids[i:i + self.QUERY_IDS_BATCH])
+            rows.extend(self.__query_playlist(sql.format(where_clause, " AND file_id IN ({})".format(ids),
+                                                         sort_clause)))
+        return iter(rows)
+
+    def __query_playlist(self, sql):
+        cursor = self.__read_db().cursor()
+        cursor.row_factory = None
+        try:
+            return cursor.execute(sql)
+        except Exception as e:
+            self.__logger.warning("Can't query playlist -> %s", e)
+            return iter(())
+
+    def get_file_event_seq(self):
+        """The seq of the latest file_event, get_file_events() from here on to keep up with the changes"""
+        return self.__read_db().execute("SELECT MAX(seq) FROM file_event").fetchone()[0] or 0
+
+    def get_file_events(self, since):
+        """Return (seq, changed, removed) for the files added, changed or removed since the file_event
+        seq since: the seq to ask from next time and sets of file_ids, those added or changed, whose
+        rows need reading again, and those removed (including files in folders gone missing).
+        Returns None if some of the events have already been dropped and everything must be read again.
+        The events are written by triggers on the file and folder tables, see __update_schema(),
+        so they come from the indexer whether that runs in this process or its own.
+        """
+        db = self.__read_db()
+        first_seq = db.execute("SELECT MIN(seq) FROM file_event").fetchone()[0]
+        if first_seq is not None and first_seq > since + 1:
+            return None
+        changed = set()
+        removed = set()
+        for seq, kind, file_id in db.execute("SELECT seq, kind, file_id FROM file_event WHERE seq > ? ORDER BY seq",
+                                             (since,)):
+            since = seq
+            if kind == 'removed':
+                changed.discard(file_id)
+                removed.add(file_id)
+            else:  # removed and added again, a file_id can be reused, is in both as it's a new file
+                changed.add(file_id)
+        return (since, changed, removed)
+
     def get_file_info(self, file_id):
         if not file_id:
             return None
+        if self.__process is not None:
+            return self.__get_file_info_from_process(file_id)
+        db = self.__read_db()
         sql = "SELECT * FROM all_data where file_id = {0}".format(file_id)
-        row = self.__db.execute(sql).fetchone()
+        row = db.execute(sql).fetchone()
         try:
             if row is not None and row['last_modified'] != os.path.getmtime(row['fname']):
                 self.__logger.debug('Cache miss: File %s changed on disk', row['fname'])
                 self.__insert_file(row['fname'], file_id)
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
+                self.__commit()  # so the read connection can see it
+                row = db.execute(sql).fetchone()  # description inserted in table
         except OSError:
             self.__logger.warning("Image '%s' does not exists or is inaccessible", row['fname'])
-        if row is not None and row['latitude'] is not None and row['longitude'] is not None and row['location'] is None:
-            if self.__get_geo_location(row['latitude'], row['longitude']):
-                row = self.__db.execute(sql).fetchone()  # description inserted in table
-        sql = "UPDATE file SET displayed_count = displayed_count + 1, last_displayed = ? WHERE file_id = ?"
-        starttime = round(time.time() * 1000)
-        self.__db_write_lock.acquire()
-        waittime = round(time.time() * 1000)
-        self.__db.execute(sql, (time.time(), file_id))  # Add file stats
-        self.__db_write_lock.release()
-        now = round(time.time() * 1000)
-        self.__logger.debug(
-            'Update file stats: Wait for %d ms and need %d ms for update ',
-            waittime - starttime, now - waittime)
+        if (self.__geo_thread is not None and row is not None and row['latitude'] is not None
+                and row['longitude'] is not None and row['location'] is None):
+            self.__geo_priority.append((row['latitude'], row['longitude']))  # look it up next
+            self.__geo_wake.set()
+        # the indexer thread writes the display stats so this never waits for __db_write_lock
+        self.__cached_file_stats.append((time.time(), file_id))
         return row  # NB if select fails (i.e. moved file) will return None
 
+    def __get_file_info_from_process(self, file_id):
+        # The indexing process does what get_file_info does above, only waiting for it if the file has changed
+        db = self.__read_db()
+        sql = "SELECT * FROM all_data where file_id = ?"
+        row = db.execute(sql, (file_id,)).fetchone()
+        changed = False
+        try:
+            changed = row is not None and row['last_modified'] != os.path.getmtime(row['fname'])
+        except OSError:
+            self.__logger.warning("Image '%s' does not exists or is inaccessible", row['fname'])
+        self.__control.put(('shown', file_id, changed))
+        if changed:
+            end_tm = time.time() + 10.0
+            while time.time() < end_tm:
+                try:
+                    if self.__replies.get(timeout=max(0.0, end_tm - time.time())) == file_id:
+                        row = db.execute(sql, (file_id,)).fetchone()
+                        break
+                except Empty:
+                    break
+        return row
+
+    def peek_file_info(self, file_id):
+        """Like get_file_info but only reads the row, no refresh, geo lookup or display stats"""
+        if not file_id:
+            return None
+        sql = "SELECT * FROM all_data where file_id = ?"
+        return self.__read_db().execute(sql, (file_id,)).fetchone()
+
     def get_column_names(self):
         sql = "PRAGMA table_info(all_data)"
-        rows = self.__db.execute(sql).fetchall()
+        rows = self.__read_db().execute(sql).fetchall()
         return [row['name'] for row in rows]
 
-    def __get_geo_location(self, lat, lon):  # TODO periodically check all lat/lon in meta with no location and try again # noqa: E501
-        location = self.__geo_reverse.get_address(lat, lon)
-        if len(location) == 0:
-            return False  # TODO this will continue to try even if there is some permanant cause
-        else:
-            sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
-            starttime = round(time.time() * 1000)
-            self.__db_write_lock.acquire()
-            waittime = round(time.time() * 1000)
-            self.__db.execute(sql, (lat, lon, location))
-            self.__db_write_lock.release()
-            now = round(time.time() * 1000)
-            self.__logger.debug(
-                'Update location: Wait for db %d ms and need %d ms for update ',
-                waittime - starttime, now - waittime)
+    def __geo_loop(self):
+        # Look up the location of every lat, lon in meta without one, those of displayed pics first.
+        # Results are written in batches, failures are retried after an increasing delay.
+        queue = []
+        found = []
+        new_cells = []
+        next_request_tm = 0.0
+        self.__load_geo_cells()
+        while self.__keep_looping:
+            priority = bool(self.__geo_priority)
+            if priority:
+                lat_lon = self.__geo_priority.popleft()
+            elif queue:
+                lat_lon = queue.pop()
+            else:
+                self.__write_geo_locations(found, new_cells)
+                queue = self.__get_missing_locations()
+                queue.reverse()  # pop() from the end
+                if not queue:
+                    self.__geo_wake.wait(timeout=60.0)  # woken by new files or a displayed pic
+                    self.__geo_wake.clear()
+                continue
+            if self.__geo_failed.get(lat_lon, (0, 0.0))[1] > time.time() or self.__has_location(lat_lon, found):
+                continue
+            cell = self.__geo_cell(*lat_lon)
+            location = self.__geo_cells.get(cell)  # somewhere close by might have been looked up already
+            if location is None:
+                wait_tm = next_request_tm - time.time()
+                if wait_tm > 0.0 and self.__geo_wake.wait(timeout=wait_tm):  # stop or new priority
+                    self.__geo_wake.clear()
+                    if lat_lon not in self.__geo_priority:
+                        queue.append(lat_lon)
+                    continue
+                next_request_tm = time.time() + self.__geo_interval
+                location = self.__geo_reverse.get_address(*lat_lon)
+                if len(location) == 0:
+                    failures = self.__geo_failed.get(lat_lon, (0, 0.0))[0] + 1
+                    delay = min(self.GEO_RETRY * 2 ** (failures - 1), self.GEO_MAX_RETRY)
+                    self.__geo_failed[lat_lon] = (failures, time.time() + delay)
+                    self.__logger.debug('No location for %s, try again in %.0fs', lat_lon, delay)
+                    continue
+                self.__geo_failed.pop(lat_lon, None)
+                if cell is not None:
+                    self.__geo_cells[cell] = location
+                    new_cells.append(cell + (location,))
+            found.append(lat_lon + (location,))
+            if len(found) >= self.GEO_BATCH or priority:
+                self.__write_geo_locations(found, new_cells)
+        self.__write_geo_locations(found, new_cells)
+
+    def __geo_cell(self, lat, lon):
+        # Snap lat, lon to a grid of roughly geo_cell_size square cells, columns get wider in
+        # degrees towards the poles so the cells stay about the same size on the ground
+        if self.__geo_cell_size <= 0:
+            return None
+        size = self.__geo_cell_size / 111320.0  # degrees of latitude
+        cell_lat = math.floor(lat / size)
+        lon_size = size / max(math.cos(math.radians((cell_lat + 0.5) * size)), 0.01)
+        return (cell_lat, math.floor(lon / lon_size))
+
+    def __load_geo_cells(self):
+        sql = "SELECT cell_lat, cell_lon, description FROM geo_cache WHERE cell_size = ?"
+        for cell_lat, cell_lon, description in self.__read_db().execute(sql, (self.__geo_cell_size,)):
+            self.__geo_cells[(cell_lat, cell_lon)] = description
+        self.__logger.debug('Loaded %d cached locations', len(self.__geo_cells))
+
+    def __get_missing_locations(self):
+        sql = """SELECT DISTINCT meta.latitude, meta.longitude FROM meta
+                    LEFT JOIN location
+                        ON location.latitude = meta.latitude AND location.longitude = meta.longitude
+                    WHERE meta.latitude IS NOT NULL AND meta.longitude IS NOT NULL AND location.id IS NULL"""
+        now = time.time()
+        return [(lat, lon) for lat, lon in self.__read_db().execute(sql)
+                if self.__geo_failed.get((lat, lon), (0, 0.0))[1] <= now]
+
+    def __has_location(self, lat_lon, found):
+        # the queue can be out of date and a displayed pic could be asked for more than once
+        if any(item[:2] == lat_lon for item in found):
             return True
+        sql = "SELECT 1 FROM location WHERE latitude = ? AND longitude = ?"
+        return self.__read_db().execute(sql, lat_lon).fetchone() is not None
+
+    def __write_geo_locations(self, found, new_cells):
+        if not found:
+            return
+        sql = "INSERT OR REPLACE INTO location (latitude, longitude, description) VALUES (?, ?, ?)"
+        sql_cell = "INSERT OR REPLACE INTO geo_cache (cell_size, cell_lat, cell_lon, description) VALUES (?, ?, ?, ?)"
+        self.__db_write_lock.acquire()
+        self.__db.executemany(sql, found)
+        self.__db.executemany(sql_cell, [(self.__geo_cell_size,) + cell for cell in new_cells])
+        self.__db.commit()
+        self.__db_write_lock.release()
+        self.__logger.debug('Added %d locations, %d from the network', len(found), len(new_cells))
+        found.clear()
+        new_cells.clear()
+
+    def __read_db(self):
+        # WAL lets this read the last commit while the indexer is part way through writing the next one
+        db = getattr(self.__read_local, 'db', None)
+        if db is None:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self.__db_file)))
+            db = sqlite3.connect(uri, uri=True, check_same_thread=False)  # only closed from another thread
+            db.row_factory = sqlite3.Row
+            for pragma in self.DB_PRAGMAS:
+                db.execute(pragma)
+            self.__read_local.db = db
+            with self.__read_dbs_lock:
+                self.__read_dbs.append(db)
+        return db
+
+    def __close_read_dbs(self):
+        with self.__read_dbs_lock:
+            for db in self.__read_dbs:
+                db.close()
+            self.__read_dbs.clear()
+
+    def __commit(self):
+        self.__db_write_lock.acquire()
+        self.__db.commit()
+        self.__db_write_lock.release()
+
+    def __write_file_stats(self):
+        if not self.__cached_file_stats:
+            return
+        stats = self.__cached_file_stats[:]
+        del self.__cached_file_stats[:len(stats)]
+        sql = "UPDATE file SET displayed_count = displayed_count + 1, last_displayed = ? WHERE file_id = ?"
+        self.__db_write_lock.acquire()
+        self.__db.executemany(sql, stats)
+        self.__db.commit()
+        self.__db_write_lock.release()
 
     def __create_open_db(self, db_file):
         sql_folder_table = """
@@ -246,6 +744,16 @@ class ImageCache:
                 UNIQUE (latitude, longitude)
             )"""
 
+        # descriptions from the geocoder for cells of a grid, shared by all the lat, lon in each cell
+        sql_geo_cache_table = """
+            CREATE TABLE IF NOT EXISTS geo_cache (
+                cell_size INTEGER NOT NULL,
+                cell_lat INTEGER NOT NULL,
+                cell_lon INTEGER NOT NULL,
+                description TEXT,
+                PRIMARY KEY (cell_size, cell_lat, cell_lon)
+            )"""
+
         sql_db_info_table = """
             CREATE TABLE IF NOT EXISTS db_info (
                 schema_version INTEGER NOT NULL
@@ -292,8 +800,17 @@ class ImageCache:
 
         db = sqlite3.connect(db_file, check_same_thread=False)
         db.row_factory = sqlite3.Row  # make results accessible by field name
-        for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_meta_index,
-                     sql_all_data_view, sql_db_info_table, sql_clean_file_trigger, sql_clean_meta_trigger):
+        # readers don't block the writer (or vice versa) in WAL mode and with synchronous NORMAL
+        # a commit no longer has to wait for the SD card, only checkpoints do
+        journal_mode = db.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            self.__logger.warning("Can't use WAL journal for %s, using %s", db_file, journal_mode)
+        db.execute('PRAGMA synchronous = NORMAL')
+        for pragma in self.DB_PRAGMAS:
+            db.execute(pragma)
+        for item in (sql_folder_table, sql_file_table, sql_meta_table, sql_location_table, sql_geo_cache_table,
+                     sql_meta_index, sql_all_data_view, sql_db_info_table, sql_clean_file_trigger,
+                     sql_clean_meta_trigger):
             db.execute(item)
 
         return db
@@ -342,82 +859,295 @@ class ImageCache:
                 self.__db.execute("ALTER TABLE file ADD COLUMN displayed_count INTEGER default 0 NOT NULL")
                 self.__db.execute("ALTER TABLE file ADD COLUMN last_displayed REAL DEFAULT 0 NOT NULL")
 
+            if schema_version <= 3:
+                # Migrate to db schema v4
+                # Add scan generations so anything not seen by the last scan can be found with one query
+                self.__db.execute("ALTER TABLE folder ADD COLUMN scan_gen INTEGER DEFAULT 0 NOT NULL")
+                self.__db.execute("ALTER TABLE file ADD COLUMN scan_gen INTEGER DEFAULT 0 NOT NULL")
+                self.__db.execute("CREATE INDEX IF NOT EXISTS folder_scan_gen ON folder (scan_gen)")
+                self.__db.execute("CREATE INDEX IF NOT EXISTS file_scan_gen ON file (scan_gen)")
+
+            if schema_version <= 4:
+                # Migrate to db schema v5
+                # Add the dominant colours and average luminance found when indexing. Files indexed
+                # before this have NULL in both and their mat colour is worked out when shown, as before.
+                self.__db.execute("ALTER TABLE meta ADD COLUMN palette TEXT")
+                self.__db.execute("ALTER TABLE meta ADD COLUMN luminance REAL")
+
+            if schema_version <= 5:
+                # Migrate to db schema v6
+                # Log of files added, changed or removed for readers to apply to their playlists, see
+                # get_file_events(). Triggers write it so every way the tables change is covered.
+                self.__db.execute("""
+                    CREATE TABLE IF NOT EXISTS file_event (
+                        seq INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+                        kind TEXT NOT NULL,
+                        file_id INTEGER NOT NULL
+                    )""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS File_Added_Trigger
+                    AFTER INSERT ON file
+                    FOR EACH ROW
+                    BEGIN
+                        INSERT INTO file_event(kind, file_id) VALUES('added', NEW.file_id);
+                    END""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS File_Changed_Trigger
+                    AFTER UPDATE OF folder_id, basename, extension, last_modified ON file
+                    FOR EACH ROW
+                    BEGIN
+                        INSERT INTO file_event(kind, file_id) VALUES('changed', NEW.file_id);
+                    END""")
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS File_Removed_Trigger
+                    AFTER DELETE ON file
+                    FOR EACH ROW
+                    BEGIN
+                        INSERT INTO file_event(kind, file_id) VALUES('removed', OLD.file_id);
+                    END""")
+                # files of a folder flagged missing drop out of all_data, and come back with it
+                self.__db.execute("""
+                    CREATE TRIGGER IF NOT EXISTS Folder_Missing_Trigger
+                    AFTER UPDATE OF missing ON folder
+                    FOR EACH ROW WHEN OLD.missing != NEW.missing
+                    BEGIN
+                        INSERT INTO file_event(kind, file_id)
+                            SELECT CASE NEW.missing WHEN 0 THEN 'changed' ELSE 'removed' END, file_id
+                            FROM file WHERE folder_id = NEW.folder_id;
+                    END""")
+                # Inner join meta, which every file gets in the same transaction, so that file_id IN (...) on
+                # all_data, as in query_playlist, is a constraint on file's primary key rather than a scan
+                self.__db.execute("DROP VIEW all_data")
+                self.__db.execute("""
+                    CREATE VIEW IF NOT EXISTS all_data
+                    AS
+                    SELECT
+                        folder.name || "/" || file.basename || "." || file.extension AS fname,
+                        file.last_modified,
+                        meta.*,
+                        meta.height > meta.width as is_portrait,
+                        location.description as location
+                    FROM file
+                        INNER JOIN folder
+                            ON folder.folder_id = file.folder_id
+                        INNER JOIN meta
+                            ON file.file_id = meta.file_id
+                        LEFT JOIN location
+                            ON location.latitude = meta.latitude AND location.longitude = meta.longitude
+                    WHERE folder.missing = 0
+                    """)
+
             # Finally, update the db's schema version stamp to the app's requested version
             self.__db.execute('DELETE FROM db_info')
             self.__db.execute('INSERT INTO db_info VALUES(?)', (required_db_schema_version,))
             self.__db.commit()
 
-    # --- Returns a set of folders matching any of
+    # --- Walks the tree below root (default picture_dir) once with os.scandir and returns
+    #     (folders, files) where folders are (name, mod_tm) for any folder
     #     - Found on disk, but not currently in the 'folder' table
     #     - Found on disk, but newer than the associated record in the 'folder' table
     #     - Found on disk, but flagged as 'missing' in the 'folder' table
-    # --- Note that all folders returned currently exist on disk
-    def __get_modified_folders(self):
+    #     and files are the image files in those folders that are new or newer than in the 'file' table
+    # --- The folder table is read once per pass and the file table once per modified folder, the
+    #     modification times come from the DirEntry stat results
+    # --- A full scan (root None) starts a new scan generation. Every folder seen, and every known file
+    #     in the folders that get listed, is stamped with it so the purge can find the rest by generation.
+    #     When files are to be purged all folders are listed, not just the modified ones.
+    def __scan_modified(self, root=None):
+        if root is None:
+            root = self.__picture_dir
+            self.__scan_gen += 1
+            list_all = self.__purge_files
+        else:
+            list_all = False
         out_of_date_folders = []
-        sql_select = "SELECT * FROM folder WHERE name = ?"
-        for dir in [d[0] for d in os.walk(self.__picture_dir, followlinks=self.__follow_links)]:
-            if os.path.basename(dir):
-                if os.path.basename(dir)[0] == '.':
-                    continue  # ignore hidden folders
-            mod_tm = int(os.stat(dir).st_mtime)
-            found = self.__db.execute(sql_select, (dir,)).fetchone()
-            if not found or found['last_modified'] < mod_tm or found['missing'] == 1:
-                out_of_date_folders.append((dir, mod_tm))
-        return out_of_date_folders
-
-    def __get_modified_files(self, modified_folders):
         out_of_date_files = []
-        # sql_select = "SELECT fname, last_modified FROM all_data WHERE fname = ? and last_modified >= ?"
-        sql_select = """
-        SELECT file.basename, file.last_modified
+        seen_folders = []
+        seen_files = []
+        sql_folders = "SELECT name, last_modified, missing FROM folder"
+        known_folders = {row['name']: (row['last_modified'], row['missing']) for row in self.__db.execute(sql_folders)}
+        sql_files = """
+        SELECT file.file_id, file.basename, file.extension, file.last_modified
             FROM file
                 INNER JOIN folder
                     ON folder.folder_id = file.folder_id
-            WHERE file.basename = ? AND file.extension = ? AND folder.name = ? AND file.last_modified >= ?
+            WHERE folder.name = ?
         """
-        for dir, _date in modified_folders:
-            for file in os.listdir(dir):
-                base, extension = os.path.splitext(file)
-                if (extension.lower() in ImageCache.EXTENSIONS
-                        # have to filter out all the Apple junk
-                        and '.AppleDouble' not in dir and not file.startswith('.')):
-                    full_file = os.path.join(dir, file)
-                    mod_tm = os.path.getmtime(full_file)
-                    found = self.__db.execute(sql_select, (base, extension.lstrip("."), dir, mod_tm)).fetchone()
-                    if not found:
-                        out_of_date_files.append(full_file)
-        return out_of_date_files
+        try:
+            dirs = [(root, int(os.stat(root).st_mtime))]
+        except OSError:
+            return out_of_date_folders, out_of_date_files
+        while dirs:
+            dir, mod_tm = dirs.pop()
+            found = known_folders.get(dir)
+            if found:
+                seen_folders.append((self.__scan_gen, dir))
+            modified = not found or found[0] < mod_tm or found[1] == 1
+            if modified:
+                out_of_date_folders.append((dir, mod_tm))
+            list_files = (modified or list_all) and '.AppleDouble' not in dir  # have to filter out all the Apple junk
+            if list_files:
+                known_files = {(row['basename'], row['extension']): (row['file_id'], row['last_modified'])
+                               for row in self.__db.execute(sql_files, (dir,))}
+            try:
+                with os.scandir(dir) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.name.startswith('.'):
+                                continue  # ignore hidden folders and files
+                            if entry.is_dir(follow_symlinks=self.__follow_links):
+                                dirs.append((entry.path, int(entry.stat().st_mtime)))
+                            elif list_files:
+                                base, extension = os.path.splitext(entry.name)
+                                if extension.lower() in ImageCache.EXTENSIONS:
+                                    known = known_files.get((base, extension.lstrip(".")))
+                                    if known is not None:
+                                        seen_files.append((self.__scan_gen, known[0]))
+                                    if known is None or known[1] < entry.stat().st_mtime:
+                                        out_of_date_files.append(entry.path)
+                        except OSError:
+                            continue  # removed while scanning, a broken link etc.
+            except OSError as e:
+                self.__logger.warning("Can't scan folder %s -> %s", dir, e)
+
+        self.__db_write_lock.acquire()
+        self.__db.executemany("UPDATE folder SET scan_gen = ? WHERE name = ?", seen_folders)
+        self.__db.executemany("UPDATE file SET scan_gen = ? WHERE file_id = ?", seen_files)
+        self.__db_write_lock.release()
+        if list_all:
+            self.__list_all_gen = self.__scan_gen
+        return out_of_date_folders, out_of_date_files
+
+    def __insert_files(self):
+        # Read the meta data of the outstanding files, in parallel if there is a pool, and
+        # write the results from this thread committing once per batch.
+        batch_size = 16 * self.__index_workers
+        # __take_budget refuses when any of these change, so that is also the way out
+        while self.__modified_files and self.__keep_looping and not self.__pause_looping and not self.__suspended:
+            batch = self.__modified_files[:batch_size]
+            # worker processes take a while to start, only worth it for a backlog of at least a full batch
+            backlog = self.__index_pool is not None or len(self.__modified_files) >= batch_size
+            pool = self.__get_index_pool() if backlog else None
+            if pool is not None:
+                results = []
+                for file in batch:
+                    if not self.__take_budget(file):
+                        break
+                    results.append(pool.submit(get_exif_info, file))
+                batch = batch[:len(results)]
+            for i, file in enumerate(batch):
+                self.__logger.debug('Inserting: %s', file)
+                try:
+                    if pool is not None:
+                        meta = results[i].result()
+                    elif self.__take_budget(file):
+                        meta = self.__get_exif_info(file)
+                    else:
+                        batch = batch[:i]  # paused, suspended or stopped, carry on from here later
+                        break
+                    self.__write_file(file, meta)
+                except BrokenExecutor as e:
+                    self.__logger.error("Meta data worker processes failed, reading files one at a time: %s", e)
+                    self.__shutdown_index_pool()
+                    self.__index_workers = 1
+                    batch = batch[:i]  # the rest will be done again without the pool
+                    break
+                except Exception as e:  # file removed, unreadable etc.
+                    self.__logger.warning("Can't read meta data from %s -> %s", file, e)
+            del self.__modified_files[:len(batch)]
+            self.__commit()
+            self.__geo_wake.set()  # there might be new locations to look up
+
+    def __take_budget(self, file):
+        # Token buckets, holding up to a second's worth, for index_files_per_sec and index_mb_per_sec.
+        # Waits until there is enough for file, returns False if paused, suspended or stopped meanwhile,
+        # in which case the file isn't read and what was taken for it is put back.
+        size = 0
+        tm = time.time()
+        elapsed = tm - self.__budget_tm
+        self.__budget_tm = tm
+        wait_tm = 0.0
+        if self.__index_files_per_sec > 0:
+            self.__file_tokens = min(self.__index_files_per_sec,
+                                     self.__file_tokens + elapsed * self.__index_files_per_sec) - 1
+            wait_tm = max(wait_tm, -self.__file_tokens / self.__index_files_per_sec)
+        if self.__index_bytes_per_sec > 0:
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                size = 0  # gone, will fail quickly when read
+            self.__byte_tokens = min(self.__index_bytes_per_sec,
+                                     self.__byte_tokens + elapsed * self.__index_bytes_per_sec) - size
+            wait_tm = max(wait_tm, -self.__byte_tokens / self.__index_bytes_per_sec)
+        if wait_tm > 0.0:
+            self.__wake.clear()
+            self.__wake.wait(timeout=wait_tm)  # set by stop(), suspend() or the end of a pause
+        if self.__keep_looping and not self.__pause_looping and not self.__suspended:
+            return True
+        if self.__index_files_per_sec > 0:
+            self.__file_tokens += 1
+        self.__byte_tokens += size
+        return False
+
+    def __get_index_pool(self):
+        if self.__index_workers > 1 and self.__index_pool is None:
+            # spawn rather than fork, this process has threads and a GL context that children mustn't inherit
+            self.__index_pool = ProcessPoolExecutor(max_workers=self.__index_workers,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+        return self.__index_pool
+
+    def __shutdown_index_pool(self):
+        if self.__index_pool is not None:
+            self.__index_pool.shutdown(wait=False)
+            self.__index_pool = None
 
     def __insert_file(self, file, file_id=None):
-        file_insert = "INSERT OR REPLACE INTO file(folder_id, basename, extension, last_modified) VALUES((SELECT folder_id from folder where name = ?), ?, ?, ?)"  # noqa: E501
-        file_update = "UPDATE file SET folder_id = (SELECT folder_id from folder where name = ?), basename = ?, extension = ?, last_modified = ? WHERE file_id = ?"  # noqa: E501
+        self.__write_file(file, self.__get_exif_info(file), file_id)
+
+    def __write_file(self, file, meta, file_id=None):
+        file_insert = "INSERT INTO file(folder_id, basename, extension, last_modified, scan_gen) VALUES(?, ?, ?, ?, ?)"
+        file_update = "UPDATE file SET folder_id = ?, basename = ?, extension = ?, last_modified = ?, scan_gen = ? WHERE file_id = ?"  # noqa: E501
+        # Both selects are satisfied by the UNIQUE indexes on folder(name) and file(folder_id, basename, extension)
+        file_select = "SELECT file_id FROM file WHERE folder_id = ? AND basename = ? AND extension = ?"
+        folder_select = "SELECT folder_id FROM folder WHERE name = ?"
         # Insert the new folder if it's not already in the table. Update the missing field separately.
-        folder_insert = "INSERT OR IGNORE INTO folder(name) VALUES(?)"
+        folder_insert = "INSERT OR IGNORE INTO folder(name, scan_gen) VALUES(?, ?)"
         folder_update = "UPDATE folder SET missing = 0 where name = ?"
+        file_delete = "DELETE FROM file WHERE file_id = ? AND NOT EXISTS (SELECT 1 FROM meta WHERE file_id = ?)"
 
         mod_tm = os.path.getmtime(file)
         dir, file_only = os.path.split(file)
         base, extension = os.path.splitext(file_only)
+        extension = extension.lstrip(".")
 
-        # Get the file's meta info and build the INSERT statement dynamically
-        meta = self.__get_exif_info(file)
+        # Build the meta INSERT statement dynamically
         meta_insert = self.__get_meta_sql_from_dict(meta)
         vals = list(meta.values())
-        vals.insert(0, file)
 
         # Insert this file's info into the folder, file, and meta tables
         self.__db_write_lock.acquire()
-        self.__db.execute(folder_insert, (dir,))
-        self.__db.execute(folder_update, (dir,))
-        if file_id is None:
-            self.__db.execute(file_insert, (dir, base, extension.lstrip("."), mod_tm))
-        else:
-            self.__db.execute(file_update, (dir, base, extension.lstrip("."), mod_tm, file_id))
         try:
-            self.__db.execute(meta_insert, vals)
-        except:
-            self.__logger.error(f"###FAILED meta_insert = {meta_insert}, vals = {vals}")
-        self.__db_write_lock.release()
+            self.__db.execute(folder_insert, (dir, self.__scan_gen))
+            self.__db.execute(folder_update, (dir,))
+            folder_id = self.__db.execute(folder_select, (dir,)).fetchone()[0]
+            if file_id is None:  # keep the existing file_id if this file is already known
+                found = self.__db.execute(file_select, (folder_id, base, extension)).fetchone()
+                if found:
+                    file_id = found[0]
+            if file_id is None:
+                file_id = self.__db.execute(file_insert,
+                                            (folder_id, base, extension, mod_tm, self.__scan_gen)).lastrowid
+            else:
+                self.__db.execute(file_update, (folder_id, base, extension, mod_tm, self.__scan_gen, file_id))
+            vals.insert(0, file_id)
+            try:
+                self.__db.execute(meta_insert, vals)
+            except sqlite3.Error as e:
+                # all_data only has files with a meta row, without one it's taken out to be tried again next scan
+                self.__logger.error("Can't write meta data for %s -> %s", file, e)
+                self.__db.execute(file_delete, (file_id, file_id))
+        finally:
+            self.__db_write_lock.release()
 
     def __update_folder_info(self, folder_collection):
         update_data = []
@@ -431,90 +1161,30 @@ class ImageCache:
     def __get_meta_sql_from_dict(self, dict):
         columns = ', '.join(dict.keys())
         ques = ', '.join('?' * len(dict.keys()))
-        return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES((SELECT file_id from all_data where fname = ?), {1})'.format(columns, ques)  # noqa: E501
+        return 'INSERT OR REPLACE INTO meta(file_id, {0}) VALUES(?, {1})'.format(columns, ques)
 
     def __purge_missing_files_and_folders(self):
-        # Find folders in the db that are no longer on disk
-        folder_id_list = []
-        for row in self.__db.execute('SELECT folder_id, name from folder'):
-            if not os.path.exists(row['name']):
-                folder_id_list.append([row['folder_id']])
-
-        # Flag or delete any non-existent folders from the db. Note, deleting will automatically
-        # remove orphaned records from the 'file' and 'meta' tables
-        if len(folder_id_list):
-            self.__db_write_lock.acquire()
-            if self.__purge_files:
-                self.__db.executemany('DELETE FROM folder WHERE folder_id = ?', folder_id_list)
-            else:
-                self.__db.executemany('UPDATE folder SET missing = 1 WHERE folder_id = ?', folder_id_list)
-            self.__db_write_lock.release()
-
-        # Find files in the db that are no longer on disk
-        if self.__purge_files:
-            file_id_list = []
-            for row in self.__db.execute('SELECT file_id, fname from all_data'):
-                if not os.path.exists(row['fname']):
-                    file_id_list.append([row['file_id']])
-
-            # Delete any non-existent files from the db. Note, this will automatically
-            # remove matching records from the 'meta' table as well.
-            if len(file_id_list):
-                self.__db_write_lock.acquire()
-                self.__db.executemany('DELETE FROM file WHERE file_id = ?', file_id_list)
-                self.__db_write_lock.release()
+        # Anything with a generation older than the last full scan wasn't found on disk. Flag or delete
+        # the folders, deleting will automatically remove orphaned records from the 'file' and 'meta' tables.
+        # Files are only deleted if the last scan listed every folder, otherwise the next scan will.
+        self.__db_write_lock.acquire()
+        if self.__purge_files and self.__list_all_gen == self.__scan_gen:
+            self.__db.execute('DELETE FROM folder WHERE scan_gen < ?', (self.__scan_gen,))
+            self.__db.execute('DELETE FROM file WHERE scan_gen < ?', (self.__scan_gen,))
             self.__purge_files = False
+        else:
+            self.__db.execute('UPDATE folder SET missing = 1 WHERE scan_gen < ? AND missing = 0', (self.__scan_gen,))
+        self.__db_write_lock.release()
 
-    def __get_exif_info(self, file_path_name):
-        exifs = get_image_meta.GetImageMeta(file_path_name)
-        # Dict to store interesting EXIF data
-        # Note, the 'key' must match a field in the 'meta' table
-        e = {}
-
-        e['orientation'] = exifs.get_orientation()
-
-        width, height = exifs.get_size()
-        ext = os.path.splitext(file_path_name)[1].lower()
-        if ext not in ('.heif', '.heic') and e['orientation'] in (5, 6, 7, 8):
-            width, height = height, width  # swap values
-        e['width'] = width
-        e['height'] = height
-
-        e['f_number'] = exifs.get_exif('EXIF FNumber')
-        e['make'] = exifs.get_exif('Image Make')
-        e['model'] = exifs.get_exif('Image Model')
-        e['exposure_time'] = exifs.get_exif('EXIF ExposureTime')
-        e['iso'] = exifs.get_exif('EXIF ISOSpeedRatings')
-        e['focal_length'] = exifs.get_exif('EXIF FocalLength')
-        e['rating'] = exifs.get_exif('Image Rating')
-        e['lens'] = exifs.get_exif('EXIF LensModel')
-        e['exif_datetime'] = None
-        val = exifs.get_exif('EXIF DateTimeOriginal')
-        if val is not None:
-            # Remove any subsecond portion of the DateTimeOriginal value. According to the spec, it's
-            # not valid here anyway (should be in SubSecTimeOriginal), but it does exist sometimes.
-            val = val.split('.', 1)[0]
-            try:
-                e['exif_datetime'] = time.mktime(time.strptime(val, '%Y:%m:%d %H:%M:%S'))
-            except Exception:
-                pass
-
-        # If we still don't have a date/time, just use the file's modificaiton time
-        if e['exif_datetime'] is None:
-            e['exif_datetime'] = os.path.getmtime(file_path_name)
-
-        gps = exifs.get_location()
-        lat = gps['latitude']
-        lon = gps['longitude']
-        e['latitude'] = round(lat, 4) if lat is not None else lat  # TODO sqlite requires (None,) to insert NULL
-        e['longitude'] = round(lon, 4) if lon is not None else lon
-
-        # IPTC
-        e['tags'] = exifs.get_exif('IPTC Keywords')
-        e['title'] = exifs.get_exif('IPTC Object Name')
-        e['caption'] = exifs.get_exif('IPTC Caption/Abstract')
+    def __flag_missing_folders(self, dirs):
+        # Flag folders (and their sub folders) reported as removed by the watcher
+        sql = "UPDATE folder SET missing = 1 WHERE name = ? OR substr(name, 1, ?) = ?"
+        self.__db_write_lock.acquire()
+        self.__db.executemany(sql, [(dir, len(dir) + 1, dir + '/') for dir in dirs if not os.path.isdir(dir)])
+        self.__db_write_lock.release()
 
-        return e
+    def __get_exif_info(self, file_path_name):
+        return get_exif_info(file_path_name)
 
 
 # If being executed (instead of imported), kick it off...
@@ -91,10 +91,12 @@ class InterfacePeripherals:
             if self.menu_is_on:
                 if self.__menu_autohide_tm and self.__timestamp - self.__last_menu_show_at > self.__menu_autohide_tm:
                     self.menu_is_on = False
-                else:
+                elif self.__viewer.frame_is_drawn:
                     self.__menu_bg.draw()
 
-            self.__gui.draw(*self.__pointer_position)
+            if self.__viewer.frame_is_drawn:  # otherwise the screen is left as it is
+                self.__gui.draw(*self.__pointer_position)
+            self.__viewer.overlay_state = (self.menu_is_on, self.__pointer_position)
 
     def stop(self) -> None:
         """Gracefully stops any active peripheral device."""
@@ -1,12 +1,17 @@
-from PIL import Image, ImageOps, ImageDraw
+from PIL import Image, ImageOps, ImageDraw, ImageStat
 from ninepatch import Ninepatch
 import numpy as np
 import random
 import logging
+from collections import OrderedDict
 
 
 class MatImage:
 
+    MAT_CACHE_SIZE = 4  # display sized textured mats kept, one per colour
+    NINEPATCH_CACHE_SIZE = 16  # bevel, shadow and highlight renders kept, one per size
+    MAT_COLOR_STEP = 4  # mat colours are rounded to this so near enough colours share a cached mat
+
     # region Constructor
 
     def __init__(self, display_size, mat_type=None, outer_mat_color=None,
@@ -22,6 +27,8 @@ class MatImage:
                             'double_flat']
 
         self.__logger = logging.getLogger("mat_image.MatImage")
+        self.__mat_cache = OrderedDict()  # (color, display_size) -> colourised display sized texture
+        self.__ninepatch_cache = OrderedDict()  # (name, width, height) -> rendered nine-patch
 
         self.auto_inner_mat_color = auto_inner_mat_color
         self.display_size = display_size
@@ -35,10 +42,8 @@ class MatImage:
 
         # --- Matting resources ---
         self.__mat_texture = Image.open('{0}/mat_texture.jpg'.format(resource_folder)).convert("L")
-        self.__9patch_bevel = Ninepatch('{0}/9_patch_bevel.png'.format(resource_folder))
-        self.__9patch_drop_shadow = Ninepatch('{0}/9_patch_drop_shadow.png'.format(resource_folder))
-        self.__9patch_inner_shadow = Ninepatch('{0}/9_patch_inner_shadow.png'.format(resource_folder))
-        self.__9patch_highlight = Ninepatch('{0}/9_patch_highlight.png'.format(resource_folder))
+        self.__9patches = {name: Ninepatch('{0}/9_patch_{1}.png'.format(resource_folder, name))
+                           for name in ('bevel', 'drop_shadow', 'inner_shadow', 'highlight')}
 
     # endregion Constructor
 
@@ -52,6 +57,7 @@ class MatImage:
     def display_size(self, val):
         self.__display_size = val
         self.__display_width, self.__display_height = val
+        self.__display_texture = None  # mat_texture resized to the display, made when first needed
 
     @property
     def display_width(self):
@@ -125,16 +131,19 @@ class MatImage:
 
     # region Public Methods
 
-    def mat_image(self, images):
+    def mat_image(self, images, palette=None):
+        # palette is the dominant colours of images[0] found when it was indexed, see get_palette().
+        # If given it saves working them out here when the outer mat color isn't specified.
 
         # Randomly pick a mat type from those specified by the User
         mat_type = random.choice(self.mat_type)
 
         # If a mat color wasn't specified, get one
         if not self.outer_mat_color:
-            self.__outer_mat_color_save = self.__get_outer_mat_color(images[0])
+            color = palette[0] if palette else self.__get_outer_mat_color(images[0])
+            self.__outer_mat_color_save = self.__quantize_color(color)
         else:
-            self.__outer_mat_color_save = tuple(self.outer_mat_color)
+            self.__outer_mat_color_save = tuple(self.outer_mat_color)  # as configured, only picked ones are quantized
 
         if mat_type == 'float':
             image = self.__style_float(images)
@@ -206,7 +215,7 @@ class MatImage:
             self.__add_image_outline(image, color2)
             image = ImageOps.expand(image, border_width)
             self.__add_image_outline(image, color, outline_width=border_width)
-            highlight = self.__9patch_highlight.render(image.width, image.height,  Image.Resampling.LANCZOS)
+            highlight = self.__render_9patch('highlight', image.width, image.height)
             image.paste(highlight, (0, 0), highlight)
             image = self.__add_drop_shadow(image)
             final_images.append(image)
@@ -310,39 +319,62 @@ class MatImage:
     def __get_darker_shade(self, rgb_color, fractional_percent=0.5):
         return tuple(map(lambda c: int(c * fractional_percent), rgb_color))
 
-    def __get_colorized_mat(self, color, use_texture):
-        if use_texture:
-            mat_img = self.__mat_texture.copy()
-            mat_img = mat_img.resize(self.display_size, resample=Image.BICUBIC)
-            mat_img = ImageOps.colorize(mat_img, black="black", white=color)
-        else:
-            mat_img = Image.new('RGB', self.display_size, color)
+    def __quantize_color(self, color):
+        step = self.MAT_COLOR_STEP
+        return tuple(min(255, int(c) // step * step + step // 2) for c in color[:3])
 
-        return mat_img
+    def __get_colorized_mat(self, color, use_texture, size=None):
+        # A new image of size, default the display size, that can be pasted on
+        if size is None:
+            size = self.display_size
+        if not use_texture:
+            return Image.new('RGB', size, color)
+        key = (color, self.display_size)
+        mat_img = self.__mat_cache.get(key)
+        if mat_img is None:
+            if self.__display_texture is None:
+                self.__display_texture = self.__mat_texture.resize(self.display_size, resample=Image.BICUBIC)
+            mat_img = ImageOps.colorize(self.__display_texture, black="black", white=color)
+            self.__mat_cache[key] = mat_img
+            if len(self.__mat_cache) > self.MAT_CACHE_SIZE:
+                self.__mat_cache.popitem(last=False)
+        else:
+            self.__mat_cache.move_to_end(key)
+        return mat_img.crop((0, 0) + tuple(size))
+
+    def __render_9patch(self, name, width, height):
+        # The renders are only ever pasted from, never on to, so can be shared
+        key = (name, width, height)
+        rendered = self.__ninepatch_cache.get(key)
+        if rendered is None:
+            rendered = self.__9patches[name].render(width, height, Image.Resampling.LANCZOS)
+            self.__ninepatch_cache[key] = rendered
+            if len(self.__ninepatch_cache) > self.NINEPATCH_CACHE_SIZE:
+                self.__ninepatch_cache.popitem(last=False)
+        else:
+            self.__ninepatch_cache.move_to_end(key)
+        return rendered
 
     def __get_inner_mat(self, size):
         w, h = size
 
         # If the color wasn't specified, get one
         if not self.inner_mat_color:
-            color = self.__get_darker_shade(self.__outer_mat_color_save, 0.50)
+            color = self.__quantize_color(self.__get_darker_shade(self.__outer_mat_color_save, 0.50))
         else:
             color = tuple(self.inner_mat_color)
 
-        mat = self.__get_colorized_mat(color, self.inner_mat_use_texture)
-        mat = mat.crop((0, 0, w, h))
-
-        return mat
+        return self.__get_colorized_mat(color, self.inner_mat_use_texture, (w, h))
 
     def __add_outer_bevel(self, image, expand=True):
         if expand:
             image = ImageOps.expand(image, 5)
-        outer_bevel_image = self.__9patch_bevel.render(image.width, image.height, Image.Resampling.LANCZOS)
+        outer_bevel_image = self.__render_9patch('bevel', image.width, image.height)
         image.paste(outer_bevel_image, (0, 0), outer_bevel_image)
         return image
 
     def __add_inner_shadow(self, image):
-        inner_shadow_image = self.__9patch_inner_shadow.render(image.width, image.height,  Image.Resampling.LANCZOS)
+        inner_shadow_image = self.__render_9patch('inner_shadow', image.width, image.height)
         image.paste(inner_shadow_image, (0, 0), inner_shadow_image)
         return image
 
@@ -362,7 +394,7 @@ class MatImage:
     def __add_drop_shadow(self, image):
         shadow_offset = 15
         mod_image = Image.new('RGBA', (image.width + shadow_offset, image.height + shadow_offset), (0, 0, 0, 0))
-        shadow_image = self.__9patch_drop_shadow.render(mod_image.width, mod_image.height,  Image.Resampling.LANCZOS)
+        shadow_image = self.__render_9patch('drop_shadow', mod_image.width, mod_image.height)
         mod_image.paste(shadow_image, (0, 0), shadow_image)
         mod_image.paste(image, (0, 0))
         return mod_image
@@ -386,51 +418,98 @@ class MatImage:
         return mat_image
 
 
+def get_palette(image, k=3):
+    """Return (colors, luminance) for image, up to k dominant (r, g, b) colors in the order
+    MatImage picks them, most saturated first, and the average luminance from 0.0 to 1.0.
+    A small image will do, KmeansNp only looks at a 100x100 thumbnail anyway.
+    """
+    colors = KmeansNp(k=k, max_iterations=10, size=100, seed=0).run(image)
+    luminance = ImageStat.Stat(image.convert('L')).mean[0] / 255.0
+    return [tuple(int(c) for c in color) for color in colors], luminance
+
+
+def palette_to_text(colors):
+    """'#rrggbb,#rrggbb,...' as stored in the meta table"""
+    return ','.join('#{:02x}{:02x}{:02x}'.format(*color) for color in colors)
+
+
+def palette_from_text(text):
+    """The list of (r, g, b) colors from palette_to_text() or None if there isn't one"""
+    if not text:
+        return None
+    try:
+        return [tuple(int(color[i:i + 2], 16) for i in (1, 3, 5)) for color in text.split(',')]
+    except ValueError:
+        return None
+
+
 class KmeansNp:
-    def __init__(self, k=3, max_iterations=5, min_distance=5.0, size=200):
+    """Dominant colors of an image by k-means, returned most saturated first.
+
+    Rather than every pixel of the thumbnail the colors are first binned, BITS bits
+    per channel, and the mean color of each bin weighted by its pixel count is what
+    gets clustered. There are seldom more than a few hundred bins so each iteration
+    is a small float32 array of squared distances. Give a seed for the same result
+    every time, otherwise the starting centroids are random.
+    """
+
+    BITS = 5  # per channel, 32768 bins
+
+    def __init__(self, k=3, max_iterations=5, min_distance=5.0, size=200, seed=None):
         self.k = k
         self.max_iterations = max_iterations
         self.min_distance = min_distance
         self.size = (size, size)
+        self.seed = seed
 
     def run(self, image, start_clusters=None):
-        image = image.copy()
-        image.thumbnail(self.size)
-        im = np.array(image, dtype=float)[:, :, :3]
-        d = im.shape[-1]  # 3 or 5 if u,v added
-        im = im.reshape(-1, d)  # NB need to use floats to avoid coercing to uint8 scrambling subtractions
-        n = len(im)
+        colors, weights = self.__histogram(self.__thumbnail(image))
         if start_clusters is None:
-            centroids = im[np.random.choice(np.arange(n), self.k)]
+            rng = np.random.default_rng(self.seed)  # bins picked in proportion to their pixels, as pixels would be
+            p = weights / weights.sum(dtype=np.float64)
+            start = rng.choice(len(colors), min(self.k, len(colors)), replace=False, p=p)
+            centroids = colors[start]
         else:
-            centroids = np.array(start_clusters, dtype=float)
-        old_centroids = centroids.copy()
+            centroids = np.array(start_clusters, dtype=np.float32)
         for i in range(self.max_iterations):
-            im.shape = (1, n, d)  # add dimension to allow broadcasting
-            centroids.shape = (self.k, 1, d)  # ditto
-            dists = (((im - centroids) ** 2).sum(axis=2)) ** 0.5  # euclidean distance - manhattan might be fine and faster # noqa: E501
-            ix = np.argmin(dists, axis=0)  # indices of nearest centroid for each pixel
-            im.shape = (n, d)  # reduce dimensions for mean
-            centroids.shape = (self.k, d)  # ditto
-            to_keep = []  # discard any centroids with no pixels nearest to them
-            for j in range(self.k):  # write back average location of all nearest pixels
-                j_pixels = im[ix == j]  # view into im where ix points to centroid j
-                if len(j_pixels) > 0:  # error if try to get mean zero length array TODO remove groups with few pixels?
-                    centroids[j] = j_pixels.mean(axis=0)
-                    to_keep.append(j)
-            if len(to_keep) < len(centroids):  # this will be relatively rare
-                for j in to_keep[::-1]:  # delete in reverse order of index
-                    centroids = np.delete(centroids, j, axis=0)
-                    old_centroids = np.delete(old_centroids, j, axis=0)
-            movement = ((((centroids - old_centroids) ** 2).sum(axis=1)) ** 0.5).max()
-            if movement < self.min_distance:
+            dists = ((colors[:, np.newaxis, :] - centroids[np.newaxis, :, :]) ** 2).sum(axis=2)  # squared euclidean
+            ix = np.argmin(dists, axis=1)  # nearest centroid for each bin
+            totals = np.bincount(ix, weights=weights, minlength=len(centroids))
+            keep = totals > 0  # discard any centroids with no pixels nearest to them
+            sums = np.stack([np.bincount(ix, weights=weights * colors[:, c], minlength=len(centroids))
+                             for c in range(3)], axis=1)
+            new_centroids = (sums[keep] / totals[keep, np.newaxis]).astype(np.float32)
+            movement = ((new_centroids - centroids[keep]) ** 2).sum(axis=1).max()
+            centroids = new_centroids
+            if movement < self.min_distance ** 2:
                 break
-            old_centroids = centroids.copy()
 
-        c_max, c_min = centroids[:, :3].max(axis=1), centroids[:, :3].min(axis=1)  # max, min for each centroid
-        c_sat = c_max - c_min  # value used previously includes element of lum TODO bias more to lighter using (1.5 * c_max - c_min) # noqa: E501
-        ix_order = np.argsort(c_sat)[::-1]  # indices to sorted values - reversed
-        return centroids[ix_order, :3].astype(np.uint8)
+        c_sat = centroids.max(axis=1) - centroids.min(axis=1)  # value used previously includes element of lum TODO bias more to lighter using (1.5 * c_max - c_min) # noqa: E501
+        ix_order = np.argsort(c_sat, kind='stable')[::-1]  # indices to sorted values - reversed
+        return centroids[ix_order].astype(np.uint8)
+
+    def __thumbnail(self, image):
+        # as Image.thumbnail() but without copying the full size image first
+        scale = min(self.size[0] / image.width, self.size[1] / image.height)
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.BICUBIC, reducing_gap=2.0)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        return image
+
+    def __histogram(self, image):
+        # (mean colors, pixel counts) of the non empty bins, both float32
+        im = np.asarray(image)[:, :, :3].reshape(-1, 3)
+        shift = 8 - self.BITS
+        q = (im >> shift).astype(np.intp)
+        ix = (q[:, 0] << (2 * self.BITS)) | (q[:, 1] << self.BITS) | q[:, 2]
+        n_bins = 1 << (3 * self.BITS)
+        counts = np.bincount(ix, minlength=n_bins)
+        used = np.flatnonzero(counts)
+        weights = counts[used].astype(np.float32)
+        colors = np.stack([np.bincount(ix, weights=im[:, c], minlength=n_bins)[used] for c in range(3)], axis=1)
+        return (colors / weights[:, np.newaxis]).astype(np.float32), weights
 
 
 if __name__ == "__main__":
@@ -3,7 +3,7 @@ import os
 import time
 import logging
 import locale
-from picframe import geo_reverse, image_cache
+from picframe import geo_reverse, image_cache, playlist
 
 DEFAULT_CONFIGFILE = "~/picframe_data/config/configuration.yaml"
 DEFAULT_CONFIG = {
@@ -13,6 +13,7 @@ DEFAULT_CONFIG = {
         'blur_edges': False,
         'edge_alpha': 0.5,
         'fps': 20.0,
+        'idle_fps': 1.0,
         'background': [0.2, 0.2, 0.3, 1.0],
         'blend_type': "blend",  # {"blend":0.0, "burn":1.0, "bump":2.0}
         'font_file': '~/picframe_data/data/fonts/NotoSans-Regular.ttf',
@@ -50,6 +51,12 @@ DEFAULT_CONFIG = {
         'menu_text_sz': 40,
         'menu_autohide_tm': 10.0,
         'geo_suppress_list': [],
+        'prefetch_depth': 2,
+        'decode_processes': 0,
+        'slide_cache_folder': '~/picframe_data/cache',
+        'slide_cache_mb': 500,
+        'slide_cache_ahead': 5,
+        'slide_memory_mb': 100,
     },
     'model': {
 
@@ -72,8 +79,18 @@ DEFAULT_CONFIG = {
                      ['region', 'state', 'province'],
                      ['country']],
         'geo_key': 'this_needs_to@be_changed',  # use your email address
+        'geo_rate': 1.0,
+        'geo_cell_size': 250,
+        'geo_backend': 'nominatim',  # or 'offline'
+        'geo_data_file': '~/picframe_data/data/cities1000.txt',
         'db_file': '~/picframe_data/data/pictureframe.db3',
         'portrait_pairs': False,
+        'index_workers': 1,
+        'watch_files': True,
+        'rescan_interval': 600.0,
+        'index_files_per_sec': 0.0,
+        'index_mb_per_sec': 0.0,
+        'index_process': False,
         'deleted_pictures': '~/DeletedPictures',
         'log_level': 'WARNING',
         'log_file': '',
@@ -115,7 +132,7 @@ class Pic:  # TODO could this be done more elegantly with namedtuple
                  f_number=0, exposure_time=None, iso=0, focal_length=None,
                  make=None, model=None, lens=None, rating=None, latitude=None,
                  longitude=None, width=0, height=0, is_portrait=0, location=None, title=None,
-                 caption=None, tags=None):
+                 caption=None, tags=None, palette=None, luminance=None):
         self.fname = fname
         self.last_modified = last_modified
         self.file_id = file_id
@@ -138,6 +155,8 @@ class Pic:  # TODO could this be done more elegantly with namedtuple
         self.tags = tags
         self.caption = caption
         self.title = title
+        self.palette = palette  # dominant colours as '#rrggbb,...', see mat_image.palette_to_text()
+        self.luminance = luminance  # average, 0.0 to 1.0
 
 
 class Model:
@@ -170,10 +189,8 @@ class Model:
                     root_logger.removeHandler(hdlr)
             root_logger.addHandler(filehandler)      # set the new handler
 
-        self.__file_list = []  # this is now a list of tuples i.e (file_id1,) or (file_id1, file_id2)
-        self.__number_of_files = 0  # this is shortcut for len(__file_list)
         self.__reload_files = True
-        self.__file_index = 0  # pointer to next position in __file_list
+        self.__file_index = 0  # pointer to next position in __playlist
         self.__current_pics = (None, None)  # this hold a tuple of (pic, None) or two pic objects if portrait pairs
         self.__num_run_through = 0
 
@@ -185,13 +202,34 @@ class Model:
         self.__pic_dir = os.path.expanduser(model_config['pic_dir'])
         self.__subdirectory = os.path.expanduser(model_config['subdirectory'])
         self.__load_geoloc = model_config['load_geoloc']
-        self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'],
-                                                    key_list=self.get_model_config()['key_list'])
+        geo_rate = model_config['geo_rate']
+        if not self.__load_geoloc:
+            self.__geo_reverse = None  # ImageCache doesn't look up locations at all
+        elif model_config['geo_backend'] == 'offline':
+            self.__geo_reverse = geo_reverse.GeoReverseOffline(os.path.expanduser(model_config['geo_data_file']),
+                                                               key_list=model_config['key_list'])
+            geo_rate = 0  # no need to ration local look ups
+        else:
+            self.__geo_reverse = geo_reverse.GeoReverse(model_config['geo_key'],
+                                                        key_list=self.get_model_config()['key_list'])
         self.__image_cache = image_cache.ImageCache(self.__pic_dir,
                                                     model_config['follow_links'],
                                                     os.path.expanduser(model_config['db_file']),
                                                     self.__geo_reverse,
-                                                    model_config['portrait_pairs'])
+                                                    model_config['portrait_pairs'],
+                                                    model_config['index_workers'],
+                                                    model_config['watch_files'],
+                                                    model_config['rescan_interval'],
+                                                    geo_rate,
+                                                    model_config['geo_cell_size'],
+                                                    model_config['index_files_per_sec'],
+                                                    model_config['index_mb_per_sec'],
+                                                    model_config['index_process'],
+                                                    self.__load_geoloc)
+        # slides as (file_id1,) or (file_id1, file_id2)
+        self.__playlist = playlist.Playlist(model_config['portrait_pairs'])
+        self.__playlist_query = None  # (where_clause, sort_clause) the playlist was loaded with
+        self.__file_event_seq = 0  # image_cache file events up to here have been applied to the playlist
         self.__deleted_pictures = model_config['deleted_pictures']
         self.__no_files_img = os.path.expanduser(model_config['no_files_img'])
         self.__sort_cols = model_config['sort_cols']
@@ -281,6 +319,9 @@ class Model:
     def pause_looping(self, val):
         self.__image_cache.pause_looping(val)
 
+    def suspend_image_cache(self, val):
+        self.__image_cache.suspend(val)
+
     def stop_image_chache(self):
         self.__image_cache.stop()
 
@@ -304,7 +345,7 @@ class Model:
         self.__reload_files = True
 
     def set_next_file_to_previous_file(self):
-        self.__file_index = (self.__file_index - 2) % self.__number_of_files  # TODO deleting last image results in ZeroDivisionError # noqa: E501
+        self.__file_index = (self.__file_index - 2) % len(self.__playlist)  # TODO deleting last image results in ZeroDivisionError # noqa: E501
 
     def get_next_file(self):
         missing_images = 0
@@ -314,18 +355,20 @@ class Model:
             pic1 = None
             pic2 = None
 
-            # Reload the playlist if requested
+            # Reload the playlist if requested, otherwise bring it up to date with the indexer
+            if not self.__reload_files:
+                self.__update_playlist()
             if self.__reload_files:
                 for _i in range(5):  # give image_cache chance on first load if a large directory
                     self.__get_files()
                     missing_images = 0
-                    if self.__number_of_files > 0:
+                    if len(self.__playlist) > 0:
                         break
                     time.sleep(0.5)
 
             # If we don't have any files to show, prepare the "no images" image
             # Also, set the reload_files flag so we'll check for new files on the next pass...
-            if self.__number_of_files == 0 or missing_images >= self.__number_of_files:
+            if len(self.__playlist) == 0 or missing_images >= len(self.__playlist):
                 pic1 = Pic(self.__no_files_img, 0, 0)
                 self.__reload_files = True
                 break
@@ -333,7 +376,7 @@ class Model:
             # If we've displayed all images...
             #   If it's time to shuffle, set a flag to do so
             #   Loop back, which will reload and shuffle if necessary
-            if self.__file_index == self.__number_of_files:
+            if self.__file_index >= len(self.__playlist):
                 self.__num_run_through += 1
                 if self.shuffle and self.__num_run_through >= self.get_model_config()['reshuffle_num']:
                     self.__reload_files = True
@@ -341,7 +384,7 @@ class Model:
                 continue
 
             # Load the current image set
-            file_ids = self.__file_list[self.__file_index]
+            file_ids = self.__playlist[self.__file_index]
             pic_row = self.__image_cache.get_file_info(file_ids[0])
             pic1 = Pic(**pic_row) if pic_row is not None else None
             if len(file_ids) == 2:
@@ -372,11 +415,30 @@ class Model:
         self.__current_pics = (pic1, pic2)
         return self.__current_pics
 
+    def get_upcoming_files(self, depth):
+        """Return a list of the next depth pic tuples that get_next_file will return
+        (as far as can be known) without moving the index on. Used for prefetching.
+        """
+        upcoming = []
+        number = len(self.__playlist)
+        if self.__reload_files or number == 0:
+            return upcoming  # next list isn't known yet
+        # after the last slide the list starts again, unless that's when it gets reshuffled
+        wraps = not (self.shuffle and self.__num_run_through + 1 >= self.get_model_config()['reshuffle_num'])
+        end = self.__file_index + min(depth, number) if wraps else min(self.__file_index + depth, number)
+        for i in range(self.__file_index, end):
+            pics = []
+            for file_id in self.__playlist[i % number]:
+                pic_row = self.__image_cache.peek_file_info(file_id)
+                pics.append(Pic(**pic_row) if pic_row is not None else None)
+            if pics and pics[0] is not None:
+                if len(pics) == 1:
+                    pics.append(None)
+                upcoming.append(tuple(pics))
+        return upcoming
+
     def get_number_of_files(self):
-        return sum(
-                    sum(1 for pic in pics if pic is not None)
-                    for pics in self.__file_list
-                )
+        return self.__playlist.number_of_files
 
     def get_current_pics(self):
         return self.__current_pics
@@ -393,12 +455,10 @@ class Model:
         if not os.path.exists(move_to_dir):
             os.system("mkdir {}".format(move_to_dir))  # problems with ownership using python func
         os.system("mv '{}' '{}'".format(f_to_delete, move_to_dir))  # and with SMB drives
-        # find and delete record from __file_list
-        for i, file_rec in enumerate(self.__file_list):
-            if file_rec[0] == pic.file_id:  # database id TODO check that db tidies itself up
-                self.__file_list.pop(i)
-                self.__number_of_files -= 1
-                break
+        # take the slide out of the playlist, the db tidies itself up when the file is found to be gone
+        index = self.__playlist.remove(pic.file_id)
+        if 0 <= index < self.__file_index:
+            self.__file_index -= 1
 
     def __get_files(self):
         if self.subdirectory != "":
@@ -413,13 +473,11 @@ class Model:
         else:
             where_clause = "1"
 
+        # The recent files first and the shuffle are done by the playlist, so the db is only queried
+        # again when the filters, the sort or the files in the library change, not for every reshuffle
         sort_list = []
-        recent_n = self.get_model_config()["recent_n"]
-        if recent_n > 0:
-            sort_list.append("last_modified < {:.0f}".format(time.time() - 3600 * 24 * recent_n))
-
         if self.shuffle:
-            sort_list.append("RANDOM()")
+            sort_list.append("file_id")  # any order will do, this is the quickest
         else:
             if self.__col_names is None:
                 self.__col_names = self.__image_cache.get_column_names()  # do this once
@@ -430,12 +488,45 @@ class Model:
             sort_list.append("fname ASC")  # always finally sort on this in case nothing else to sort on or sort_cols is "" # noqa: E501
         sort_clause = ",".join(sort_list)
 
-        self.__file_list = self.__image_cache.query_cache(where_clause, sort_clause)
-        self.__number_of_files = len(self.__file_list)
+        query = (where_clause, sort_clause)
+        if query == self.__playlist_query:
+            self.__update_playlist()  # which might find it has to be read again
+        if query != self.__playlist_query:
+            self.__file_event_seq = self.__image_cache.get_file_event_seq()  # anything after is applied later
+            self.__playlist.load(self.__image_cache.query_playlist(where_clause, sort_clause))
+            self.__playlist_query = query
+        self.__playlist.arrange(self.shuffle, self.__recent_time())
         self.__file_index = 0
         self.__num_run_through = 0
         self.__reload_files = False
 
+    def __update_playlist(self):
+        # Apply the files added, changed or removed by the indexer since the playlist was loaded
+        # without querying all of it again. Changed files are looked up again as they may now
+        # match the filters, or not. A sorted playlist needs the db to put new files in order.
+        if self.__playlist_query is None:
+            return
+        events = self.__image_cache.get_file_events(self.__file_event_seq)
+        if events is None:  # fallen too far behind, read it all again
+            self.__playlist_query = None
+            self.__reload_files = True
+            return
+        self.__file_event_seq, changed, removed = events
+        if not changed and not removed:
+            return
+        if changed and not self.shuffle:
+            self.__playlist_query = None
+            self.__reload_files = True
+            return
+        where_clause, sort_clause = self.__playlist_query
+        rows = list(self.__image_cache.query_playlist(where_clause, "file_id", changed)) if changed else []
+        removed |= changed - set(row[0] for row in rows)  # no longer match the filters
+        self.__file_index -= self.__playlist.update(rows, removed, self.__file_index, self.__recent_time())
+
+    def __recent_time(self):
+        recent_n = self.get_model_config()["recent_n"]
+        return time.time() - 3600 * 24 * recent_n if recent_n > 0 else 0.0
+
     def __generate_random_string(self, length):
         random_bytes = os.urandom(length // 2)
         random_string = ''.join('{:02x}'.format(ord(chr(byte))) for byte in random_bytes)
@@ -0,0 +1,178 @@
+import random
+import logging
+from array import array
+
+
+class Playlist:
+    """The order the slideshow goes through the files, held in typed arrays.
+
+    load() takes (file_id, is_portrait, last_modified) rows, as returned by
+    ImageCache.query_playlist(), and keeps them in parallel arrays of a few bytes
+    per file rather than a list of tuples. arrange() then puts the files in
+    slide order without going back to the db: the recent ones first, shuffled if
+    asked (a Fisher-Yates shuffle with the Random seeded by seed) and, with
+    portrait_pairs, the portrait files paired up as ImageCache.query_cache() does.
+    The second file of each slide is held in a parallel array, 0 for none.
+    """
+
+    def __init__(self, portrait_pairs=False, seed=None):
+        self.__logger = logging.getLogger("playlist.Playlist")
+        self.__portrait_pairs = portrait_pairs
+        self.__random = random.Random(seed)
+        self.__file_ids = array('I')
+        self.__is_portrait = array('B')
+        self.__last_modified = array('d')
+        self.__slides = array('I')  # first, or only, file_id of each slide
+        self.__pairs = array('I')  # second file_id of each slide or 0
+
+    def __len__(self):
+        return len(self.__slides)
+
+    def __getitem__(self, index):
+        """(file_id,) or (file_id1, file_id2) for the slide at index"""
+        if self.__pairs[index]:
+            return (self.__slides[index], self.__pairs[index])
+        return (self.__slides[index],)
+
+    @property
+    def number_of_files(self):
+        return len(self.__slides) + sum(1 for file_id in self.__pairs if file_id)
+
+    def load(self, rows):
+        """Replace the files with rows of (file_id, is_portrait, last_modified) in their sort order"""
+        self.__file_ids = array('I')
+        self.__is_portrait = array('B')
+        self.__last_modified = array('d')
+        for file_id, is_portrait, last_modified in rows:
+            self.__file_ids.append(file_id)
+            self.__is_portrait.append(1 if is_portrait else 0)
+            self.__last_modified.append(last_modified or 0.0)
+        self.__logger.debug("loaded %d files", len(self.__file_ids))
+
+    def arrange(self, shuffle, recent_time=0.0):
+        """Build the slides. Files modified since recent_time, if not 0, come first. Each part
+        is shuffled if shuffle is set, otherwise kept in the order given to load().
+        """
+        order = array('I', range(len(self.__file_ids)))
+        parts = [order]
+        if recent_time > 0.0:
+            last_modified = self.__last_modified
+            parts = [array('I', (i for i in order if last_modified[i] >= recent_time)),
+                     array('I', (i for i in order if last_modified[i] < recent_time))]
+        if shuffle:
+            for part in parts:
+                self.__random.shuffle(part)  # Fisher-Yates, in place
+        self.__slides = array('I')
+        self.__pairs = array('I')
+        file_ids = self.__file_ids
+        is_portrait = self.__is_portrait
+        for part in parts:
+            first = -1  # slide waiting for a second portrait
+            for i in part:
+                if self.__portrait_pairs and is_portrait[i]:
+                    if first >= 0:
+                        self.__pairs[first] = file_ids[i]
+                        first = -1
+                        continue
+                    first = len(self.__slides)
+                self.__slides.append(file_ids[i])
+                self.__pairs.append(0)
+
+    def update(self, rows, removed, start, recent_time=0.0):
+        """Apply changes to the files without arranging them all again. rows are (file_id, is_portrait,
+        last_modified) of files added or changed, removed file_ids to take out. New files go into the
+        slides from start, the index of the next to show, on: at random positions or, if modified since
+        recent_time (when not 0), at start so they are shown next. A file_id in both is taken out and
+        put back as a new file. Returns the number of slides taken out before start, for the caller
+        to move its index back by.
+        """
+        rows = {row[0]: row for row in rows}
+        removed = set(removed)
+        file_ids = array('I')
+        is_portrait = array('B')
+        last_modified = array('d')
+        for i, file_id in enumerate(self.__file_ids):  # one pass over the arrays for the whole batch
+            if file_id in removed:
+                continue
+            row = rows.pop(file_id, None)
+            file_ids.append(file_id)
+            is_portrait.append((1 if row[1] else 0) if row else self.__is_portrait[i])
+            last_modified.append((row[2] or 0.0) if row else self.__last_modified[i])
+        self.__file_ids, self.__is_portrait, self.__last_modified = file_ids, is_portrait, last_modified
+        before = 0
+        if removed:
+            before = self.__remove_slides(removed, start)
+            start -= before
+        new_rows = list(rows.values())  # what is left wasn't there before
+        for file_id, portrait, modified in new_rows:
+            self.__file_ids.append(file_id)
+            self.__is_portrait.append(1 if portrait else 0)
+            self.__last_modified.append(modified or 0.0)
+        self.__insert_slides(new_rows, start, recent_time)
+        if removed or new_rows:
+            self.__logger.debug("%d files added and %d removed", len(new_rows), len(removed))
+        return before
+
+    def __remove_slides(self, removed, start):
+        # The partner of a removed file in a portrait pair stays as a slide on its own
+        slides = array('I')
+        pairs = array('I')
+        before = 0
+        for i, (file_id, pair_id) in enumerate(zip(self.__slides, self.__pairs)):
+            if pair_id in removed:
+                pair_id = 0
+            if file_id in removed:
+                file_id, pair_id = pair_id, 0
+            if file_id:
+                slides.append(file_id)
+                pairs.append(pair_id)
+            elif i < start:
+                before += 1
+        self.__slides, self.__pairs = slides, pairs
+        return before
+
+    def __insert_slides(self, rows, start, recent_time):
+        slides = []
+        waiting = None  # portrait waiting for a second
+        for file_id, portrait, modified in rows:
+            recent = recent_time > 0.0 and (modified or 0.0) >= recent_time
+            if self.__portrait_pairs and portrait:
+                if waiting is not None:
+                    slides.append((waiting[0], file_id, waiting[1] or recent))
+                    waiting = None
+                else:
+                    waiting = (file_id, recent)
+                continue
+            slides.append((file_id, 0, recent))
+        if waiting is not None:
+            slides.append((waiting[0], 0, waiting[1]))
+        next_recent = start
+        for file_id, pair_id, recent in slides:
+            if recent:  # in the order they come, ahead of the rest
+                index = next_recent
+                next_recent += 1
+            else:
+                index = self.__random.randint(next_recent, len(self.__slides))
+            self.__slides.insert(index, file_id)
+            self.__pairs.insert(index, pair_id)
+
+    def remove(self, file_id):
+        """Take out the slide holding file_id, returns its index or -1 if not found"""
+        for ids in (self.__slides, self.__pairs):
+            try:
+                index = ids.index(file_id)
+            except ValueError:
+                continue
+            del self.__slides[index]
+            del self.__pairs[index]
+            break
+        else:
+            return -1
+        try:
+            i = self.__file_ids.index(file_id)
+            del self.__file_ids[i]
+            del self.__is_portrait[i]
+            del self.__last_modified[i]
+        except ValueError:
+            pass
+        return index
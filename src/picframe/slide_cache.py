@@ -0,0 +1,231 @@
+import os
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import OrderedDict
+from PIL import Image
+
+
+class DiskSlideCache:
+    """Display ready slide images saved in folder so a picture coming round again
+    only needs one small decode instead of the full open, orientate, mat and blur.
+
+    Files are named by a hash of the file_id and last_modified of each pic plus the
+    display size and whatever SlideLoader settings change the result, so anything
+    edited or a change of settings simply misses. Images are saved as JPEG, the
+    alpha of RGBA (blurred edges) images goes in a separate PNG. That alpha is
+    little more than two flat areas so this is a fraction of the size and four times
+    quicker to read than an RGBA PNG. Once the total size goes over max_mb the least
+    recently used are deleted. The file modification time is the LRU clock as atime
+    often isn't updated.
+
+    Processes sharing folder, i.e. SlideDecoderPool workers, each have their own
+    DiskSlideCache. They pick up each other's files on a miss and keep the size limit
+    between them by passing the same shared_total(). The process that takes it over
+    max_mb lists the folder again, to see what the others have added and used, before
+    deleting anything.
+    """
+
+    JPEG_QUALITY = 90
+    ALPHA_EXT = '.alpha.png'
+
+    def __init__(self, folder, max_mb=500, shared=None):
+        self.__logger = logging.getLogger("slide_cache.DiskSlideCache")
+        self.__folder = folder
+        self.__max_bytes = max_mb * 1024 * 1024
+        self.__lock = threading.Lock()
+        self.__entries = None  # OrderedDict key -> (size, has_alpha), least recently used first. Read on first use
+        self.__total = 0
+        self.__shared = shared  # from shared_total() or None if this is the only process using folder
+
+    @staticmethod
+    def shared_total(ctx=multiprocessing):
+        """Total size of the folder kept between processes, pass to each of their DiskSlideCaches"""
+        return ctx.Value('d', -1.0)  # not known until one of them lists the folder
+
+    def key(self, pics, settings):
+        ids = tuple((pic.file_id, pic.last_modified) if pic is not None else None for pic in pics)
+        return hashlib.sha1(repr((ids, settings)).encode()).hexdigest()
+
+    def contains(self, key):
+        with self.__lock:
+            self.__load_entries()
+            return key in self.__entries or self.__find(key)
+
+    def get(self, key):
+        """Return the saved image for key or None"""
+        with self.__lock:
+            self.__load_entries()
+            if key not in self.__entries and not self.__find(key):
+                return None
+            self.__entries.move_to_end(key)
+            has_alpha = self.__entries[key][1]
+        path = os.path.join(self.__folder, key + '.jpg')
+        try:
+            im = Image.open(path)
+            im.load()
+            if has_alpha:
+                alpha = Image.open(os.path.join(self.__folder, key + self.ALPHA_EXT))
+                im.putalpha(alpha)
+            os.utime(path)  # now the most recently used
+            return im
+        except FileNotFoundError:  # deleted by another process
+            self.__remove(key)
+            return None
+        except Exception as e:
+            self.__logger.warning("Can't read cached slide %s -> %s", path, e)
+            self.__remove(key)
+            return None
+
+    def put(self, key, im):
+        """Save im for key, evicting the least recently used if over the size limit"""
+        has_alpha = im.mode == 'RGBA'
+        paths = [os.path.join(self.__folder, key + ext) for ext in ('.jpg', self.ALPHA_EXT)[:1 + has_alpha]]
+        try:
+            with self.__lock:
+                self.__load_entries()
+            # save the alpha first and the jpg last, the jpg is what __load_entries goes by
+            if has_alpha:
+                im.getchannel('A').save(paths[1] + '.tmp', format='PNG')
+                os.replace(paths[1] + '.tmp', paths[1])
+            im.convert('RGB').save(paths[0] + '.tmp', format='JPEG', quality=self.JPEG_QUALITY)
+            os.replace(paths[0] + '.tmp', paths[0])  # never leave a half written file under the real name
+            size = sum(os.path.getsize(path) for path in paths)
+        except Exception as e:
+            self.__logger.warning("Can't save cached slide %s -> %s", paths[0], e)
+            for path in paths:
+                self.__delete(path + '.tmp')
+            return
+        with self.__lock:
+            added = size - self.__entries.pop(key, (0, False))[0]
+            self.__total += added
+            self.__entries[key] = (size, has_alpha)
+            if self.__shared is None:
+                self.__evict()
+                return
+        with self.__shared.get_lock():  # always taken before __lock
+            if self.__shared.value >= 0.0:
+                self.__shared.value += added
+            if self.__shared.value < 0.0 or self.__shared.value > self.__max_bytes:  # < 0 if not counted yet
+                with self.__lock:
+                    self.__entries = None  # see what the other processes have done
+                    self.__load_entries(delete_tmp=False)
+                    self.__evict()
+                    self.__shared.value = self.__total
+
+    def __evict(self):
+        # delete the least recently used until under the limit, with __lock held
+        while self.__total > self.__max_bytes and len(self.__entries) > 1:
+            old_key, (old_size, old_alpha) = self.__entries.popitem(last=False)
+            self.__total -= old_size
+            self.__delete_files(old_key, old_alpha)
+
+    def __find(self, key):
+        # add key if another process sharing the folder has saved it, with __lock held
+        path = os.path.join(self.__folder, key + '.jpg')
+        alpha_path = os.path.join(self.__folder, key + self.ALPHA_EXT)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return False
+        has_alpha = os.path.exists(alpha_path)
+        self.__entries[key] = (size + (os.path.getsize(alpha_path) if has_alpha else 0), has_alpha)
+        self.__total += self.__entries[key][0]  # already counted in the shared total
+        return True
+
+    def __remove(self, key):
+        with self.__lock:
+            size, has_alpha = self.__entries.pop(key, (0, True))
+            self.__total -= size
+        self.__delete_files(key, has_alpha)
+
+    def __delete_files(self, key, has_alpha):
+        self.__delete(os.path.join(self.__folder, key + '.jpg'))
+        if has_alpha:
+            self.__delete(os.path.join(self.__folder, key + self.ALPHA_EXT))
+
+    def __delete(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def __load_entries(self, delete_tmp=True):
+        if self.__entries is not None:
+            return
+        jpgs = []
+        alphas = {}
+        try:
+            os.makedirs(self.__folder, exist_ok=True)
+            with os.scandir(self.__folder) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):  # left by a crash, or being written by another process
+                        if delete_tmp:
+                            self.__delete(entry.path)
+                    elif entry.name.endswith(self.ALPHA_EXT):
+                        alphas[entry.name[:-len(self.ALPHA_EXT)]] = entry.stat().st_size
+                    elif entry.name.endswith('.jpg'):
+                        st = entry.stat()
+                        jpgs.append((st.st_mtime, entry.name[:-4], st.st_size))
+        except OSError as e:
+            self.__logger.warning("Can't use slide cache folder %s -> %s", self.__folder, e)
+        jpgs.sort()
+        self.__entries = OrderedDict()
+        for _, key, size in jpgs:
+            self.__entries[key] = (size + alphas.get(key, 0), key in alphas)
+        for key in alphas:
+            if key not in self.__entries:  # jpg never written or already deleted
+                self.__delete(os.path.join(self.__folder, key + self.ALPHA_EXT))
+        self.__total = sum(size for size, _ in self.__entries.values())
+        self.__logger.debug("%d cached slides, %.1fMB", len(self.__entries), self.__total / 1048576)
+
+
+class MemorySlideCache:
+    """The most recently shown slide images held in memory so stepping back and
+    forward through them doesn't go near the disk. Keyed by slide_loader.pics_key,
+    the size of each entry is taken as width * height * bands and the least
+    recently used are dropped once the total goes over max_mb.
+    """
+
+    def __init__(self, max_mb=100):
+        self.__logger = logging.getLogger("slide_cache.MemorySlideCache")
+        self.__max_bytes = max_mb * 1024 * 1024
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> PIL image, least recently used first
+        self.__total = 0
+
+    def __contains__(self, key):
+        with self.__lock:
+            return key in self.__entries
+
+    def get(self, key):
+        """Return the image for key or None"""
+        with self.__lock:
+            im = self.__entries.get(key)
+            if im is not None:
+                self.__entries.move_to_end(key)
+            return im
+
+    def put(self, key, im):
+        """Hold on to im, which must be fully loaded, dropping the least recently used if over the limit"""
+        size = self.__size(im)
+        if size > self.__max_bytes:
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None:
+                self.__total -= self.__size(old)
+            self.__entries[key] = im
+            self.__total += size
+            while self.__total > self.__max_bytes:
+                _, old = self.__entries.popitem(last=False)
+                self.__total -= self.__size(old)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__total = 0
+
+    def __size(self, im):
+        return im.width * im.height * len(im.getbands())
@@ -0,0 +1,429 @@
+import os
+import logging
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image, ImageFilter
+from picframe import mat_image, get_image_meta, slide_cache
+
+
+def pics_key(pics):
+    """Key identifying a (pic1, pic2) tuple by file name and modification time."""
+    return tuple((pic.fname, pic.last_modified) if pic is not None else None for pic in pics)
+
+
+class SlideLoader:
+    """Builds the display ready PIL image for a set of pics.
+
+    This is everything __tex_load used to do before creating the pi3d.Texture:
+    open, orientate, mat or blur the edges. It doesn't touch pi3d so it is safe
+    to run on a worker thread.
+    """
+
+    def __init__(self, display_size, blur_amount=12, blur_zoom=1.0, blur_edges=False, edge_alpha=0.5,
+                 mat_images=True, mat_images_tol=0.01, mat_type=None, outer_mat_color=None,
+                 inner_mat_color=None, outer_mat_border=75, inner_mat_border=40,
+                 outer_mat_use_texture=True, inner_mat_use_texture=False, mat_resource_folder='.',
+                 disk_cache=None):
+        self.__logger = logging.getLogger("slide_loader.SlideLoader")
+        self.__display_size = display_size
+        self.__blur_amount = blur_amount
+        self.__blur_zoom = blur_zoom
+        self.__blur_edges = blur_edges
+        self.__edge_alpha = edge_alpha
+        self.mat_images = mat_images
+        self.mat_images_tol = mat_images_tol
+        self.__mat_type = mat_type
+        self.__outer_mat_color = outer_mat_color
+        self.__inner_mat_color = inner_mat_color
+        self.__outer_mat_border = outer_mat_border
+        self.__inner_mat_border = inner_mat_border
+        self.__outer_mat_use_texture = outer_mat_use_texture
+        self.__inner_mat_use_texture = inner_mat_use_texture
+        self.__mat_resource_folder = mat_resource_folder
+        self.__disk_cache = disk_cache  # slide_cache.DiskSlideCache or None
+        self.__matter = None
+        self.__matter_lock = threading.Lock()  # MatImage keeps per image state so serialize calls
+
+    @property
+    def display_size(self):
+        return self.__display_size
+
+    def release(self, im):
+        """Nothing to give back, see SlideDecoderPool.release()"""
+        pass
+
+    def load(self, pics):
+        """Return the finished PIL image for pics or None if it can't be opened"""
+        key = None
+        if self.__disk_cache is not None:
+            key = self.__disk_cache.key(pics, self.__settings())
+            im = self.__disk_cache.get(key)
+            if im is not None:
+                return im
+        im, composed = self.__make(pics)
+        if composed and key is not None:
+            self.__disk_cache.put(key, im)
+        return im
+
+    def warm(self, pics):
+        """Make sure the disk cache has the image for pics"""
+        if self.__disk_cache is None:
+            return
+        key = self.__disk_cache.key(pics, self.__settings())
+        if not self.__disk_cache.contains(key):
+            im, composed = self.__make(pics)
+            if composed:
+                self.__disk_cache.put(key, im)
+
+    def __settings(self):
+        # everything that changes the image produced by __make
+        return (self.__display_size, self.__blur_amount, self.__blur_zoom, self.__blur_edges, self.__edge_alpha,
+                self.mat_images, self.mat_images_tol, self.__mat_type, self.__outer_mat_color,
+                self.__inner_mat_color, self.__outer_mat_border, self.__inner_mat_border,
+                self.__outer_mat_use_texture, self.__inner_mat_use_texture, self.__mat_resource_folder)
+
+    def __make(self, pics):  # noqa: C901
+        # Returns (image or None, composed). Only composed images, matted, paired or with
+        # blurred edges, are worth caching. Others are as quick to decode from the original.
+        size = self.__display_size
+        composed = False
+        # Load the image(s) and correct their orientation as necessary
+        if pics[0]:
+            im = get_image_meta.GetImageMeta.get_image_object(pics[0].fname, self.__decode_size(pics[0]))
+            if im is None:
+                return (None, False)
+            if pics[0].orientation != 1:
+                im = self.__orientate_image(im, pics[0])
+
+        if pics[1]:
+            im2 = get_image_meta.GetImageMeta.get_image_object(pics[1].fname, self.__decode_size(pics[1]))
+            if im2 is None:
+                return (None, False)
+            if pics[1].orientation != 1:
+                im2 = self.__orientate_image(im2, pics[1])
+
+        screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
+
+        if self.mat_images and diff_aspect > self.mat_images_tol:
+            with self.__matter_lock:
+                if self.__matter is None:
+                    self.__matter = mat_image.MatImage(display_size=size,
+                                                       resource_folder=self.__mat_resource_folder,
+                                                       mat_type=self.__mat_type,
+                                                       outer_mat_color=self.__outer_mat_color,
+                                                       inner_mat_color=self.__inner_mat_color,
+                                                       outer_mat_border=self.__outer_mat_border,
+                                                       inner_mat_border=self.__inner_mat_border,
+                                                       outer_mat_use_texture=self.__outer_mat_use_texture,
+                                                       inner_mat_use_texture=self.__inner_mat_use_texture)
+                palette = mat_image.palette_from_text(pics[0].palette)  # found by the indexer
+                if not pics[1]:
+                    im = self.__matter.mat_image((im,), palette)
+                else:
+                    im = self.__matter.mat_image((im, im2), palette)
+                # with a choice of mat types each showing gets a random one, caching would fix the first
+                composed = len(self.__matter.mat_type) == 1
+        else:
+            if pics[1]:  # i.e portrait pair
+                im = self.__create_image_pair(im, im2)
+                composed = True
+
+        (w, h) = im.size
+        screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
+
+        if self.__blur_edges and size:
+            if diff_aspect > 0.01:
+                (sc_b, sc_f) = (size[1] / im.size[1], size[0] / im.size[0])
+                if screen_aspect > image_aspect:
+                    (sc_b, sc_f) = (sc_f, sc_b)  # swap round
+                (w, h) = (round(size[0] / sc_b / self.__blur_zoom), round(size[1] / sc_b / self.__blur_zoom))
+                (x, y) = (round(0.5 * (im.size[0] - w)), round(0.5 * (im.size[1] - h)))
+                box = (x, y, x + w, y + h)
+                blr_sz = (int(x * 512 / size[0]) for x in size)
+                im_b = im.resize(size, resample=0, box=box).resize(blr_sz)
+                im_b = im_b.filter(ImageFilter.GaussianBlur(self.__blur_amount))
+                im_b = im_b.resize(size, resample=Image.BICUBIC)
+                im_b.putalpha(round(255 * self.__edge_alpha))  # to apply the same EDGE_ALPHA as the no blur method.
+                im = im.resize((int(x * sc_f) for x in im.size), resample=Image.BICUBIC)
+                """resize can use Image.LANCZOS (alias for Image.ANTIALIAS) for resampling
+                for better rendering of high-contranst diagonal lines. NB downscaled large
+                images are rescaled near the start of this try block if w or h > max_dimension
+                so those lines might need changing too.
+                """
+                im_b.paste(im, box=(round(0.5 * (im_b.size[0] - im.size[0])),
+                                    round(0.5 * (im_b.size[1] - im.size[1]))))
+                im = im_b  # have to do this as paste applies in place
+                composed = True
+        return (im, composed)
+
+    # Concatenate the specified images horizontally. Clip the taller
+    # image to the height of the shorter image.
+    def __create_image_pair(self, im1, im2):
+        sep = 8  # separation between the images
+        # scale widest image to same width as narrower to avoid drastic cropping on mismatched images
+        if im1.width > im2.width:
+            im1 = im1.resize((im2.width, int(im1.height * im2.width / im1.width)), resample=Image.BICUBIC)
+        else:
+            im2 = im2.resize((im1.width, int(im2.height * im1.width / im2.width)), resample=Image.BICUBIC)
+        dst = Image.new('RGB', (im1.width + im2.width + sep, min(im1.height, im2.height)))
+        dst.paste(im1, (0, 0))
+        dst.paste(im2, (im1.width + sep, 0))
+        return dst
+
+    def __decode_size(self, pic):
+        # size the image, as stored in the file, has to cover to fill the display once orientated
+        ext = os.path.splitext(pic.fname)[1].lower()
+        if pic.orientation in (5, 6, 7, 8) and ext not in ('.heif', '.heic'):
+            return (self.__display_size[1], self.__display_size[0])
+        return self.__display_size
+
+    def __orientate_image(self, im, pic):
+        ext = os.path.splitext(pic.fname)[1].lower()
+        if ext in ('.heif', '.heic'):  # heif and heic images are converted to PIL.Image obects and are alway in correct orienation # noqa: E501
+            return im
+        orientation = pic.orientation
+        if orientation == 2:
+            im = im.transpose(Image.FLIP_LEFT_RIGHT)
+        elif orientation == 3:
+            im = im.transpose(Image.ROTATE_180)  # rotations are clockwise
+        elif orientation == 4:
+            im = im.transpose(Image.FLIP_TOP_BOTTOM)
+        elif orientation == 5:
+            im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
+        elif orientation == 6:
+            im = im.transpose(Image.ROTATE_270)
+        elif orientation == 7:
+            im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
+        elif orientation == 8:
+            im = im.transpose(Image.ROTATE_90)
+        return im
+
+    def __get_aspect_diff(self, screen_size, image_size):
+        screen_aspect = screen_size[0] / screen_size[1]
+        image_aspect = image_size[0] / image_size[1]
+
+        if screen_aspect > image_aspect:
+            diff_aspect = 1 - (image_aspect / screen_aspect)
+        else:
+            diff_aspect = 1 - (screen_aspect / image_aspect)
+        return (screen_aspect, image_aspect, diff_aspect)
+
+
+class SlidePrefetcher:
+    """Prepares the next few slides on background threads.
+
+    The controller hands over the upcoming pics with prefetch() after each slide
+    change and __tex_load collects the finished image with get(). Anything not
+    ready in time is simply loaded on the render thread as before. Each thread
+    works on one slide at a time, so use one per SlideDecoderPool process for them
+    all to be kept busy.
+    """
+
+    def __init__(self, loader, depth=2, ahead=0, threads=1):  # loader is a SlideLoader or SlideDecoderPool
+        self.__logger = logging.getLogger("slide_loader.SlidePrefetcher")
+        self.__loader = loader
+        self.__depth = depth
+        self.__ahead = ahead  # pics tuples to render into the loader's disk cache, including the first depth
+        self.__pending = []  # pics tuples still to load, in display order
+        self.__warm = []  # pics tuples after those for the disk cache only
+        self.__ready = {}  # pics_key -> PIL image
+        self.__loading = set()  # pics_key of those being worked on
+        self.__cond = threading.Condition()
+        self.__keep_looping = True
+        self.__threads = [threading.Thread(target=self.__loop, daemon=True) for _ in range(max(1, threads))]
+        for thread in self.__threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """How many upcoming pics tuples prefetch() can use"""
+        return max(self.__depth, self.__ahead)
+
+    @property
+    def busy(self):
+        """True while any of the first depth upcoming pics are still to load. Warming the disk cache doesn't count"""
+        with self.__cond:
+            return bool(self.__pending) or bool(self.__loading)
+
+    def prefetch(self, upcoming):
+        """Replace the look-ahead list with upcoming, a list of pics tuples in display order"""
+        warm = upcoming[self.__depth:self.__ahead]
+        upcoming = upcoming[:self.__depth]
+        keys = [pics_key(pics) for pics in upcoming]
+        with self.__cond:
+            for key in list(self.__ready):  # drop anything that's no longer coming up
+                if key not in keys:
+                    self.__loader.release(self.__ready.pop(key))
+            self.__pending = [pics for pics, key in zip(upcoming, keys)
+                              if key not in self.__ready and key not in self.__loading]
+            self.__warm = warm
+            self.__cond.notify_all()
+
+    def get(self, pics):
+        """Return the prepared image for pics, waiting if it's being loaded right now, or None"""
+        key = pics_key(pics)
+        with self.__cond:
+            while key in self.__loading:
+                self.__cond.wait()
+            self.__pending = [p for p in self.__pending if pics_key(p) != key]
+            return self.__ready.pop(key, None)
+
+    def release(self, im):
+        """Hand back an image from get() once it has been made into a texture"""
+        self.__loader.release(im)
+
+    def stop(self):
+        with self.__cond:
+            self.__keep_looping = False
+            self.__cond.notify_all()
+        for thread in self.__threads:
+            thread.join()
+
+    def __loop(self):
+        while True:
+            with self.__cond:
+                while self.__keep_looping and not self.__pending and not self.__warm:
+                    self.__cond.wait()
+                if not self.__keep_looping:
+                    return
+                if not self.__pending:
+                    pics = self.__warm.pop(0)
+                    warm = True
+                else:
+                    pics = self.__pending.pop(0)
+                    key = pics_key(pics)
+                    self.__loading.add(key)
+                    warm = False
+            if warm:
+                try:
+                    self.__loader.warm(pics)
+                except Exception as e:
+                    self.__logger.warning("Can't cache \"%s\": %s", pics[0].fname if pics[0] else None, e)
+                continue
+            im = None
+            try:
+                im = self.__loader.load(pics)
+                if isinstance(im, Image.Image):
+                    im.load()  # make sure nothing lazy is left for the render thread
+            except Exception as e:
+                self.__logger.warning("Can't prefetch \"%s\": %s", pics[0].fname if pics[0] else None, e)
+            with self.__cond:
+                if im is not None:
+                    self.__ready[key] = im
+                self.__loading.discard(key)
+                self.__cond.notify_all()
+
+
+# state of a SlideDecoderPool worker process, set up by init_decode_worker()
+_worker_loader = None
+_worker_buffers = {}  # shared memory name -> SharedMemory
+
+
+def init_decode_worker(loader_kwargs, disk_cache_args):
+    global _worker_loader
+    disk_cache = slide_cache.DiskSlideCache(*disk_cache_args) if disk_cache_args else None
+    _worker_loader = SlideLoader(disk_cache=disk_cache, **loader_kwargs)
+
+
+def decode_slide(pics, buffer_name, mat_images, mat_images_tol):
+    """Run in a SlideDecoderPool worker. Load pics and copy the pixels into the shared memory
+    buffer_name, returning the shape of the array or None. With buffer_name None only warm the
+    disk cache.
+    """
+    _worker_loader.mat_images = mat_images
+    _worker_loader.mat_images_tol = mat_images_tol
+    if buffer_name is None:
+        _worker_loader.warm(pics)
+        return None
+    im = _worker_loader.load(pics)
+    if im is None:
+        return None
+    if im.mode not in ('RGB', 'RGBA'):
+        im = im.convert('RGB')
+    buffer = _worker_buffers.get(buffer_name)
+    if buffer is None:  # NB spawned workers share the parent's resource tracker, which unlinks at the end
+        buffer = shared_memory.SharedMemory(name=buffer_name)
+        _worker_buffers[buffer_name] = buffer
+    # Plain pictures come from draft() at up to twice the display size, more than the GPU needs.
+    # Shrink to just cover the display and, if that's still too big for the buffer, to fit it.
+    width, height = _worker_loader.display_size
+    scale = max(width / im.width, height / im.height)
+    scale = min(scale, (buffer.size / (im.width * im.height * len(im.getbands()))) ** 0.5)
+    if scale < 1.0:
+        im = im.resize((int(im.width * scale), int(im.height * scale)), resample=Image.BICUBIC)
+    arr = np.asarray(im)
+    np.ndarray(arr.shape, dtype=np.uint8, buffer=buffer.buf)[...] = arr
+    return arr.shape
+
+
+class SlideDecoderPool:
+    """Does what SlideLoader does in worker processes, out of reach of the render thread's GIL.
+
+    The finished pixels come back through a ring of shared memory buffers, each big
+    enough for an RGBA image of twice the display_size area, instead of being pickled. load() returns
+    a numpy array looking straight at one of the buffers, which pi3d.Texture can take
+    without a copy. The buffer stays reserved until it's given back with release(),
+    after the texture has been loaded into OpenGL. load() waits for a free buffer so
+    there must be more buffers than images held at once by the caller.
+    """
+
+    def __init__(self, loader_kwargs, disk_cache_args=None, processes=1, buffers=4):
+        self.__logger = logging.getLogger("slide_loader.SlideDecoderPool")
+        width, height = loader_kwargs['display_size']
+        self.mat_images = loader_kwargs.get('mat_images', True)  # can be changed as for SlideLoader
+        self.mat_images_tol = loader_kwargs.get('mat_images_tol', 0.01)
+        self.__buffers = [shared_memory.SharedMemory(create=True, size=width * height * 8) for _ in range(buffers)]
+        self.__free = list(range(buffers))
+        self.__in_use = {}  # id(array) -> buffer index
+        self.__cond = threading.Condition()
+        # spawn rather than fork, this process has threads and a GL context that children mustn't inherit
+        self.__pool = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=init_decode_worker, initargs=(loader_kwargs, disk_cache_args))
+
+    def load(self, pics):
+        """Return the finished image for pics as an array in shared memory, or None"""
+        with self.__cond:
+            while not self.__free:
+                self.__cond.wait()
+            index = self.__free.pop()
+        shape = None
+        try:
+            shape = self.__pool.submit(decode_slide, pics, self.__buffers[index].name,
+                                       self.mat_images, self.mat_images_tol).result()
+        finally:
+            if shape is None:
+                self.__give_back(index)
+        if shape is None:
+            return None
+        arr = np.ndarray(shape, dtype=np.uint8, buffer=self.__buffers[index].buf)
+        with self.__cond:
+            self.__in_use[id(arr)] = index
+        return arr
+
+    def warm(self, pics):
+        """Make sure the disk cache has the image for pics"""
+        self.__pool.submit(decode_slide, pics, None, self.mat_images, self.mat_images_tol).result()
+
+    def release(self, im):
+        """Give the buffer behind im, from load(), back for reuse. im mustn't be used after this"""
+        with self.__cond:
+            index = self.__in_use.pop(id(im), None)
+        if index is not None:
+            self.__give_back(index)
+
+    def stop(self):
+        self.__pool.shutdown(wait=True)
+        for buffer in self.__buffers:
+            try:
+                buffer.close()
+            except BufferError:  # an array still refers to it, the memory goes when that does
+                pass
+            buffer.unlink()
+
+    def __give_back(self, index):
+        with self.__cond:
+            self.__free.append(index)
+            self.__cond.notify()
@@ -62,7 +62,8 @@ def create_config(root):
             file.write(filedata)
 
         with open(run_start, "w") as file:  # TODO work-around for RPi4
-            file.write("from picframe import start\nstart.main()\n")
+            # guard needed as the indexer's worker processes re-import the main module
+            file.write("from picframe import start\nif __name__ == '__main__':\n    start.main()\n")
     except Exception:
         raise
 
@@ -118,7 +119,6 @@ def main():
                              'pi3d',
                              'yaml',
                              'paho.mqtt',
-                             'iptcinfo3',
                              'numpy',
                              'ninepatch',
                              'pi_heif',
@@ -3,9 +3,10 @@ import time
 import subprocess
 import logging
 import os
+import multiprocessing
 import numpy as np
-from PIL import Image, ImageFilter, ImageFile
-from picframe import mat_image, get_image_meta
+from PIL import ImageFile
+from picframe import slide_loader, slide_cache
 from datetime import datetime
 
 # supported display modes for display switch
@@ -31,6 +32,8 @@ def parse_show_text(txt):
 
 class ViewerDisplay:
 
+    DISPLAY_STATE_TTL = 60.0  # seconds to trust the last known display power state before asking again
+
     def __init__(self, config):
         self.__logger = logging.getLogger("viewer_display.ViewerDisplay")
         self.__blur_amount = config['blur_amount']
@@ -49,6 +52,7 @@ class ViewerDisplay:
         self.__mat_resource_folder = os.path.expanduser(config['mat_resource_folder'])
 
         self.__fps = config['fps']
+        self.__idle_fps = float(config['idle_fps'])
         self.__background = config['background']
         self.__blend_type = {"blend": 0.0, "burn": 1.0, "bump": 2.0}[config['blend_type']]
         self.__font_file = os.path.expanduser(config['font_file'])
@@ -74,6 +78,8 @@ class ViewerDisplay:
         self.__display_w = None if config['display_w'] is None else int(config['display_w'])
         self.__display_h = None if config['display_h'] is None else int(config['display_h'])
         self.__display_power = int(config['display_power'])
+        self.__display_is_on = None  # last known state, asking vcgencmd or xset means starting a process
+        self.__display_state_tm = 0.0
         self.__use_glx = config['use_glx']
         self.__alpha = 0.0  # alpha - proportion front image to back
         self.__delta_alpha = 1.0
@@ -89,7 +95,21 @@ class ViewerDisplay:
         self.__next_tm = 0.0
         self.__name_tm = 0.0
         self.__in_transition = False
-        self.__matter = None
+        self.__drawn_frames = [None, None]  # signatures of the last two frames drawn, the newest first
+        self.__last_draw_tm = 0.0
+        self.frame_is_drawn = True  # False if slideshow_is_running left the screen as it was
+        self.overlay_state = None  # anything InterfacePeripherals draws on top, a change forces a redraw
+        self.__loader = None
+        self.__prefetcher = None
+        self.__decoder = None
+        self.__prefetch_depth = int(config['prefetch_depth'])
+        self.__decode_processes = int(config['decode_processes'])
+        self.__slide_cache_folder = os.path.expanduser(config['slide_cache_folder'])
+        self.__slide_cache_mb = float(config['slide_cache_mb'])
+        self.__slide_cache_ahead = int(config['slide_cache_ahead'])
+        self.__memory_cache = None
+        if float(config['slide_memory_mb']) > 0:
+            self.__memory_cache = slide_cache.MemorySlideCache(float(config['slide_memory_mb']))
         self.__prev_clock_time = None
         self.__clock_overlay = None
         self.__show_clock = config['show_clock']
@@ -101,6 +121,13 @@ class ViewerDisplay:
 
     @property
     def display_is_on(self):
+        tm = time.time()
+        if self.__display_is_on is None or tm > self.__display_state_tm + self.DISPLAY_STATE_TTL:
+            self.__display_is_on = self.__get_display_power()
+            self.__display_state_tm = tm
+        return self.__display_is_on
+
+    def __get_display_power(self):
         if self.__display_power == 0:
             try:  # vcgencmd only applies to raspberry pi
                 state = str(subprocess.check_output(["vcgencmd", "display_power"]))
@@ -150,6 +177,8 @@ class ViewerDisplay:
                 self.__logger.debug("Cause: %s", e)
         else:
             self.__logger.warning("Unsupported setting for display_power=%d.", self.__display_power)
+        self.__display_is_on = on_off
+        self.__display_state_tm = time.time()
 
     def set_show_text(self, txt_key=None, val="ON"):
         if txt_key is None:
@@ -187,6 +216,16 @@ class ViewerDisplay:
         except Exception:  # ignore exceptions, error handling is done in following function
             pass
         self.__mat_images, self.__mat_images_tol = self.__get_mat_image_control_values(val)
+        if self.__loader is not None:
+            self.__loader.mat_images = self.__mat_images
+            self.__loader.mat_images_tol = self.__mat_images_tol
+            if self.__decoder is not None:
+                self.__decoder.mat_images = self.__mat_images
+                self.__decoder.mat_images_tol = self.__mat_images_tol
+            if self.__prefetcher is not None:
+                self.__prefetcher.prefetch([])  # anything already prepared used the old setting
+            if self.__memory_cache is not None:
+                self.__memory_cache.clear()
 
     def get_matting_images(self):
         if self.__mat_images and self.__mat_images_tol > 0:
@@ -204,41 +243,6 @@ class ViewerDisplay:
     def clock_is_on(self, val):
         self.__show_clock = val
 
-    # Concatenate the specified images horizontally. Clip the taller
-    # image to the height of the shorter image.
-    def __create_image_pair(self, im1, im2):
-        sep = 8  # separation between the images
-        # scale widest image to same width as narrower to avoid drastic cropping on mismatched images
-        if im1.width > im2.width:
-            im1 = im1.resize((im2.width, int(im1.height * im2.width / im1.width)), resample=Image.BICUBIC)
-        else:
-            im2 = im2.resize((im1.width, int(im2.height * im1.width / im2.width)), resample=Image.BICUBIC)
-        dst = Image.new('RGB', (im1.width + im2.width + sep, min(im1.height, im2.height)))
-        dst.paste(im1, (0, 0))
-        dst.paste(im2, (im1.width + sep, 0))
-        return dst
-
-    def __orientate_image(self, im, pic):
-        ext = os.path.splitext(pic.fname)[1].lower()
-        if ext in ('.heif', '.heic'):  # heif and heic images are converted to PIL.Image obects and are alway in correct orienation # noqa: E501
-            return im
-        orientation = pic.orientation
-        if orientation == 2:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT)
-        elif orientation == 3:
-            im = im.transpose(Image.ROTATE_180)  # rotations are clockwise
-        elif orientation == 4:
-            im = im.transpose(Image.FLIP_TOP_BOTTOM)
-        elif orientation == 5:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_90)
-        elif orientation == 6:
-            im = im.transpose(Image.ROTATE_270)
-        elif orientation == 7:
-            im = im.transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.ROTATE_270)
-        elif orientation == 8:
-            im = im.transpose(Image.ROTATE_90)
-        return im
-
     def __get_mat_image_control_values(self, mat_images_value):
         on = True
         val = 0.01
@@ -254,86 +258,35 @@ class ViewerDisplay:
                 self.__logger.warning("Invalid value for config option 'mat_images'. Using default.")
         return (on, val)
 
-    def __get_aspect_diff(self, screen_size, image_size):
-        screen_aspect = screen_size[0] / screen_size[1]
-        image_aspect = image_size[0] / image_size[1]
-
-        if screen_aspect > image_aspect:
-            diff_aspect = 1 - (image_aspect / screen_aspect)
-        else:
-            diff_aspect = 1 - (screen_aspect / image_aspect)
-        return (screen_aspect, image_aspect, diff_aspect)
-
-    def __tex_load(self, pics, size=None):  # noqa: C901
+    def __tex_load(self, pics):
+        prefetched = None
         try:
-            if self.__mat_images and self.__matter is None:
-                self.__matter = mat_image.MatImage(display_size=(self.__display.width, self.__display.height),
-                                                   resource_folder=self.__mat_resource_folder,
-                                                   mat_type=self.__mat_type,
-                                                   outer_mat_color=self.__outer_mat_color,
-                                                   inner_mat_color=self.__inner_mat_color,
-                                                   outer_mat_border=self.__outer_mat_border,
-                                                   inner_mat_border=self.__inner_mat_border,
-                                                   outer_mat_use_texture=self.__outer_mat_use_texture,
-                                                   inner_mat_use_texture=self.__inner_mat_use_texture)
-
-            # Load the image(s) and correct their orientation as necessary
-            if pics[0]:
-                im = get_image_meta.GetImageMeta.get_image_object(pics[0].fname)
-                if im is None:
-                    return None
-                if pics[0].orientation != 1:
-                    im = self.__orientate_image(im, pics[0])
-
-            if pics[1]:
-                im2 = get_image_meta.GetImageMeta.get_image_object(pics[1].fname)
-                if im2 is None:
-                    return None
-                if pics[1].orientation != 1:
-                    im2 = self.__orientate_image(im2, pics[1])
-
-            screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
-
-            if self.__mat_images and diff_aspect > self.__mat_images_tol:
-                if not pics[1]:
-                    im = self.__matter.mat_image((im,))
-                else:
-                    im = self.__matter.mat_image((im, im2))
-            else:
-                if pics[1]:  # i.e portrait pair
-                    im = self.__create_image_pair(im, im2)
-
-            (w, h) = im.size
-            screen_aspect, image_aspect, diff_aspect = self.__get_aspect_diff(size, im.size)
-
-            if self.__blur_edges and size:
-                if diff_aspect > 0.01:
-                    (sc_b, sc_f) = (size[1] / im.size[1], size[0] / im.size[0])
-                    if screen_aspect > image_aspect:
-                        (sc_b, sc_f) = (sc_f, sc_b)  # swap round
-                    (w, h) = (round(size[0] / sc_b / self.__blur_zoom), round(size[1] / sc_b / self.__blur_zoom))
-                    (x, y) = (round(0.5 * (im.size[0] - w)), round(0.5 * (im.size[1] - h)))
-                    box = (x, y, x + w, y + h)
-                    blr_sz = (int(x * 512 / size[0]) for x in size)
-                    im_b = im.resize(size, resample=0, box=box).resize(blr_sz)
-                    im_b = im_b.filter(ImageFilter.GaussianBlur(self.__blur_amount))
-                    im_b = im_b.resize(size, resample=Image.BICUBIC)
-                    im_b.putalpha(round(255 * self.__edge_alpha))  # to apply the same EDGE_ALPHA as the no blur method.
-                    im = im.resize((int(x * sc_f) for x in im.size), resample=Image.BICUBIC)
-                    """resize can use Image.LANCZOS (alias for Image.ANTIALIAS) for resampling
-                    for better rendering of high-contranst diagonal lines. NB downscaled large
-                    images are rescaled near the start of this try block if w or h > max_dimension
-                    so those lines might need changing too.
-                    """
-                    im_b.paste(im, box=(round(0.5 * (im_b.size[0] - im.size[0])),
-                                        round(0.5 * (im_b.size[1] - im.size[1]))))
-                    im = im_b  # have to do this as paste applies in place
+            im = None
+            key = slide_loader.pics_key(pics)
+            if self.__memory_cache is not None:
+                im = self.__memory_cache.get(key)
+            if im is None and self.__prefetcher is not None:
+                im = prefetched = self.__prefetcher.get(pics)
+            if im is None:
+                im = self.__loader.load(pics)
+            if im is None:
+                return None
+            # Not an array in a SlideDecoderPool buffer, that would mean copying it here on the render thread.
+            # Those come back from the disk cache in a worker process instead
+            if self.__memory_cache is not None and not isinstance(im, np.ndarray):
+                im.load()
+                self.__memory_cache.put(key, im)
             tex = pi3d.Texture(im, blend=True, m_repeat=True, free_after_load=True)
+            if prefetched is not None:
+                tex.load_opengl()  # now, before the buffer behind the image is handed back
         except Exception as e:
             self.__logger.warning("Can't create tex from file: \"%s\" or \"%s\"", pics[0].fname, pics[1])
             self.__logger.warning("Cause: %s", e)
             tex = None
             # raise # only re-raise errors here while debugging
+        finally:
+            if prefetched is not None:
+                self.__prefetcher.release(prefetched)
         return tex
 
     def __make_text(self, pic, paused, side=0, pair=False):  # noqa: C901
@@ -399,7 +352,7 @@ class ViewerDisplay:
             self.__textblocks[1] = None
         self.__textblocks[side] = block
 
-    def __draw_clock(self):
+    def __update_clock(self):
         current_time = datetime.now().strftime(self.__clock_format)
 
         # --- Only rebuild the FixedString containing the time valud if the time string has changed.
@@ -419,9 +372,6 @@ class ViewerDisplay:
             self.__clock_overlay.sprite.position(x, y, 0.1)
             self.__prev_clock_time = current_time
 
-        if self.__clock_overlay:
-            self.__clock_overlay.sprite.draw()
-
     @property
     def display_width(self):
         return self.__display.width
@@ -433,6 +383,21 @@ class ViewerDisplay:
     def is_in_transition(self):
         return self.__in_transition
 
+    def is_preloading(self):
+        """True while upcoming slides are being prepared in the background"""
+        return self.__prefetcher is not None and self.__prefetcher.busy
+
+    @property
+    def prefetch_depth(self):
+        return self.__prefetcher.depth if self.__prefetcher is not None else 0
+
+    def prefetch(self, upcoming):
+        """Start preparing the images for the list of upcoming pics tuples in the background"""
+        if self.__prefetcher is not None:
+            if self.__memory_cache is not None:  # no need to prepare anything still in memory
+                upcoming = [pics for pics in upcoming if slide_loader.pics_key(pics) not in self.__memory_cache]
+            self.__prefetcher.prefetch(upcoming)
+
     def slideshow_start(self):
         self.__display = pi3d.Display.create(x=self.__display_x, y=self.__display_y,
                                              w=self.__display_w, h=self.__display_h, frames_per_second=self.__fps,
@@ -447,6 +412,42 @@ class ViewerDisplay:
         self.__slide.unif[55] = 1.0  # brightness
         self.__textblocks = [None, None]
         self.__flat_shader = pi3d.Shader("uv_flat")
+        disk_cache = None
+        disk_cache_args = None
+        if self.__slide_cache_mb > 0:
+            disk_cache_args = (self.__slide_cache_folder, self.__slide_cache_mb)
+            if self.__decode_processes > 0:  # the decode processes use the same folder, sharing the size limit
+                ctx = multiprocessing.get_context('spawn')
+                disk_cache_args += (slide_cache.DiskSlideCache.shared_total(ctx),)
+            disk_cache = slide_cache.DiskSlideCache(*disk_cache_args)
+        loader_kwargs = dict(display_size=(self.__display.width, self.__display.height),
+                             blur_amount=self.__blur_amount,
+                             blur_zoom=self.__blur_zoom,
+                             blur_edges=self.__blur_edges,
+                             edge_alpha=self.__edge_alpha,
+                             mat_images=self.__mat_images,
+                             mat_images_tol=self.__mat_images_tol,
+                             mat_type=self.__mat_type,
+                             outer_mat_color=self.__outer_mat_color,
+                             inner_mat_color=self.__inner_mat_color,
+                             outer_mat_border=self.__outer_mat_border,
+                             inner_mat_border=self.__inner_mat_border,
+                             outer_mat_use_texture=self.__outer_mat_use_texture,
+                             inner_mat_use_texture=self.__inner_mat_use_texture,
+                             mat_resource_folder=self.__mat_resource_folder)
+        self.__loader = slide_loader.SlideLoader(disk_cache=disk_cache, **loader_kwargs)
+        ahead = self.__slide_cache_ahead if disk_cache is not None else 0
+        if self.__prefetch_depth > 0 or ahead > 0:
+            loader = self.__loader
+            threads = 1
+            if self.__decode_processes > 0:
+                # a thread for each process to keep them all busy, and enough buffers for the slides waiting,
+                # one no longer wanted, those being loaded and the one being made a texture
+                threads = self.__decode_processes
+                self.__decoder = loader = slide_loader.SlideDecoderPool(loader_kwargs, disk_cache_args,
+                                                                        self.__decode_processes,
+                                                                        self.__prefetch_depth + threads + 2)
+            self.__prefetcher = slide_loader.SlidePrefetcher(loader, self.__prefetch_depth, ahead, threads)
 
         if self.__text_bkg_hgt:
             bkg_hgt = int(min(self.__display.width, self.__display.height) * self.__text_bkg_hgt)
@@ -458,13 +459,9 @@ class ViewerDisplay:
             self.__text_bkg.set_draw_details(self.__flat_shader, [text_bkg_tex])
 
     def slideshow_is_running(self, pics=None, time_delay=200.0, fade_time=10.0, paused=False):  # noqa: C901
-        if self.clock_is_on:
-            self.__draw_clock()
-
-        loop_running = self.__display.loop_running()
         tm = time.time()
         if pics is not None:
-            new_sfg = self.__tex_load(pics, (self.__display.width, self.__display.height))
+            new_sfg = self.__tex_load(pics)
             tm = time.time()
             self.__next_tm = tm + time_delay
             self.__name_tm = tm + fade_time + self.__show_text_tm  # text starts after slide transition
@@ -523,8 +520,7 @@ class ViewerDisplay:
         else:  # no transition effect safe to update database, resuffle etc
             self.__in_transition = False
 
-        self.__slide.draw()
-
+        text_alpha = None
         if self.__alpha >= 1.0 and tm < self.__name_tm:
             # this sets alpha for the TextBlock from 0 to 1 then back to 0
             if self.__show_text_tm > 0:
@@ -542,17 +538,61 @@ class ViewerDisplay:
             for block in self.__textblocks:
                 if block is not None:
                     block.sprite.set_alpha(alpha)
+            text_alpha = alpha
+
+        if self.clock_is_on:
+            self.__update_clock()
+
+        # Outside transitions, text fades and Ken Burns the frame is usually just what's on the screen
+        # already. Only redraw when something has changed or, as a fall back, at idle_fps. The frame is
+        # only presented by the next loop_running() so the last two drawn must match before skipping.
+        # loop_running() is also where pi3d reads window events so any waiting ones force a redraw too.
+        frame = self.__frame_signature(text_alpha)
+        if (self.__idle_fps > 0 and frame == self.__drawn_frames[0] == self.__drawn_frames[1]
+                and tm - self.__last_draw_tm < 1.0 / self.__idle_fps and not self.__events_pending()):
+            self.frame_is_drawn = False
+            time.sleep(1.0 / self.__fps)  # keep checking for input at the normal rate
+            return (self.__display.is_running, False)
+        self.frame_is_drawn = True
+        self.__drawn_frames = [frame, self.__drawn_frames[0]]
+        self.__last_draw_tm = tm
+
+        loop_running = self.__display.loop_running()
+        self.__slide.draw()
 
-            # if we have a text background to render (and we currently have text), set its alpha and draw it
-            if self.__text_bkg_hgt and any(block is not None for block in self.__textblocks):  # only draw background if text there # noqa: E501
-                self.__text_bkg.set_alpha(alpha)
-                self.__text_bkg.draw()
+        # if we have a text background to render (and we currently have text), set its alpha and draw it
+        if text_alpha is not None and self.__text_bkg_hgt and any(block is not None for block in self.__textblocks):  # only draw background if text there # noqa: E501
+            self.__text_bkg.set_alpha(text_alpha)
+            self.__text_bkg.draw()
 
         for block in self.__textblocks:
             if block is not None:
                 block.sprite.draw()
 
+        if self.clock_is_on and self.__clock_overlay:
+            self.__clock_overlay.sprite.draw()
+
         return (loop_running, False)  # now returns tuple with skip image flag added
 
+    def __events_pending(self):
+        # same backends as pi3d Display._loop_begin(), on the Pi console it reads nothing there
+        if getattr(pi3d, 'USE_SDL2', False):
+            import sdl2
+            return sdl2.SDL_HasEvents(sdl2.SDL_FIRSTEVENT, sdl2.SDL_LASTEVENT) == sdl2.SDL_TRUE
+        if pi3d.PLATFORM in (pi3d.PLATFORM_PI, pi3d.PLATFORM_ANDROID):
+            return False
+        from pyxlib import xlib
+        return xlib.XEventsQueued(self.__display.opengl.d, xlib.QueuedAfterFlush) > 0
+
+    def __frame_signature(self, text_alpha):
+        # everything that changes what slideshow_is_running draws
+        return (id(self.__sfg), id(self.__sbg), tuple(self.__slide.unif), text_alpha,
+                tuple(id(block) for block in self.__textblocks),
+                self.__prev_clock_time if self.clock_is_on else None, self.overlay_state)
+
     def slideshow_stop(self):
+        if self.__prefetcher is not None:
+            self.__prefetcher.stop()
+        if self.__decoder is not None:
+            self.__decoder.stop()
         self.__display.destroy()
@@ -0,0 +1,89 @@
+"""Benchmark of reading the meta data of image files with GetImageMeta.
+
+Builds a small library of large JPEG (with the exif of test/images/AlleExif.JPG),
+greyscale JPEG and palette PNG files and reports files per second for GetImageMeta
+plus get_size(), i.e. what the indexer needs for each file, against the previous
+approach of an open and convert("RGB") (which decodes anything not already RGB)
+for the tags, another for the size and a separate open for IPTC. "fast" is the
+JPEG marker parser used by the indexer, reading just the tags it stores.
+
+    python -m test.benchmarks.bench_get_image_meta [files_per_kind] [repeats]
+"""
+import os
+import sys
+import time
+import logging
+import tempfile
+from PIL import Image
+from picframe.get_image_meta import GetImageMeta
+
+EXIF_SOURCE = os.path.join(os.path.dirname(__file__), '..', 'images', 'AlleExif.JPG')
+
+
+def make_library(folder, files_per_kind):
+    exif = Image.open(EXIF_SOURCE).info.get('exif', b'')
+    rgb = Image.radial_gradient('L').resize((4000, 3000)).convert('RGB')
+    grey = rgb.convert('L')
+    palette = rgb.convert('P')
+    files = []
+    for i in range(files_per_kind):
+        for name, im, kwargs in (('rgb{}.jpg', rgb, {'exif': exif, 'quality': 90}),
+                                 ('grey{}.jpg', grey, {'quality': 90}),
+                                 ('palette{}.png', palette, {})):
+            fname = os.path.join(folder, name.format(i))
+            im.save(fname, **kwargs)
+            files.append(fname)
+    return files
+
+
+def open_converted(fname):
+    image = Image.open(fname)
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGB")
+    return image
+
+
+def previous_approach(fname):
+    # what GetImageMeta used to do: open and convert for the tags, IPTCInfo, open and convert again for the size
+    image = open_converted(fname)
+    image.getexif()
+    try:
+        image.getxmp()
+    except Exception:
+        pass
+    try:
+        from iptcinfo3 import IPTCInfo
+        with open(fname, 'rb') as fh:
+            IPTCInfo(fh, force=True, out_charset='utf-8')
+    except Exception:
+        pass
+    return open_converted(fname).size
+
+
+def current_approach(fname):
+    return GetImageMeta(fname).get_size()
+
+
+def fast_approach(fname):
+    return GetImageMeta(fname, fast=True).get_size()
+
+
+def main(files_per_kind=20, repeats=3):
+    logging.getLogger('iptcinfo').setLevel(logging.ERROR)
+    with tempfile.TemporaryDirectory() as tmp:
+        files = make_library(tmp, files_per_kind)
+        print("{:>20} {:>12}".format("", "files/s"))
+        for label, func in (("previous", previous_approach), ("GetImageMeta", current_approach),
+                            ("GetImageMeta fast", fast_approach)):
+            best = None
+            for _ in range(repeats):
+                tm = time.perf_counter()
+                for fname in files:
+                    func(fname)
+                elapsed = time.perf_counter() - tm
+                best = elapsed if best is None else min(best, elapsed)
+            print("{:>20} {:>12.1f}".format(label, len(files) / best))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
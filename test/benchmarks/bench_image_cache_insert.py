@@ -0,0 +1,49 @@
+"""Benchmark of ImageCache file inserts as the library grows.
+
+Inserts synthetic files (empty files with fixed meta data, so no image decoding is
+timed) and reports the average cost per insert for each block. The cost should stay
+flat as the number of rows grows.
+
+    python -m test.benchmarks.bench_image_cache_insert [number_of_files] [block_size]
+"""
+import os
+import sys
+import time
+import tempfile
+from picframe import image_cache
+
+META = {'orientation': 1, 'width': 4000, 'height': 3000, 'f_number': 2.8, 'make': 'SONY', 'model': 'ILCE-7RM3',
+        'exposure_time': '1/30', 'iso': 6400, 'focal_length': '17.0', 'rating': None, 'lens': None,
+        'exif_datetime': 1580410888.0, 'latitude': None, 'longitude': None, 'tags': None, 'title': None,
+        'caption': None}
+
+
+def main(number_of_files=20000, block_size=2000, files_per_folder=500):
+    with tempfile.TemporaryDirectory() as tmp:
+        pic_dir = os.path.join(tmp, 'pictures')
+        os.makedirs(pic_dir)
+        cache = image_cache.ImageCache(pic_dir, False, os.path.join(tmp, 'bench.db3'), None)
+        cache.pause_looping(True)
+        cache._ImageCache__get_exif_info = lambda file_path_name: dict(META)
+        insert_file = cache._ImageCache__insert_file
+        files = []
+        for i in range(number_of_files):
+            folder = os.path.join(pic_dir, 'folder{:04d}'.format(i // files_per_folder))
+            if i % files_per_folder == 0:
+                os.makedirs(folder)
+            fname = os.path.join(folder, 'img{:06d}.jpg'.format(i))
+            open(fname, 'wb').close()
+            files.append(fname)
+
+        print("{:>10} {:>16}".format("rows", "ms per insert"))
+        for start in range(0, number_of_files, block_size):
+            tm = time.perf_counter()
+            for fname in files[start:start + block_size]:
+                insert_file(fname)
+            elapsed = time.perf_counter() - tm
+            print("{:>10} {:>16.3f}".format(start + block_size, 1000.0 * elapsed / block_size))
+        cache.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,62 @@
+"""Benchmark of the ImageCache folder/file scan on a synthetic tree.
+
+Builds number_of_folders folders of files_per_folder empty .jpg files and times one
+scanning pass in three states of the database:
+  - empty, every folder and file is new
+  - all files known but every folder modified, so each folder has to be listed and compared
+  - nothing changed, only the folders are checked
+
+    python -m test.benchmarks.bench_image_cache_scan [number_of_folders] [files_per_folder]
+"""
+import os
+import sys
+import time
+import tempfile
+from picframe import image_cache
+
+
+def timed_scan(cache, label):
+    tm = time.perf_counter()
+    folders, files = cache._ImageCache__scan_modified()
+    elapsed = time.perf_counter() - tm
+    print("{:<32} {:>8} folders {:>8} files {:>8.3f} s".format(label, len(folders), len(files), elapsed))
+    return folders, files
+
+
+def main(number_of_folders=1000, files_per_folder=100):
+    with tempfile.TemporaryDirectory() as tmp:
+        pic_dir = os.path.join(tmp, 'pictures')
+        for i in range(number_of_folders):
+            folder = os.path.join(pic_dir, 'folder{:04d}'.format(i))
+            os.makedirs(folder)
+            for j in range(files_per_folder):
+                open(os.path.join(folder, 'img{:04d}.jpg'.format(j)), 'wb').close()
+
+        cache = image_cache.ImageCache(pic_dir, False, os.path.join(tmp, 'bench.db3'), None, rescan_interval=1e9)
+        cache.pause_looping(True)
+        time.sleep(1.0)  # let the indexing thread settle into its paused state
+        db = cache._ImageCache__db
+
+        folders, files = timed_scan(cache, "empty db")
+
+        # fill the folder and file tables directly, no meta data needed for scanning
+        db.executemany("INSERT INTO folder(name, last_modified) VALUES(?, 0)", [(dir,) for dir, _ in folders])
+        folder_ids = {row['name']: row['folder_id'] for row in db.execute("SELECT folder_id, name FROM folder")}
+        rows = []
+        for fname in files:
+            dir, file_only = os.path.split(fname)
+            base, extension = os.path.splitext(file_only)
+            rows.append((folder_ids[dir], base, extension.lstrip("."), os.path.getmtime(fname)))
+        db.executemany("INSERT INTO file(folder_id, basename, extension, last_modified) VALUES(?, ?, ?, ?)", rows)
+        db.commit()
+        timed_scan(cache, "files known, folders modified")
+
+        db.executemany("UPDATE folder SET last_modified = ? WHERE name = ?",
+                       [(mod_tm, dir) for dir, mod_tm in folders])
+        db.commit()
+        timed_scan(cache, "nothing changed")
+        cache.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,74 @@
+"""Benchmark of how much indexing holds up the slideshow.
+
+Copies test/images/AlleExif.JPG number_of_files times then, while an ImageCache
+indexes them, runs a stand in for the render loop on the main thread: a frame of
+pure Python work every 1/fps seconds. Reports how late the frames were with the
+indexer on a thread of this process and in its own process (index_process=True).
+
+    python -m test.benchmarks.bench_index_jitter [number_of_files] [index_workers]
+"""
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+from picframe import image_cache
+
+SOURCE = os.path.join(os.path.dirname(__file__), '..', 'images', 'AlleExif.JPG')
+FPS = 20.0
+
+
+class NoGeoReverse:
+    def get_address(self, lat, lon):
+        return ""
+
+
+def frame_work():
+    total = 0
+    for i in range(20000):  # a few ms, roughly what building a frame costs in Python
+        total += i * i
+    return total
+
+
+def run(pic_dir, db_file, number_of_files, index_workers, index_process):
+    late = []
+    cache = image_cache.ImageCache(pic_dir, False, db_file, NoGeoReverse(), index_workers=index_workers,
+                                   rescan_interval=1e9, geo_rate=0, index_process=index_process)
+    db = sqlite3.connect(db_file)
+    start_tm = time.perf_counter()
+    while db.execute("SELECT COUNT(*) FROM file").fetchone()[0] < number_of_files:
+        next_tm = time.perf_counter()  # don't count the check against the next frame
+        for _ in range(int(FPS)):  # a second of frames between checks
+            frame_work()
+            next_tm += 1.0 / FPS
+            wait_tm = next_tm - time.perf_counter()
+            if wait_tm > 0.0:
+                time.sleep(wait_tm)
+                late.append(time.perf_counter() - next_tm)
+            else:
+                late.append(-wait_tm)
+    elapsed = time.perf_counter() - start_tm
+    db.close()
+    cache.stop()
+    late.sort()
+    return elapsed, late
+
+
+def main(number_of_files=2000, index_workers=1):
+    with tempfile.TemporaryDirectory() as tmp:
+        pic_dir = os.path.join(tmp, 'pictures')
+        for i in range(number_of_files):
+            folder = os.path.join(pic_dir, 'folder{:03d}'.format(i // 100))
+            os.makedirs(folder, exist_ok=True)
+            shutil.copy(SOURCE, os.path.join(folder, 'img{:05d}.jpg'.format(i)))
+        print("{:>16} {:>10} {:>12} {:>12} {:>12}".format("", "index s", "mean ms", "p95 ms", "max ms"))
+        for label, index_process in (("thread", False), ("process", True)):
+            db_file = os.path.join(tmp, '{}.db3'.format(label))
+            elapsed, late = run(pic_dir, db_file, number_of_files, index_workers, index_process)
+            print("{:>16} {:>10.1f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+                  label, elapsed, 1000 * sum(late) / len(late), 1000 * late[int(len(late) * 0.95)], 1000 * late[-1]))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,111 @@
+"""Benchmark and quality check of KmeansNp, the mat colour search.
+
+Runs KmeansNp (as MatImage and the indexer use it, k=3, 10 iterations on a 100x100
+thumbnail) and the previous implementation, k-means over every thumbnail pixel
+in float64, on a set of pictures for number_of_seeds seeds each. Reports ms per
+run and, as the quality measures, the RMS distance (0-255 RGB) of the thumbnail
+pixels from the nearest colour found and how far the chosen mat colour (the first)
+is from the previous one on average, next to how far apart the previous one's
+choices are from one seed to the next.
+
+    python -m test.benchmarks.bench_kmeans [number_of_seeds]
+"""
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image, ImageFilter
+from picframe.mat_image import KmeansNp
+
+SOURCE = os.path.join(os.path.dirname(__file__), '..', 'images', 'AlleExif.JPG')
+
+
+def previous_kmeans(image, k=3, max_iterations=10, min_distance=5.0, size=100):
+    # KmeansNp.run as it was
+    image = image.copy()
+    image.thumbnail((size, size))
+    im = np.array(image, dtype=float)[:, :, :3]
+    d = im.shape[-1]
+    im = im.reshape(-1, d)
+    n = len(im)
+    centroids = im[np.random.choice(np.arange(n), k)]
+    old_centroids = centroids.copy()
+    for i in range(max_iterations):
+        im.shape = (1, n, d)
+        centroids.shape = (k, 1, d)
+        dists = (((im - centroids) ** 2).sum(axis=2)) ** 0.5
+        ix = np.argmin(dists, axis=0)
+        im.shape = (n, d)
+        centroids.shape = (k, d)
+        to_keep = []
+        for j in range(k):
+            j_pixels = im[ix == j]
+            if len(j_pixels) > 0:
+                centroids[j] = j_pixels.mean(axis=0)
+                to_keep.append(j)
+        if len(to_keep) < len(centroids):
+            for j in to_keep[::-1]:
+                centroids = np.delete(centroids, j, axis=0)
+                old_centroids = np.delete(old_centroids, j, axis=0)
+        movement = ((((centroids - old_centroids) ** 2).sum(axis=1)) ** 0.5).max()
+        if movement < min_distance:
+            break
+        old_centroids = centroids.copy()
+    c_max, c_min = centroids[:, :3].max(axis=1), centroids[:, :3].min(axis=1)
+    ix_order = np.argsort(c_max - c_min)[::-1]
+    return centroids[ix_order, :3].astype(np.uint8)
+
+
+def pictures():
+    photo = Image.open(SOURCE).convert('RGB')
+    w, h = photo.size
+    yield 'photo', photo
+    yield 'photo top left', photo.crop((0, 0, w // 2, h // 2))
+    yield 'photo bottom right', photo.crop((w // 2, h // 2, w, h))
+    rng = np.random.default_rng(1)
+    blobs = Image.fromarray(rng.integers(0, 256, (24, 16, 3), dtype=np.uint8)).resize((3000, 2000), Image.BICUBIC)
+    yield 'colour blobs', blobs.filter(ImageFilter.GaussianBlur(20))
+    yield 'gradient', Image.merge('RGB', (Image.linear_gradient('L'), Image.radial_gradient('L'),
+                                          Image.linear_gradient('L').rotate(90))).resize((3000, 2000))
+    flat = Image.new('RGB', (3000, 2000), (30, 60, 200))
+    flat.paste((220, 200, 40), (0, 0, 1000, 2000))
+    flat.paste((20, 20, 20), (2000, 0, 3000, 2000))
+    yield 'three colours', flat
+
+
+def rms_error(image, colors):
+    image = image.copy()
+    image.thumbnail((100, 100))
+    im = np.asarray(image, dtype=float)[:, :, :3].reshape(-1, 1, 3)
+    return float(np.sqrt(((im - np.asarray(colors, dtype=float)[np.newaxis]) ** 2).sum(axis=2).min(axis=1).mean()))
+
+
+def distance(color1, color2):
+    return float(np.sqrt(((color1.astype(float) - color2.astype(float)) ** 2).sum()))
+
+
+def main(number_of_seeds=20):
+    print("{:>20} {:>8} {:>8} {:>9} {:>9} {:>10} {:>10}".format(
+          "", "prev ms", "new ms", "prev rms", "new rms", "mat Δ new", "mat Δ prev"))
+    for label, image in pictures():
+        results = {}
+        for name, func in (("prev", lambda s: previous_kmeans(image)),
+                           ("new", lambda s: KmeansNp(k=3, max_iterations=10, size=100, seed=s).run(image))):
+            colors = []
+            tm = time.perf_counter()
+            for seed in range(number_of_seeds):
+                np.random.seed(seed)
+                colors.append(func(seed))
+            results[name] = (1000 * (time.perf_counter() - tm) / number_of_seeds, colors)
+        prev_ms, prev_colors = results["prev"]
+        new_ms, new_colors = results["new"]
+        prev_rms = np.mean([rms_error(image, c) for c in prev_colors])
+        new_rms = np.mean([rms_error(image, c) for c in new_colors])
+        mat_delta = np.mean([distance(p[0], n[0]) for p, n in zip(prev_colors, new_colors)])
+        prev_delta = np.mean([distance(p[0], n[0]) for p, n in zip(prev_colors, prev_colors[1:])])
+        print("{:>20} {:>8.2f} {:>8.2f} {:>9.1f} {:>9.1f} {:>10.1f} {:>10.1f}".format(
+              label, prev_ms, new_ms, prev_rms, new_rms, mat_delta, prev_delta))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,37 @@
+"""Benchmark of MatImage.mat_image() for each mat style.
+
+Mats a 3000x2000 and a 2000x3000 picture in turn for a 1920x1080 display,
+number_of_slides times per style, with the outer and inner mat colours given
+and with them picked from each picture (which adds the k-means colour search
+and means a different mat colour for every picture), and reports ms per slide.
+
+    python -m test.benchmarks.bench_mat_image [number_of_slides]
+"""
+import os
+import sys
+import time
+from PIL import Image
+from picframe.mat_image import MatImage
+
+RESOURCE_FOLDER = os.path.join(os.path.dirname(__file__), '..', '..', 'src', 'picframe', 'data', 'mat')
+
+
+def main(number_of_slides=10):
+    landscape = Image.radial_gradient('L').resize((3000, 2000)).convert('RGB')
+    portrait = Image.linear_gradient('L').resize((2000, 3000)).convert('RGB')
+    print("{:>18} {:>14} {:>14}".format("", "given ms", "auto ms"))
+    for mat_type in MatImage((1920, 1080), resource_folder=RESOURCE_FOLDER).mat_types:
+        times = []
+        for color in ((200, 180, 150), None):
+            matter = MatImage((1920, 1080), mat_type=mat_type, resource_folder=RESOURCE_FOLDER,
+                              outer_mat_color=color, inner_mat_color=color,
+                              outer_mat_use_texture=True, inner_mat_use_texture=True)
+            tm = time.perf_counter()
+            for i in range(number_of_slides):
+                matter.mat_image((landscape if i % 2 == 0 else portrait,))
+            times.append(1000 * (time.perf_counter() - tm) / number_of_slides)
+        print("{:>18} {:>14.1f} {:>14.1f}".format(mat_type, *times))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
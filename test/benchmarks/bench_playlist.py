@@ -0,0 +1,112 @@
+"""Benchmark of building the slideshow playlist.
+
+Fills a db with number_of_files file records, a third of them portrait, in 100
+folders (created empty on disk so the scan leaves them alone) and compares the
+previous reshuffle, query_cache with ORDER BY RANDOM() returning a list of
+tuples, against Playlist: the first load (query_playlist, load and arrange), a
+reshuffle after that (arrange only) and then number_of_new new files applied as
+Model does, from get_file_events, rather than loading it all again. Reports ms
+and the memory held by the result, with and without portrait pairs.
+
+    python -m test.benchmarks.bench_playlist [number_of_files] [number_of_new]
+"""
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+import tracemalloc
+from picframe import image_cache, playlist
+
+WHERE = "fname LIKE '{}/%'"
+RECENT = "last_modified < {:.0f}".format(time.time() - 3 * 24 * 3600)
+
+
+class NoGeoReverse:
+    def get_address(self, lat, lon):
+        return ""
+
+
+def fill_db(pic_dir, db_file, number_of_files):
+    cache = image_cache.ImageCache(pic_dir, False, db_file, NoGeoReverse(), rescan_interval=1e9, geo_rate=0)
+    cache.stop()
+    db = sqlite3.connect(db_file)
+    for f in range(100):
+        folder = os.path.join(pic_dir, 'folder{:03d}'.format(f))
+        os.makedirs(folder, exist_ok=True)
+        db.execute("INSERT INTO folder(folder_id, name, last_modified) VALUES(?, ?, ?)",
+                   (f + 1, folder, int(os.stat(folder).st_mtime)))
+    sql = "INSERT INTO file(file_id, folder_id, basename, extension, last_modified) VALUES(?, ?, ?, 'jpg', ?)"
+    db.executemany(sql, ((i, i % 100 + 1, 'img{:06d}'.format(i), time.time() - i * 60)
+                         for i in range(1, number_of_files + 1)))
+    db.executemany("INSERT INTO meta(file_id, width, height) VALUES(?, ?, ?)",
+                   ((i, 2000, 3000) if i % 3 == 0 else (i, 3000, 2000) for i in range(1, number_of_files + 1)))
+    db.commit()
+    db.close()
+
+
+def add_files(pic_dir, db_file, first_id, number_of_new):
+    # as if synced from a phone, just now
+    db = sqlite3.connect(db_file)
+    sql = "INSERT INTO file(file_id, folder_id, basename, extension, last_modified) VALUES(?, 1, ?, 'jpg', ?)"
+    db.executemany(sql, ((i, 'new{:06d}'.format(i), time.time()) for i in range(first_id, first_id + number_of_new)))
+    db.executemany("INSERT INTO meta(file_id, width, height) VALUES(?, 3000, 2000)",
+                   ((i,) for i in range(first_id, first_id + number_of_new)))
+    db.commit()
+    db.close()
+
+
+def measure(func):
+    # timed without tracemalloc, which slows Python code down a lot, then again for the memory held
+    tm = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - tm
+    tracemalloc.start()
+    result = func()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return 1000 * elapsed, size / 1048576, result
+
+
+def main(number_of_files=100000, number_of_new=500):
+    with tempfile.TemporaryDirectory() as tmp:
+        pic_dir = os.path.join(tmp, 'pictures')
+        db_file = os.path.join(tmp, 'bench.db3')
+        fill_db(pic_dir, db_file, number_of_files)
+        print("{:>28} {:>10} {:>10}".format("", "ms", "MB held"))
+        for portrait_pairs in (False, True):
+            cache = image_cache.ImageCache(pic_dir, False, db_file, NoGeoReverse(), portrait_pairs=portrait_pairs,
+                                           rescan_interval=1e9, geo_rate=0)
+            cache.pause_looping(True)
+            where = WHERE.format(pic_dir)
+            label = " pairs" if portrait_pairs else ""
+            ms, mb, result = measure(lambda: cache.query_cache(where, RECENT + ",RANDOM()"))
+            print("{:>28} {:>10.1f} {:>10.1f}".format("previous" + label, ms, mb))
+            slides = len(result)
+            del result
+            plist = playlist.Playlist(portrait_pairs)
+
+            def load():
+                plist.load(cache.query_playlist(where, "file_id"))  # as Model does when shuffling
+                plist.arrange(True, time.time() - 3 * 24 * 3600)
+                return plist
+            ms, mb, _ = measure(load)
+            print("{:>28} {:>10.1f} {:>10.1f}".format("Playlist load" + label, ms, mb))
+            ms, _, _ = measure(lambda: plist.arrange(True, time.time() - 3 * 24 * 3600))
+            print("{:>28} {:>10.1f} {:>10}".format("Playlist reshuffle" + label, ms, ""))
+            assert len(plist) == slides
+            seq = cache.get_file_event_seq()
+            add_files(pic_dir, db_file, number_of_files + 1 + portrait_pairs * number_of_new, number_of_new)
+
+            def apply_new():
+                _, changed, removed = cache.get_file_events(seq)
+                rows = list(cache.query_playlist(where, "file_id", changed))
+                plist.update(rows, removed, 0, time.time() - 3 * 24 * 3600)
+            ms, _, _ = measure(apply_new)
+            print("{:>28} {:>10.1f} {:>10}".format("Playlist {} new".format(number_of_new) + label, ms, ""))
+            assert len(plist) == slides + number_of_new
+            cache.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,66 @@
+"""Benchmark of handing finished slides from a worker process to the render process.
+
+Prepares a 4000x2500 picture with blurred edges for a 1920x1080 display, an RGBA
+image of about 8MB, number_of_slides times in one worker process and reports the
+time per slide and the CPU used by the receiving (render) process, returning the
+image pickled through a ProcessPoolExecutor against SlideDecoderPool's shared
+memory buffers. The disk cache is off so every slide is built from scratch.
+
+    python -m test.benchmarks.bench_slide_handoff [number_of_slides]
+"""
+import os
+import sys
+import time
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from picframe import slide_loader
+
+LOADER_KWARGS = dict(display_size=(1920, 1080), mat_images=False, blur_edges=True)
+
+
+class BenchPic:
+    def __init__(self, fname):
+        self.fname = fname
+        self.file_id = 1
+        self.last_modified = 0
+        self.orientation = 1
+
+
+def load_pickled(pics):
+    im = slide_loader._worker_loader.load(pics)
+    return np.asarray(im)
+
+
+def timed(label, load, release, pics, number_of_slides):
+    load(pics)  # start up the worker
+    wall_tm = time.perf_counter()
+    cpu_tm = time.process_time()
+    for _ in range(number_of_slides):
+        im = load(pics)
+        release(im)
+    wall_tm = (time.perf_counter() - wall_tm) / number_of_slides
+    cpu_tm = (time.process_time() - cpu_tm) / number_of_slides
+    print("{:>16} {:>12.1f} {:>12.1f}".format(label, 1000 * wall_tm, 1000 * cpu_tm))
+
+
+def main(number_of_slides=20):
+    with tempfile.TemporaryDirectory() as tmp:
+        fname = os.path.join(tmp, 'picture.jpg')
+        Image.radial_gradient('L').resize((2500, 4000)).convert('RGB').save(fname, quality=90)
+        pics = (BenchPic(fname), None)
+        print("{:>16} {:>12} {:>12}".format("", "ms/slide", "render CPU ms"))
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=slide_loader.init_decode_worker,
+                                 initargs=(LOADER_KWARGS, None)) as pool:
+            timed("pickled", lambda p: pool.submit(load_pickled, p).result(), lambda im: None, pics,
+                  number_of_slides)
+        decoder = slide_loader.SlideDecoderPool(LOADER_KWARGS, buffers=2)
+        timed("shared memory", decoder.load, decoder.release, pics, number_of_slides)
+        decoder.stop()
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,12 @@
+import os
+
+
+class DummyPic:
+    """Stands in for model.Pic, with just what SlideLoader and the slide caches use"""
+
+    def __init__(self, fname, file_id=1, orientation=1):
+        self.fname = fname
+        self.file_id = file_id
+        self.last_modified = os.path.getmtime(fname) if os.path.exists(fname) else 0
+        self.orientation = orientation
+        self.palette = None
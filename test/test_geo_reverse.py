@@ -0,0 +1,67 @@
+import pickle
+import numpy as np
+
+from src.picframe.geo_reverse import GeoReverseOffline
+
+KEY_LIST = [['tourism', 'amenity', 'isolated_dwelling'],
+            ['suburb', 'village'],
+            ['city', 'county'],
+            ['region', 'state', 'province'],
+            ['country']]
+
+PLACES = [  # geonameid, name, asciiname, alternatenames, lat, lon, class, code, country, cc2, admin1, ..., population
+    ['292223', 'Dubai', 'Dubai', '', '25.07725', '55.30927', 'P', 'PPLA', 'AE', '', '03', '', '', '', '2956587'],
+    ['291074', 'Ras al-Khaimah', 'Ras al-Khaimah', '', '25.78953', '55.9432', 'P', 'PPLA', 'AE', '', '05', '', '', '',
+     '351943'],
+    ['2643743', 'London', 'London', '', '51.50853', '-0.12574', 'P', 'PPLC', 'GB', '', 'ENG', '', '', '', '8961989'],
+    ['2657832', 'Abinger Hammer', 'Abinger Hammer', '', '51.21', '-0.42', 'P', 'PPL', 'GB', '', 'ENG', '', '', '',
+     '600'],
+    ['4017700', 'Pacific', 'Pacific', '', '0.0', '-179.9', 'P', 'PPL', 'KI', '', '', '', '', '', '0'],
+    ['3448439', 'São Paulo', 'Sao Paulo', '', '-23.5475', '-46.63611', 'P', 'PPLA', 'BR', '', '27', '', '', '',
+     '10021295'],
+    ['2993458', 'Mont Blanc', 'Mont Blanc', '', '45.83', '6.86', 'T', 'MT', 'FR', '', '', '', '', '', '0'],
+]
+
+
+def write_data(tmp_path):
+    data_file = tmp_path / "cities1000.txt"
+    data_file.write_text("".join("\t".join(p + ['', '', 'tz', '2020-01-01']) + "\n" for p in PLACES))
+    (tmp_path / "admin1CodesASCII.txt").write_text("AE.03\tDubai\tDubai\t292224\nGB.ENG\tEngland\tEngland\t6269131\n")
+    (tmp_path / "countryInfo.txt").write_text("#ISO\tISO3\tISO-Numeric\tfips\tCountry\n"
+                                              "AE\tARE\t784\tAE\tUnited Arab Emirates\n"
+                                              "GB\tGBR\t826\tUK\tUnited Kingdom\n")
+    return str(data_file)
+
+
+def test_nearest_place(tmp_path):
+    geo = GeoReverseOffline(write_data(tmp_path), KEY_LIST)
+    assert geo.get_address(25.1973, 55.2744) == "Dubai, Dubai, United Arab Emirates"
+    assert geo.get_address(51.2, -0.4) == "Abinger Hammer, England, United Kingdom"
+    assert geo.get_address(0.1, 179.95) == "Pacific, KI"  # across the date line, no name for KI
+    assert geo.get_address(45.83, 6.86) == ""  # mountains aren't populated places
+    assert geo.get_address(-23.5, -46.6) == "São Paulo, BR"
+    assert (tmp_path / "cities1000.txt.npz").exists()
+
+
+def test_loads_saved_arrays(tmp_path):
+    data_file = write_data(tmp_path)
+    GeoReverseOffline(data_file, KEY_LIST).get_address(0.0, 0.0)
+    (tmp_path / "cities1000.txt").unlink()
+    assert GeoReverseOffline(data_file, KEY_LIST).get_address(51.5, -0.1) == "London, England, United Kingdom"
+
+
+def test_older_saved_arrays_read_again(tmp_path):
+    data_file = write_data(tmp_path)
+    np.savez(data_file + ".npz", name=np.array(["Nowhere"]), n_lon=360)  # fixed width unicode, as before
+    assert GeoReverseOffline(data_file, KEY_LIST).get_address(51.5, -0.1) == "London, England, United Kingdom"
+
+
+def test_pickled_for_index_process(tmp_path):
+    geo = GeoReverseOffline(write_data(tmp_path), KEY_LIST)
+    geo.get_address(0.0, 0.0)  # places loaded, but not pickled
+    geo = pickle.loads(pickle.dumps(geo))
+    assert geo.get_address(51.5, -0.1) == "London, England, United Kingdom"
+
+
+def test_missing_data_file(tmp_path):
+    assert GeoReverseOffline(str(tmp_path / "none.txt"), KEY_LIST).get_address(51.5, -0.1) == ""
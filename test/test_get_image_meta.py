@@ -155,3 +155,109 @@ def test_exifs_heic():
 
     except Exception:
         pytest.fail("Unexpected exception")
+
+
+def write_iptc_jpg(fname, datasets):
+    # A JPEG with an APP13 Photoshop segment holding an 8BIM IPTC resource of the
+    # (record, dataset, text) datasets, as written by photo editors
+    import io
+    import struct
+    from PIL import Image
+    iptc = b''.join(b'\x1c' + struct.pack('>BBH', record, dataset, len(value.encode('utf-8')))
+                    + value.encode('utf-8') for record, dataset, value in datasets)
+    resource = b'8BIM' + struct.pack('>H', 0x0404) + b'\x00\x00' + struct.pack('>L', len(iptc)) + iptc
+    if len(iptc) % 2:
+        resource += b'\x00'
+    app13 = b'Photoshop 3.0\x00' + resource
+    buf = io.BytesIO()
+    Image.new('RGB', (64, 48)).save(buf, format='JPEG')
+    jpeg = buf.getvalue()
+    with open(fname, 'wb') as f:
+        f.write(jpeg[:2] + b'\xff\xed' + struct.pack('>H', len(app13) + 2) + app13 + jpeg[2:])
+
+
+@pytest.mark.parametrize("fast", [False, True])
+def test_iptc_jpg(tmp_path, fast):
+    fname = str(tmp_path / "iptc.jpg")
+    write_iptc_jpg(fname, [(1, 90, '\x1b%G'),  # coded character set UTF-8
+                           (2, 25, 'eins'), (2, 25, 'zwei'), (2, 25, 'über'),
+                           (2, 120, 'Hier ist die Beschreibung'),
+                           (2, 5, 'Das ist die Überschrift')])
+    exifs = GetImageMeta(fname, fast=fast)
+    assert exifs.get_exif('IPTC Keywords') == 'eins,zwei,über,'
+    assert exifs.get_exif('IPTC Caption/Abstract') == 'Hier ist die Beschreibung'
+    assert exifs.get_exif('IPTC Object Name') == 'Das ist die Überschrift'
+    assert exifs.get_size() == (64, 48)
+
+
+META_KEYS = ['EXIF FNumber', 'Image Make', 'Image Model', 'EXIF ExposureTime', 'EXIF ISOSpeedRatings',
+             'EXIF FocalLength', 'Image Rating', 'EXIF LensModel', 'EXIF DateTimeOriginal', 'IPTC Keywords',
+             'IPTC Object Name', 'IPTC Caption/Abstract']
+
+
+def meta_values(exifs):
+    return ([exifs.get_size(), exifs.get_orientation(), exifs.get_location()]
+            + [exifs.get_exif(key) for key in META_KEYS])
+
+
+@pytest.mark.parametrize("fname", ["test/images/AlleExif.JPG", "test/images/test3.HEIC", "test/images/noimage.jpg"])
+def test_fast_same_as_pil(fname):
+    assert meta_values(GetImageMeta(fname, fast=True)) == meta_values(GetImageMeta(fname))
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+def test_fast_jpg(tmp_path, endian):
+    from PIL import Image
+    from PIL.TiffImagePlugin import IFDRational
+    exif = Image.Exif()
+    exif.endian = endian
+    exif[0x0112] = 6  # Orientation
+    exif[0x010F] = 'Canon'
+    exif[0x4746] = 4  # Rating
+    ifd = exif.get_ifd(0x8769)
+    ifd[0x829D] = IFDRational(28, 10)  # FNumber
+    ifd[0x829A] = IFDRational(1, 250)  # ExposureTime
+    ifd[0x8827] = 200  # ISOSpeedRatings
+    ifd[0xA434] = 'EF50mm f/1.8'  # LensModel
+    gps = exif.get_ifd(0x8825)
+    gps[1] = 'S'
+    gps[2] = (IFDRational(33, 1), IFDRational(52, 1), IFDRational(1234, 100))
+    gps[3] = 'E'
+    gps[4] = (IFDRational(151, 1), IFDRational(12, 1), IFDRational(3, 1))
+    fname = str(tmp_path / "exif.jpg")
+    Image.new('RGB', (300, 200)).save(fname, exif=exif.tobytes())
+    exifs = GetImageMeta(fname, fast=True)
+    assert exifs.get_size() == (300, 200)
+    assert exifs.get_orientation() == 6
+    assert exifs.get_exif('EXIF ExposureTime') == "1/250"
+    assert exifs.get_exif('EXIF ISOSpeedRatings') == 200
+    assert exifs.get_exif('Image Rating') == 4
+    assert meta_values(exifs) == meta_values(GetImageMeta(fname))
+
+
+def test_fast_jpg_xmp(tmp_path):
+    from PIL import Image
+    xmp = Image.open("test/images/test3.HEIC").info['xmp']
+    fname = str(tmp_path / "xmp.jpg")
+    Image.new('RGB', (30, 20)).save(fname, xmp=xmp)
+    exifs = GetImageMeta(fname, fast=True)
+    assert exifs.get_exif('IPTC Keywords') == 'Stichwort1,Stichwort2,'
+    assert exifs.get_exif('IPTC Object Name') == 'Das ist die Überschrift'
+    assert exifs.get_exif('IPTC Caption/Abstract') == 'Hier ist die Beschreibung'
+    assert meta_values(exifs) == meta_values(GetImageMeta(fname))
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_thumbnail(fast):
+    thumbnail = GetImageMeta("test/images/AlleExif.JPG", fast=fast).get_thumbnail()
+    assert thumbnail.size == (256, 160) and thumbnail.mode == "RGB"
+    assert GetImageMeta("test/images/noimage.jpg", fast=fast).get_thumbnail() is None
+
+
+@pytest.mark.parametrize("size", [(100, 100), (300, 40), (900, 100), (1920, 1200), (2000, 100)])
+def test_get_image_object_covers_size(size):
+    image = GetImageMeta.get_image_object("test/images/AlleExif.JPG", size)  # 1920x1200
+    assert image.mode == "RGB"
+    assert image.width >= min(size[0], 1920) and image.height >= min(size[1], 1200)
+    if size == (100, 100):
+        assert image.size == (240, 150)  # draft at 1/8, not the full size
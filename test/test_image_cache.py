@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import pytest
+
+from src.picframe import image_cache
+from src.picframe.image_cache import ImageCache
+from src.picframe.mat_image import palette_from_text
+
+
+class DummyGeoReverse:
+    def get_address(self, lat, lon):
+        return ""
+
+
+def wait_for_files(cache, where_clause="1", number=1, timeout=10.0):
+    end_tm = time.time() + timeout
+    while time.time() < end_tm:
+        files = cache.query_cache(where_clause)
+        if len(files) >= number:
+            return files
+        time.sleep(0.05)
+    return cache.query_cache(where_clause)
+
+
+@pytest.fixture
+def pic_dir(tmp_path):
+    pic_dir = tmp_path / "pictures"
+    pic_dir.mkdir()
+    return pic_dir
+
+
+@pytest.fixture
+def make_cache(tmp_path, pic_dir):
+    # make_cache(pictures, geo_reverse, **kwargs) copies a test picture to each of the names in
+    # pictures, relative to pic_dir, and returns an ImageCache of pic_dir. All are stopped at the end
+    caches = []
+
+    def make(pictures=("one.jpg",), geo_reverse=DummyGeoReverse(), **kwargs):
+        for name in pictures:
+            (pic_dir / name).parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy("test/images/AlleExif.JPG", pic_dir / name)
+        caches.append(ImageCache(str(pic_dir), False, str(tmp_path / "test.db3"), geo_reverse, **kwargs))
+        return caches[-1]
+    yield make
+    for cache in caches:
+        cache.stop()  # again if the test already has
+
+
+@pytest.fixture
+def cache(make_cache):
+    return make_cache()
+
+
+def test_files_indexed(cache):
+    files = wait_for_files(cache)
+    assert len(files) == 1
+    row = cache.get_file_info(files[0][0])
+    assert row['fname'].endswith("/one.jpg")
+    assert row['width'] == 1920
+    assert row['height'] == 1200
+    assert row['make'] == "SONY"
+
+
+def test_changed_file_keeps_file_id(cache):
+    files = wait_for_files(cache)
+    file_id = files[0][0]
+    fname = cache.get_file_info(file_id)['fname']
+    mod_tm = os.path.getmtime(fname) + 10.0
+    os.utime(fname, (mod_tm, mod_tm))
+    row = cache.get_file_info(file_id)  # notices the change and re-reads the meta data
+    assert row['last_modified'] == mod_tm
+    assert row['make'] == "SONY"
+    assert cache.query_cache("1") == [(file_id,)]
+
+
+def test_indexing_in_child_process(make_cache, tmp_path):
+    cache = make_cache(index_process=True)
+    files = wait_for_files(cache)
+    assert len(files) == 1
+    file_id = files[0][0]
+    fname = cache.get_file_info(file_id)['fname']
+    mod_tm = os.path.getmtime(fname) + 10.0
+    os.utime(fname, (mod_tm, mod_tm))
+    assert cache.get_file_info(file_id)['last_modified'] == mod_tm  # read again by the child
+    cache.stop()
+    db = sqlite3.connect(str(tmp_path / "test.db3"))
+    assert db.execute("SELECT displayed_count FROM file").fetchone()[0] == 2
+
+
+def test_suspended_cache_ignores_new_files(cache, pic_dir):
+    wait_for_files(cache)
+    cache.suspend(True)
+    time.sleep(1.1)  # folder times are held to the second
+    shutil.copy("test/images/AlleExif.JPG", pic_dir / "two.jpg")
+    time.sleep(3.0)  # longer than rescan_interval
+    assert len(cache.query_cache("1")) == 1
+    cache.suspend(False)
+    assert len(wait_for_files(cache, number=2)) == 2
+
+
+def test_indexing_rate_limited(make_cache):
+    start_tm = time.time()
+    cache = make_cache(["{}.jpg".format(i) for i in range(6)], index_files_per_sec=4.0)
+    assert len(wait_for_files(cache, number=6)) == 6
+    assert time.time() - start_tm > 1.2  # the sixth can't start before 6 / 4 seconds
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="inotify is Linux only")
+def test_stop_and_suspend_during_backlog(make_cache):
+    cache = make_cache(["{}.jpg".format(i) for i in range(40)], index_files_per_sec=5.0)
+    wait_for_files(cache)
+    cache.suspend(True)
+    time.sleep(0.5)  # let it settle
+    count = len(cache.query_cache("1"))
+    cpu_tm = time.process_time()
+    time.sleep(1.0)
+    assert time.process_time() - cpu_tm < 0.2  # not spinning
+    assert len(cache.query_cache("1")) == count
+    cache.suspend(False)
+    assert len(wait_for_files(cache, number=count + 1)) < 40
+    start_tm = time.time()
+    cache.stop()
+    assert time.time() - start_tm < 2.0  # doesn't wait for the backlog
+
+
+def test_watcher_picks_up_changes(make_cache, pic_dir):
+    cache = make_cache([], watch_files=True, rescan_interval=3600.0)
+    time.sleep(0.5)  # let the first walk finish so only the watcher can find the new files
+    (pic_dir / "sub").mkdir()
+    shutil.copy("test/images/AlleExif.JPG", pic_dir / "sub" / "new.jpg")
+    shutil.copy("test/images/AlleExif.JPG", pic_dir / "new.jpg")
+    assert len(wait_for_files(cache, number=2)) == 2
+    os.remove(pic_dir / "new.jpg")
+    assert len(wait_for_files(cache, "fname LIKE '%sub/new.jpg'")) == 1
+    end_tm = time.time() + 10.0
+    while len(cache.query_cache("1")) > 1 and time.time() < end_tm:
+        time.sleep(0.05)
+    assert len(cache.query_cache("1")) == 1
+
+
+def test_file_not_kept_without_meta(make_cache, tmp_path, monkeypatch):
+    get_exif_info = image_cache.get_exif_info
+
+    def bad_meta(file_path_name):
+        meta = get_exif_info(file_path_name)
+        if file_path_name.endswith("bad.jpg"):
+            meta['make'] = object()  # sqlite can't store this
+        return meta
+    monkeypatch.setattr(image_cache, "get_exif_info", bad_meta)
+    cache = make_cache(["good.jpg", "bad.jpg"])
+    assert len(wait_for_files(cache)) == 1
+    cache.stop()
+    db = sqlite3.connect(str(tmp_path / "test.db3"))
+    assert db.execute("SELECT basename FROM file").fetchall() == [("good",)]
+    db.close()
+
+
+def test_purge_files(make_cache, pic_dir):
+    cache = make_cache(["one.jpg", "sub/two.jpg"], rescan_interval=0.1)
+    file_ids = set(file[0] for file in wait_for_files(cache, number=2))
+    assert len(file_ids) == 2
+    seq, changed, removed = cache.get_file_events(0)
+    assert changed == file_ids and removed == set()
+    shutil.rmtree(pic_dir / "sub")  # folder is flagged missing, its files drop out of all_data
+    end_tm = time.time() + 10.0
+    while len(cache.query_cache("1")) > 1 and time.time() < end_tm:
+        time.sleep(0.05)
+    assert len(cache.query_cache("1")) == 1
+    seq, changed, removed = cache.get_file_events(seq)
+    assert changed == set() and removed == file_ids - set(cache.query_cache("1")[0])
+    os.remove(pic_dir / "one.jpg")
+    cache.purge_files()
+    end_tm = time.time() + 10.0
+    while len(cache.query_cache("1")) > 0 and time.time() < end_tm:
+        time.sleep(0.05)
+    assert cache.query_cache("1") == []
+    assert cache.get_file_events(seq)[2] == file_ids  # both deleted now
+
+
+def test_reads_not_blocked_by_writer(cache, tmp_path):
+    files = wait_for_files(cache)
+    lock = cache._ImageCache__db_write_lock
+    with lock:  # as if the indexer was in the middle of a long batch
+        row = cache.get_file_info(files[0][0])
+        assert row['make'] == "SONY"
+        assert cache.query_cache("1") == files
+    db = sqlite3.connect(str(tmp_path / "test.db3"))
+    sql = "SELECT displayed_count FROM file WHERE file_id = ?"
+    end_tm = time.time() + 10.0
+    while db.execute(sql, files[0]).fetchone()[0] == 0 and time.time() < end_tm:
+        time.sleep(0.05)  # stats are written later by the indexer thread
+    assert db.execute(sql, files[0]).fetchone()[0] == 1
+    db.close()
+
+
+class CountingGeoReverse:
+    def __init__(self, location):
+        self.location = location
+        self.calls = 0
+
+    def get_address(self, lat, lon):
+        self.calls += 1
+        return self.location
+
+
+@pytest.mark.parametrize("location", ["Dubai", ""])
+def test_locations_looked_up_in_background(make_cache, location):
+    geo = CountingGeoReverse(location)
+    cache = make_cache(geo_reverse=geo)
+    files = wait_for_files(cache, "location IS NOT NULL" if location else "1")
+    time.sleep(0.2)
+    row = cache.get_file_info(files[0][0])
+    time.sleep(0.2)
+    assert row['location'] == (location or None)
+    assert geo.calls == 1  # failures aren't retried straight away
+
+
+@pytest.mark.parametrize("load_geoloc, geo", [(False, CountingGeoReverse("Dubai")), (True, None)])
+def test_no_look_ups_without_geoloc(make_cache, load_geoloc, geo):
+    cache = make_cache(geo_reverse=geo, load_geoloc=load_geoloc)
+    files = wait_for_files(cache)
+    row = cache.get_file_info(files[0][0])
+    time.sleep(0.2)
+    assert row['latitude'] is not None
+    assert cache.get_file_info(files[0][0])['location'] is None
+    assert geo is None or geo.calls == 0
+
+
+def test_nearby_locations_share_a_look_up(make_cache, tmp_path):
+    geo = CountingGeoReverse("Dubai")
+    cache = make_cache(geo_reverse=geo)
+    wait_for_files(cache, "location IS NOT NULL")
+    cache.stop()
+    db = sqlite3.connect(str(tmp_path / "test.db3"))
+    db.execute("UPDATE meta SET latitude = latitude + 0.0001")  # a few metres away, same grid cell
+    db.commit()
+    db.close()
+    cache = make_cache([], geo_reverse=geo)
+    assert len(wait_for_files(cache, "location = 'Dubai'")) == 1
+    assert geo.calls == 1  # from the cache loaded at start up
+
+
+def test_palette_indexed(cache):
+    files = wait_for_files(cache)
+    row = cache.get_file_info(files[0][0])
+    colors = palette_from_text(row['palette'])
+    assert 1 <= len(colors) <= 3
+    assert all(0 <= c <= 255 for color in colors for c in color)
+    assert 0.0 < row['luminance'] < 1.0
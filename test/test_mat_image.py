@@ -0,0 +1,38 @@
+import pytest
+from PIL import Image, ImageChops
+
+from src.picframe.mat_image import MatImage, KmeansNp, palette_from_text, palette_to_text
+
+RESOURCE_FOLDER = "src/picframe/data/mat"
+
+
+@pytest.mark.parametrize("mat_type", MatImage((320, 200), resource_folder=RESOURCE_FOLDER).mat_types)
+def test_cached_mats_not_drawn_on(mat_type):
+    matter = MatImage((320, 200), mat_type=mat_type, resource_folder=RESOURCE_FOLDER, outer_mat_border=20,
+                      inner_mat_border=10, outer_mat_color=(200, 180, 150), inner_mat_use_texture=True)
+    first = matter.mat_image((Image.new("RGB", (300, 400), (255, 0, 0)),))
+    matter.mat_image((Image.new("RGB", (400, 300), (0, 0, 255)),))
+    again = matter.mat_image((Image.new("RGB", (300, 400), (255, 0, 0)),))
+    assert first.size == (320, 200)
+    assert ImageChops.difference(first, again).getbbox() is None
+
+
+def test_palette_used_for_outer_mat():
+    matter = MatImage((320, 200), mat_type='float', resource_folder=RESOURCE_FOLDER, outer_mat_use_texture=False)
+    im = matter.mat_image((Image.new("RGB", (300, 400), (0, 0, 255)),), palette=[(200, 0, 0), (0, 0, 255)])
+    assert im.getpixel((0, 0)) == (202, 2, 2)  # quantized
+    matter.outer_mat_color = (255, 255, 255)
+    im = matter.mat_image((Image.new("RGB", (300, 400), (0, 0, 255)),), palette=[(200, 0, 0)])
+    assert im.getpixel((0, 0)) == (255, 255, 255)  # configured colours are used as they are
+    assert palette_from_text(palette_to_text([(200, 0, 0), (1, 2, 255)])) == [(200, 0, 0), (1, 2, 255)]
+
+
+def test_kmeans_seeded_most_saturated_first():
+    image = Image.new("RGB", (300, 200), (40, 40, 40))
+    image.paste((200, 40, 30), (0, 0, 100, 200))
+    image.paste((90, 100, 110), (200, 0, 300, 200))
+    colors = KmeansNp(k=3, max_iterations=10, size=100, seed=1).run(image)
+    expected = [(200, 40, 30), (90, 100, 110), (40, 40, 40)]
+    assert abs(colors.astype(int) - expected).max() <= 2  # a little blending where the thumbnail is resized
+    image = Image.open("test/images/AlleExif.JPG")
+    assert (KmeansNp(seed=2).run(image) == KmeansNp(seed=2).run(image)).all()
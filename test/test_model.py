@@ -0,0 +1,46 @@
+import time
+import shutil
+import pytest
+
+from src.picframe.model import Model
+
+
+@pytest.fixture
+def model(tmp_path):
+    pic_dir = tmp_path / "pictures"
+    pic_dir.mkdir()
+    for name in ("a.jpg", "b.jpg", "c.jpg"):
+        shutil.copy("test/images/AlleExif.JPG", pic_dir / name)
+    config = tmp_path / "configuration.yaml"
+    config.write_text("viewer: {{}}\n"
+                      "model: {{pic_dir: '{0}', db_file: '{1}', load_geoloc: False, shuffle: False}}\n"
+                      "mqtt: {{}}\nhttp: {{}}\nperipherals: {{}}\n".format(pic_dir, tmp_path / "test.db3"))
+    model = Model(str(config))
+    end_tm = time.time() + 10.0
+    while model.get_number_of_files() < 3 and time.time() < end_tm:  # wait for the indexer
+        model.force_reload()
+        model.get_next_file()
+        time.sleep(0.1)
+    yield model
+    model.stop_image_chache()
+
+
+def names(upcoming):
+    return [pics[0].fname.rsplit("/", 1)[-1] for pics in upcoming]
+
+
+def test_upcoming_files_wrap_round_at_end(model):
+    model.force_reload()
+    assert names(model.get_upcoming_files(2)) == []  # not known until the list is loaded again
+    shown = [model.get_next_file()[0].fname.rsplit("/", 1)[-1] for _ in range(3)]
+    assert shown == ["a.jpg", "b.jpg", "c.jpg"]
+    assert names(model.get_upcoming_files(2)) == ["a.jpg", "b.jpg"]  # starts again after the last
+    assert names(model.get_upcoming_files(5)) == ["a.jpg", "b.jpg", "c.jpg"]  # each slide only once
+
+
+def test_no_upcoming_files_when_reshuffled_at_end(model):
+    model.shuffle = True
+    model.force_reload()
+    for _ in range(3):
+        model.get_next_file()
+    assert model.get_upcoming_files(2) == []  # the next list isn't known until it is shuffled
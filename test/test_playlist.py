@@ -0,0 +1,42 @@
+from src.picframe.playlist import Playlist
+
+# file_id, is_portrait, last_modified
+ROWS = [(1, 0, 100.0), (2, 1, 200.0), (3, 1, 300.0), (4, 0, 400.0), (5, 1, 500.0), (6, 0, 600.0)]
+
+
+def slides(playlist):
+    return [playlist[i] for i in range(len(playlist))]
+
+
+def test_in_order_with_portrait_pairs():
+    playlist = Playlist(portrait_pairs=True)
+    playlist.load(iter(ROWS))
+    playlist.arrange(shuffle=False)
+    assert slides(playlist) == [(1,), (2, 3), (4,), (5,), (6,)]  # as ImageCache.query_cache pairs them
+    assert playlist.number_of_files == 6
+    assert playlist.remove(3) == 1
+    assert slides(playlist) == [(1,), (4,), (5,), (6,)]
+    assert playlist.remove(3) == -1
+
+
+def test_seeded_shuffle_recent_first():
+    playlists = []
+    for _ in range(2):
+        playlist = Playlist(seed=42)
+        playlist.load(iter(ROWS))
+        playlist.arrange(shuffle=True, recent_time=450.0)
+        playlists.append(slides(playlist))
+    assert playlists[0] == playlists[1]
+    assert sorted(playlists[0][:2]) == [(5,), (6,)]
+    assert sorted(playlists[0][2:]) == [(1,), (2,), (3,), (4,)]
+
+
+def test_update_in_place():
+    playlist = Playlist(seed=1)
+    playlist.load(iter(ROWS[:4]))
+    playlist.arrange(shuffle=False)
+    before = playlist.update([(7, 0, 700.0), (8, 0, 100.0), (4, 1, 400.0)], {1, 2}, 3, recent_time=650.0)
+    assert before == 2  # 1 and 2 had been shown
+    assert slides(playlist)[:2] == [(3,), (7,)]  # recent one next
+    assert sorted(slides(playlist)) == [(3,), (4,), (7,), (8,)]
+    assert playlist.number_of_files == 4
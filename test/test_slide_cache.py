@@ -0,0 +1,83 @@
+import os
+import pytest
+from PIL import Image
+
+from src.picframe.slide_cache import DiskSlideCache, MemorySlideCache
+from src.picframe.slide_loader import SlideLoader
+from test.stubs import DummyPic
+
+
+def test_put_get(tmp_path):
+    cache = DiskSlideCache(str(tmp_path / "cache"), 10)
+    key = cache.key((DummyPic("test/images/AlleExif.JPG"), None), ("settings",))
+    assert cache.get(key) is None
+    cache.put(key, Image.new("RGB", (64, 32), (200, 0, 0)))
+    cache.put(key + "a", Image.new("RGBA", (64, 32), (0, 0, 200, 128)))
+    cache = DiskSlideCache(str(tmp_path / "cache"), 10)  # found again after a restart
+    im = cache.get(key)
+    assert im.size == (64, 32) and im.mode == "RGB"
+    assert cache.get(key + "a").mode == "RGBA"
+    assert key != cache.key((DummyPic("test/images/AlleExif.JPG"), None), ("other settings",))
+
+
+def test_least_recently_used_evicted(tmp_path):
+    cache = DiskSlideCache(str(tmp_path / "cache"), 0.5)
+    noise = Image.effect_noise((200, 200), 100).convert("RGB")  # doesn't compress well
+    cache.put("first", noise)
+    cache.put("second", noise)
+    assert cache.get("first") is not None  # so second is now the oldest
+    for i in range(20):
+        cache.put("more{}".format(i), noise)
+        if not cache.contains("second"):
+            break
+    assert not cache.contains("second")
+    assert cache.contains("more{}".format(i))
+    total = sum(os.path.getsize(os.path.join(tmp_path / "cache", f)) for f in os.listdir(tmp_path / "cache"))
+    assert total <= 0.5 * 1024 * 1024
+
+
+def test_loader_uses_cache(tmp_path):
+    cache = DiskSlideCache(str(tmp_path / "cache"), 10)
+    loader = SlideLoader((320, 320), mat_images=False, blur_edges=True, disk_cache=cache)
+    pics = (DummyPic("test/images/AlleExif.JPG"), None)
+    loader.warm(pics)
+    assert len(os.listdir(tmp_path / "cache")) == 2  # jpg and alpha png
+    im = loader.load(pics)
+    assert im.format == "JPEG"  # read back from the cache
+    assert im.mode == "RGBA"
+    assert im.size == (320, 320)
+    loader = SlideLoader((320, 200), mat_images=False, disk_cache=cache)
+    loader.load(pics)  # nothing done to the image beyond opening it, not worth caching
+    assert len(os.listdir(tmp_path / "cache")) == 2
+
+
+def test_size_limit_shared_between_processes(tmp_path):
+    shared = DiskSlideCache.shared_total()
+    caches = [DiskSlideCache(str(tmp_path / "cache"), 0.5, shared) for _ in range(2)]
+    noise = Image.effect_noise((200, 200), 100).convert("RGB")
+    for i in range(20):
+        caches[i % 2].put("slide{}".format(i), noise)
+    assert caches[0].get("slide19") is not None  # saved by the other one
+    total = sum(os.path.getsize(os.path.join(tmp_path / "cache", f)) for f in os.listdir(tmp_path / "cache"))
+    assert total <= 0.5 * 1024 * 1024
+
+
+@pytest.mark.parametrize("mat_type, cached", [("float", True), ("float single_bevel", False)])
+def test_matted_cached_for_one_mat_type(tmp_path, mat_type, cached):
+    loader = SlideLoader((320, 320), mat_type=mat_type, mat_resource_folder="src/picframe/data/mat",
+                         disk_cache=DiskSlideCache(str(tmp_path / "cache"), 10))
+    loader.warm((DummyPic("test/images/AlleExif.JPG"), None))
+    assert (len(os.listdir(tmp_path / "cache")) == 1) == cached
+
+
+def test_memory_least_recently_used_dropped():
+    cache = MemorySlideCache(1)  # room for four 256x256 RGBA images
+    images = [Image.new("RGBA", (256, 256)) for _ in range(5)]
+    for i, im in enumerate(images[:4]):
+        cache.put(i, im)
+    assert cache.get(0) is images[0]  # so 1 is now the oldest
+    cache.put(4, images[4])
+    assert 1 not in cache
+    assert all(i in cache for i in (0, 2, 3, 4))
+    cache.put(5, Image.new("RGB", (1024, 1024)))  # bigger than the whole cache, not kept
+    assert 5 not in cache and 0 in cache
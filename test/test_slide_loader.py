@@ -0,0 +1,128 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+from src.picframe.slide_loader import SlideLoader, SlideDecoderPool, SlidePrefetcher
+from test.stubs import DummyPic
+
+
+def test_decoder_pool_same_as_loader():
+    kwargs = dict(display_size=(320, 320), mat_images=False, blur_edges=True)
+    pics = (DummyPic("test/images/AlleExif.JPG"), None)
+    expected = np.asarray(SlideLoader(**kwargs).load(pics))
+    pool = SlideDecoderPool(kwargs, buffers=1)
+    try:
+        for _ in range(2):  # the second load needs the buffer given back by release()
+            arr = pool.load(pics)
+            assert arr.shape == expected.shape
+            assert np.array_equal(arr, expected)
+            pool.release(arr)
+        assert pool.load((DummyPic("test/images/missing.jpg"), None)) is None
+    finally:
+        pool.stop()
+
+
+@pytest.mark.parametrize("orientation", [1, 6, 8])
+def test_loader_covers_display_once_orientated(orientation):
+    pic = DummyPic("test/images/AlleExif.JPG", orientation=orientation)  # 1920x1200
+    im = SlideLoader((900, 100), mat_images=False).load((pic, None))
+    assert im.width >= 900 and im.height >= 100  # 5 to 8 need the display size swapped to decode
+
+
+def test_decoder_pool_shrinks_to_cover_display():
+    pool = SlideDecoderPool(dict(display_size=(320, 100), mat_images=False))
+    try:
+        arr = pool.load((DummyPic("test/images/AlleExif.JPG"), None))  # 1920x1200, draft gives 480x300
+        assert arr.shape == (200, 320, 3)
+    finally:
+        pool.stop()
+
+
+class StubLoader:
+    # loads wait for gate, the image is the file name
+    def __init__(self):
+        self.gate = threading.Event()
+        self.loaded = []
+        self.released = []
+
+    def load(self, pics):
+        self.loaded.append(pics[0].fname)
+        self.gate.wait(timeout=5.0)
+        return pics[0].fname
+
+    def release(self, im):
+        self.released.append(im)
+
+
+def wait_until(condition, timeout=5.0):
+    end_tm = time.time() + timeout
+    while not condition() and time.time() < end_tm:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_prefetch_replaces_list():
+    loader = StubLoader()
+    prefetcher = SlidePrefetcher(loader, depth=3)
+    try:
+        prefetcher.prefetch([(DummyPic(name), None) for name in ("a", "b", "c")])
+        assert wait_until(lambda: loader.loaded == ["a"])
+        prefetcher.prefetch([(DummyPic("d"), None)])  # a carries on, b and c are never loaded
+        loader.gate.set()
+        assert wait_until(lambda: not prefetcher.busy)
+        assert loader.loaded == ["a", "d"]
+        assert prefetcher.get((DummyPic("d"), None)) == "d"
+    finally:
+        prefetcher.stop()
+
+
+def test_get_waits_for_load_in_progress():
+    loader = StubLoader()
+    prefetcher = SlidePrefetcher(loader, depth=2)
+    try:
+        prefetcher.prefetch([(DummyPic("a"), None)])
+        assert wait_until(lambda: loader.loaded == ["a"])
+        threading.Timer(0.2, loader.gate.set).start()
+        assert prefetcher.get((DummyPic("a"), None)) == "a"
+        assert prefetcher.get((DummyPic("b"), None)) is None  # not asked for, doesn't wait
+    finally:
+        prefetcher.stop()
+
+
+def test_dropped_images_released():
+    loader = StubLoader()
+    loader.gate.set()
+    prefetcher = SlidePrefetcher(loader, depth=2)
+    try:
+        prefetcher.prefetch([(DummyPic("a"), None), (DummyPic("b"), None)])
+        assert wait_until(lambda: not prefetcher.busy)
+        prefetcher.prefetch([(DummyPic("b"), None)])
+        assert loader.released == ["a"]
+        assert prefetcher.get((DummyPic("b"), None)) == "b"
+    finally:
+        prefetcher.stop()
+
+
+class BarrierLoader:
+    # each load only finishes once `parties` of them are running at the same time
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=2.0)
+
+    def load(self, pics):
+        self.barrier.wait()
+        return pics[0].fname
+
+    def release(self, im):
+        pass
+
+
+def test_prefetcher_threads_load_in_parallel():
+    prefetcher = SlidePrefetcher(BarrierLoader(2), depth=2, threads=2)
+    try:
+        pics = [(DummyPic("a.jpg"), None), (DummyPic("b.jpg"), None)]
+        prefetcher.prefetch(pics)
+        wait_until(lambda: not prefetcher.busy)  # one thread alone would fail at the barrier
+        assert [prefetcher.get(p) for p in pics] == ["a.jpg", "b.jpg"]
+    finally:
+        prefetcher.stop()
@@ -0,0 +1,83 @@
+import time
+import pytest
+
+from src.picframe.model import DEFAULT_CONFIG
+from src.picframe.viewer_display import ViewerDisplay
+
+
+class StubDisplay:
+    """Counts loop_running() calls instead of presenting frames"""
+
+    def __init__(self):
+        self.is_running = True
+        self.loops = 0
+
+    def loop_running(self):
+        self.loops += 1
+        return self.is_running
+
+
+class StubSlide:
+    """Counts draw() calls, unif is all of the shader state the frame signature reads"""
+
+    def __init__(self):
+        self.unif = [0.0] * 60
+        self.draws = 0
+
+    def draw(self):
+        self.draws += 1
+
+
+@pytest.fixture
+def viewer(monkeypatch):
+    config = {**DEFAULT_CONFIG['viewer'], 'fps': 200.0, 'idle_fps': 1.0, 'show_clock': False, 'kenburns': False}
+    viewer = ViewerDisplay(config)
+    # a slide already faded in and well away from the next one, what is left of slideshow_is_running
+    viewer._ViewerDisplay__display = StubDisplay()
+    viewer._ViewerDisplay__slide = StubSlide()
+    viewer._ViewerDisplay__textblocks = [None, None]
+    viewer._ViewerDisplay__sfg = object()
+    viewer._ViewerDisplay__sbg = object()
+    viewer._ViewerDisplay__alpha = 1.0
+    viewer._ViewerDisplay__next_tm = time.time() + 100.0
+    viewer.events = False
+    monkeypatch.setattr(viewer, '_ViewerDisplay__events_pending', lambda: viewer.events)
+    return viewer
+
+
+def run(viewer, n):
+    for _ in range(n):
+        assert viewer.slideshow_is_running() == (True, False)
+    return viewer._ViewerDisplay__slide.draws, viewer._ViewerDisplay__display.loops
+
+
+def test_unchanged_frame_not_redrawn(viewer):
+    assert run(viewer, 2) == (2, 2)  # the second loop_running() presents the first frame
+    assert viewer.frame_is_drawn
+    assert run(viewer, 5) == (2, 2)
+    assert not viewer.frame_is_drawn
+
+
+def test_change_redraws(viewer):
+    run(viewer, 3)
+    viewer.overlay_state = "menu"
+    assert run(viewer, 1) == (3, 3)
+    viewer._ViewerDisplay__slide.unif[44] = 0.5
+    assert run(viewer, 1) == (4, 4)
+    assert run(viewer, 3) == (5, 5)  # then back to idle after it's been presented
+
+
+def test_pending_events_redraw(viewer):
+    run(viewer, 3)
+    viewer.events = True
+    assert run(viewer, 2) == (4, 4)  # loop_running() gets to read them
+    viewer.events = False
+    assert run(viewer, 2) == (4, 4)
+
+
+def test_idle_fps_redraws(viewer):
+    run(viewer, 3)
+    viewer._ViewerDisplay__last_draw_tm -= 1.0
+    assert run(viewer, 2) == (3, 3)
+    viewer._ViewerDisplay__idle_fps = 0.0
+    assert run(viewer, 2) == (5, 5)